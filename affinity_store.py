@@ -0,0 +1,365 @@
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+# 相性テーブルのバイナリストア
+# 血統名を category コードに変換し、main_affinity を N×N×N×N の密な配列
+# ([親, 祖父, 祖母, 子] の順)、C値を N×N の行列として保持する。
+# ファイルは読み取り専用でメモリマップされるため、gunicorn の各ワーカーは
+# ページキャッシュ上の1つのコピーを共有する。
+#
+# 起動時に必要な派生インデックス (best_ab_lookup の元になる配列、モン類ごとの血統一覧と相性値の上界、
+# 血統リスト) も同じファイルに格納し、元ファイルの内容ハッシュをキーにしたスナップショット
+# として扱う。元ファイルが変わらない限り、起動時は pandas を使わずにファイルを開くだけで済む。
+
+STORE_MAGIC = b'MFSTORE\x01'
+STORE_FORMAT_VERSION = 4
+STORE_ALIGNMENT = 64
+DEFAULT_STORE_PATH = os.environ.get('AFFINITY_STORE_PATH', 'part_affinity_store.bin')
+
+AFFINITY_COLUMNS = ['parent_bloodline', 'grandpa_bloodline', 'grandma_bloodline', 'child_bloodline']
+
+
+class AffinityStore:
+    def __init__(self, bloodlines, arrays, meta=None, path=None, file_id=None):
+        self.bloodlines = list(bloodlines)
+        self.codes = {bl: i for i, bl in enumerate(self.bloodlines)}
+        # memmap のサブクラスを外して素の ndarray ビューとして扱う (実体は共有マップのまま)
+        self.arrays = {name: np.asarray(arr) for name, arr in arrays.items()}
+        self.meta = meta or {}
+        self.path = path
+        # 開いたときのファイルの (inode, サイズ, 更新時刻)。再読み込みでパスの中身が差し替えられたかの判定に使う
+        self.file_id = file_id
+        # [親, 祖父, 祖母, 子] -> main_affinity (欠損は NaN)
+        self.affinity = self.arrays['affinity']
+        # [親①, 親②] -> C値 (非対称の値を優先し、なければソート済みペアの値)
+        self.c_matrix = self.arrays['c_matrix']
+        # [親, 子] -> 最大の main_affinity と、それを与える (祖父, 祖母) のコード (無ければ -1)
+        self.best_ab_affinity = self.arrays['best_ab_affinity']
+        self.best_ab_grandparents = self.arrays['best_ab_grandparents']
+        # 除外を考慮した探索用に、相性値の降順に並べた祖父母の順位表 (欠損は末尾)
+        # [親, 子] -> 祖父×N+祖母 / [親, 祖父, 子] -> 祖母 / [親, 祖母, 子] -> 祖父
+        self.ranked_grandparent_pairs = self.arrays['ranked_grandparent_pairs']
+        self.ranked_grandmas = self.arrays['ranked_grandmas']
+        self.ranked_grandpas = self.arrays['ranked_grandpas']
+        self.monsters_by_category = self.meta.get('monsters_by_category', {})
+        # モン類の並びと [親, モン類] -> モン類の子に対する best_ab_affinity の最大値 (値が無ければ NaN)
+        self.categories = self.meta.get('categories', [])
+        self.category_best_ab_max = self.arrays['category_best_ab_max']
+
+    @property
+    def version(self):
+        # 元ファイルの内容ハッシュから作ったデータバージョン
+        return self.meta.get('version')
+
+    @property
+    def size(self):
+        return len(self.bloodlines)
+
+    def code(self, bloodline):
+        return self.codes.get(bloodline)
+
+    def main_affinity(self, parent, grandpa, grandma, child):
+        codes = self.codes
+        p = codes.get(parent)
+        gp = codes.get(grandpa)
+        gm = codes.get(grandma)
+        c = codes.get(child)
+        if p is None or gp is None or gm is None or c is None:
+            return None
+        val = self.affinity.item(p, gp, gm, c)
+        if val != val:
+            return None
+        return val
+
+    def category_codes(self, category):
+        # モン類に属する血統のコード (コード順)。未知のモン類なら None
+        if category not in self.monsters_by_category:
+            return None
+        return sorted(self.codes[bl] for bl in self.monsters_by_category[category] if bl in self.codes)
+
+    def c_value(self, p1, p2):
+        i = self.codes.get(p1)
+        j = self.codes.get(p2)
+        if i is None or j is None:
+            return None
+        val = self.c_matrix.item(i, j)
+        if val != val:
+            return None
+        return val
+
+    def c_pairs(self):
+        # C値が定義されている (親①, 親②) の組み合わせを列挙
+        rows, cols = np.nonzero(~np.isnan(self.c_matrix))
+        for i, j in zip(rows.tolist(), cols.tolist()):
+            yield (self.bloodlines[i], self.bloodlines[j]), float(self.c_matrix[i, j])
+
+
+def _align(offset):
+    return (offset + STORE_ALIGNMENT - 1) // STORE_ALIGNMENT * STORE_ALIGNMENT
+
+
+def write_store(path, bloodlines, arrays, meta=None):
+    # ヘッダ(JSON) + アライメント済みの生配列 という単純な形式で書き出す
+    entries = {}
+    layout = []
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        entries[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': 0}
+        layout.append((name, arr))
+
+    # オフセットはヘッダ長に依存するため、長さが収束するまで計算し直す
+    header_len = 0
+    while True:
+        offset = _align(len(STORE_MAGIC) + 8 + header_len)
+        for name, arr in layout:
+            entries[name]['offset'] = offset
+            offset = _align(offset + arr.nbytes)
+        header = json.dumps({
+            'format_version': STORE_FORMAT_VERSION,
+            'bloodlines': list(bloodlines),
+            'arrays': entries,
+            'meta': meta or {},
+        }, ensure_ascii=False).encode('utf-8')
+        if len(header) == header_len:
+            break
+        header_len = len(header)
+
+    # 書き込み途中のファイルを他ワーカーが開かないよう、一時ファイル経由で置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(STORE_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, arr in layout:
+            f.seek(entries[name]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(_align(f.tell()))
+    os.replace(tmp_path, path)
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def open_store(path):
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        file_id = (st.st_ino, st.st_size, st.st_mtime_ns)
+        magic = f.read(len(STORE_MAGIC))
+        if magic != STORE_MAGIC:
+            raise ValueError(f"不正なストアファイルです: {path}")
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header.get('format_version') != STORE_FORMAT_VERSION:
+        raise ValueError(f"ストアファイルのバージョンが一致しません: {path}")
+
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=np.dtype(entry['dtype']))
+            continue
+        arrays[name] = np.memmap(path, dtype=np.dtype(entry['dtype']), mode='r', offset=entry['offset'], shape=shape)
+    return AffinityStore(header['bloodlines'], arrays, header.get('meta'), path=path, file_id=file_id)
+
+
+def _category_codes(series, categories):
+    import pandas as pd
+    return pd.Categorical(series, categories=categories).codes.astype(np.int64)
+
+
+def build_store_arrays(part_affinity_df, part_c_df):
+    # 血統の並びはアプリ側と同じく child_bloodline のカテゴリ (ソート済み) を使う
+    bloodlines = sorted(part_affinity_df['child_bloodline'].dropna().unique().tolist())
+    n = len(bloodlines)
+
+    codes = [
+        np.asarray(_category_codes(part_affinity_df[col], bloodlines))
+        for col in AFFINITY_COLUMNS
+    ]
+    valid = np.all([c >= 0 for c in codes], axis=0)
+    if not valid.all():
+        print(f"警告: 未知の血統を含む {int((~valid).sum())} 行を無視しました。")
+
+    affinity = np.full((n, n, n, n), np.nan, dtype=np.float64)
+    p, gp, gm, ch = (c[valid] for c in codes)
+    affinity[p, gp, gm, ch] = part_affinity_df['main_affinity'].to_numpy(dtype=np.float64)[valid]
+
+    c1 = np.asarray(_category_codes(part_c_df['parent1_bloodline'], bloodlines))
+    c2 = np.asarray(_category_codes(part_c_df['parent2_bloodline'], bloodlines))
+    c_vals = part_c_df['c_affinity'].to_numpy(dtype=np.float64)
+    c_valid = (c1 >= 0) & (c2 >= 0)
+    c1, c2, c_vals = c1[c_valid], c2[c_valid], c_vals[c_valid]
+
+    # 非対称 (順序を保持)
+    asymmetric = np.full((n, n), np.nan, dtype=np.float64)
+    asymmetric[c1, c2] = c_vals
+    # 対称 (ソート済みペア) : 血統コードは名前順なので、コードの大小がそのままソート順になる
+    lo = np.minimum(c1, c2)
+    hi = np.maximum(c1, c2)
+    symmetric = np.full((n, n), np.nan, dtype=np.float64)
+    symmetric[lo, hi] = c_vals
+    symmetric = np.where(np.isnan(symmetric), symmetric.T, symmetric)
+    c_matrix = np.where(np.isnan(asymmetric), symmetric, asymmetric)
+
+    best_ab_affinity, best_ab_grandparents = build_best_ab_arrays(affinity)
+    arrays = {
+        'affinity': affinity,
+        'c_matrix': c_matrix,
+        'best_ab_affinity': best_ab_affinity,
+        'best_ab_grandparents': best_ab_grandparents,
+    }
+    arrays.update(build_ranked_grandparent_arrays(affinity))
+    return bloodlines, arrays
+
+
+def build_best_ab_arrays(affinity):
+    # 親と子から最適な祖父母を見つけるためのルックアップ
+    # (祖父・祖母の組を1軸にまとめ、最初に現れる最大値を採用する)
+    n = affinity.shape[0]
+    by_pair = np.nan_to_num(affinity.reshape(n, n * n, n), nan=-np.inf)
+    best_pair = by_pair.argmax(axis=1)
+    best_val = np.take_along_axis(by_pair, best_pair[:, None, :], axis=1)[:, 0, :]
+    found = best_val > -1
+
+    best_ab_affinity = np.where(found, best_val, -1.0)
+    best_ab_grandparents = np.stack([best_pair // n, best_pair % n], axis=-1)
+    best_ab_grandparents[~found] = -1
+    return best_ab_affinity, best_ab_grandparents.astype(np.int32)
+
+
+def _descending_order(values, dtype):
+    # 最後の軸を相性値の降順に並べた順位 (同値は番号順、欠損は末尾)
+    return np.argsort(-np.nan_to_num(values, nan=-np.inf), axis=-1, kind='stable').astype(dtype)
+
+
+def build_ranked_grandparent_arrays(affinity):
+    n = affinity.shape[0]
+    dtype = np.int16 if n * n <= np.iinfo(np.int16).max else np.int32
+    return {
+        # [親, 子, 祖父×N+祖母]
+        'ranked_grandparent_pairs': _descending_order(affinity.transpose(0, 3, 1, 2).reshape(n, n, n * n), dtype),
+        # [親, 祖父, 子, 祖母]
+        'ranked_grandmas': _descending_order(affinity.transpose(0, 1, 3, 2), dtype),
+        # [親, 祖母, 子, 祖父]
+        'ranked_grandpas': _descending_order(affinity.transpose(0, 2, 3, 1), dtype),
+    }
+
+
+def build_monsters_by_category(monsters_df):
+    monsters_by_category = {}
+    for _, row in monsters_df.iterrows():
+        monsters_by_category.setdefault(row['モン類'], []).append(row['主血統'])
+    return monsters_by_category
+
+
+def build_category_arrays(bloodlines, best_ab_affinity, monsters_by_category):
+    # モン類単位の探索の上界に使う、親ごと・モン類ごとの最良の片側の相性値
+    # (モン類のどの子に対しても、片側の相性値はこの値を超えない)
+    codes = {bl: i for i, bl in enumerate(bloodlines)}
+    categories = sorted(monsters_by_category)
+    best = np.where(best_ab_affinity > -1, best_ab_affinity, np.nan)
+    category_max = np.full((len(bloodlines), len(categories)), np.nan)
+    for k, category in enumerate(categories):
+        members = [codes[bl] for bl in monsters_by_category[category] if bl in codes]
+        if members and not np.isnan(best[:, members]).all():
+            with np.errstate(invalid='ignore'):
+                category_max[:, k] = np.nanmax(best[:, members], axis=1)
+    return categories, {'category_best_ab_max': category_max}
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def source_fingerprint(sources):
+    # 元ファイルごとの内容ハッシュと、ハッシュ計算を省くための (サイズ, 更新時刻)
+    return {
+        name: {'sha256': _file_digest(path), 'stat': _file_stat(path)}
+        for name, path in sources.items()
+    }
+
+
+def snapshot_version(fingerprint):
+    digest = hashlib.sha256()
+    digest.update(str(STORE_FORMAT_VERSION).encode('ascii'))
+    for name in sorted(fingerprint):
+        digest.update(name.encode('utf-8'))
+        digest.update(fingerprint[name]['sha256'].encode('ascii'))
+    return digest.hexdigest()[:16]
+
+
+def build_store(sources, path):
+    import pandas as pd
+    print("--- 相性ストアを構築します ---")
+    fingerprint = source_fingerprint(sources)
+    part_affinity_df = pd.read_csv(sources['affinity'])
+    part_c_df = pd.read_csv(sources['c'])
+    monsters_df = pd.read_excel(sources['monsters'])
+    bloodlines, arrays = build_store_arrays(part_affinity_df, part_c_df)
+    monsters_by_category = build_monsters_by_category(monsters_df)
+    categories, category_arrays = build_category_arrays(bloodlines, arrays['best_ab_affinity'], monsters_by_category)
+    arrays.update(category_arrays)
+    meta = {
+        'version': snapshot_version(fingerprint),
+        'sources': fingerprint,
+        'monsters_by_category': monsters_by_category,
+        'categories': categories,
+    }
+    write_store(path, bloodlines, arrays, meta)
+    print(f"--- 相性ストアを書き出しました: {path} (version {meta['version']}) ---")
+
+
+def _is_current(store, sources):
+    # まず (サイズ, 更新時刻) で判定し、異なる場合だけ内容ハッシュを比べる
+    recorded = store.meta.get('sources', {})
+    if set(recorded) != set(sources):
+        return False
+    for name, src in sources.items():
+        if recorded[name]['stat'] == _file_stat(src):
+            continue
+        if recorded[name]['sha256'] != _file_digest(src):
+            return False
+    return True
+
+
+def load_or_build_store(affinity_csv, c_csv, monsters_xlsx, path=DEFAULT_STORE_PATH):
+    # スナップショットが存在し、元ファイルの内容が変わっていなければそのまま開く
+    sources = {'affinity': affinity_csv, 'c': c_csv, 'monsters': monsters_xlsx}
+    for src in sources.values():
+        if not os.path.exists(src):
+            raise FileNotFoundError(src)
+    if os.path.exists(path):
+        try:
+            store = open_store(path)
+            if _is_current(store, sources):
+                return store
+            print("--- 元ファイルが更新されたため、相性ストアを再構築します ---")
+        except ValueError as e:
+            print(f"警告: {e} 再構築します。")
+    build_store(sources, path)
+    return open_store(path)
+
+
+if __name__ == '__main__':
+    # デプロイ時のビルドステップ: python affinity_store.py [出力先]
+    output_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_STORE_PATH
+    build_store({
+        'affinity': 'part_affinity_lookup_table.csv',
+        'c': 'part_C_lookup_table.csv',
+        'monsters': 'monsters.xlsx',
+    }, output_path)
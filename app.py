@@ -1,32 +1,51 @@
-import pandas as pd
-from flask import Flask, request, jsonify, render_template
-import itertools
-import random
-from threading import Event
+import base64
+import json
+import os
+import time
+
+import numpy as np
+
+from flask import Flask, Response, g, request, jsonify, render_template
+from threading import Event, Lock
 from collections import defaultdict
 
+from data_bundle import DataBundle
+from jobs import JobManager, JobQueueFull
+from metrics import new_profile, registry
+from pedigree_planner import PEDIGREE_MAX_DEPTH, cached_depth, plan_pedigree
+from query_planner import (
+    budget_seconds, feedback, plan_lookup, plan_maximin, plan_pareto, plan_pedigree_tables, plan_summary,
+    plan_category_lineages, plan_threshold, plan_top_lineages, record_cost
+)
+from response_encoding import MSGPACK_MIMETYPES, GZIP_MIN_BYTES, gzip_body, msgpack_available, pack_compact
+from result_cache import ResultCache
+from sampled_search import (
+    SAMPLING_MAX_SAMPLES, SAMPLING_ROUND_SIZE, SAMPLING_STABLE_ROUNDS, sampled_maximin, sampled_summary
+)
+from search_engine import (
+    SLOT_NAMES, ExplorationCancelled, SearchContext, add_category_matches, count_lineages_above, deadline_after,
+    lineages_above, pareto_combinations, slot_sensitivity, threshold_parent_pairs, top_category_lineages, top_lineages
+)
+from sharded_search import sharded_maximin_combination, sharded_summarize_combinations
+
 app = Flask(__name__)
 
-# 探索中止フラグ
-is_exploration_cancelled = Event()
+# 実行中の従来の /explore・/explore_multi の中止フラグ (request_id -> Event。ジョブはジョブごとに持つ)
+# /cancel_exploration は同じ request_id の探索だけを中止し、他の利用者の探索には影響しない
+running_explorations = {}
+running_explorations_lock = Lock()
 
-# CSVファイルの読み込み (データ型を最適化)
+# 相性テーブルと派生インデックスの読み込み
 try:
-    part_affinity_df = pd.read_csv('part_affinity_lookup_table.csv').astype({
-        'child_bloodline': 'category',
-        'parent_bloodline': 'category',
-        'grandpa_bloodline': 'category',
-        'grandma_bloodline': 'category'
-    })
-    part_c_df = pd.read_csv('part_C_lookup_table.csv').astype({
-        'parent1_bloodline': 'category',
-        'parent2_bloodline': 'category'
+    # 元ファイルの内容ハッシュをキーにしたスナップショットをメモリマップする (全ワーカーで共有)
+    # 元ファイルが更新されている場合のみ、CSV と monsters.xlsx から再構築する
+    # 稼働中に元ファイルが更新されたら裏で再構築して差し替える。リクエストは開始時のバージョンを最後まで使う
+    data_bundle = DataBundle({
+        'affinity': 'part_affinity_lookup_table.csv',
+        'c': 'part_C_lookup_table.csv',
+        'monsters': 'monsters.xlsx',
     })
-    # monsters.xlsxの読み込み
-    monsters_df = pd.read_excel('monsters.xlsx')
-    monsters_by_category = defaultdict(list)
-    for _, row in monsters_df.iterrows():
-        monsters_by_category[row['モン類']].append(row['主血統'])
+    data_bundle.start_watcher()
 
 except FileNotFoundError:
     print("エラー: 必要なファイルが見つかりません。")
@@ -41,82 +60,282 @@ TARGET_AFFINITY_SCORES = {
     '☆': (615, float('inf'))
 }
 
+# パレート解を求める子の数の上限 (子が多いとパレート解の数と比較の手間が急激に増える)
+PARETO_FRONT_MAX_CHILDREN = int(os.environ.get('PARETO_FRONT_MAX_CHILDREN', 4))
+
 # 共通秘伝の値
 COMMON_SECRET_III_BONUS = 12.5
 COMMON_SECRET_II_BONUS = 5.0
 SUB_BLOODLINE_RARE_BONUS = 224
 
-### ルックアップ辞書の事前構築 ###
-print("--- ルックアップ辞書の構築を開始します ---")
+### ルックアップ用ヘルパー ###
+# C値を取得するヘルパー関数 (非対称の値を優先し、なければソート済みペアの値)
+def get_c_value(p1, p2):
+    return data_bundle.store.c_value(p1, p2)
+
+def get_main_affinity(parent, grandpa, grandma, child):
+    return data_bundle.store.main_affinity(parent, grandpa, grandma, child)
 
-# 非対称辞書 (順序を保持)
-part_c_lookup_asymmetric = part_c_df.set_index(['parent1_bloodline', 'parent2_bloodline']).to_dict()['c_affinity']
-# 対称辞書 (ソート済み)
-part_c_df['sorted_parents'] = part_c_df.apply(lambda row: tuple(sorted((row['parent1_bloodline'], row['parent2_bloodline']))), axis=1)
-part_c_lookup_symmetric = part_c_df.set_index('sorted_parents').to_dict()['c_affinity']
+### 参照データ ###
+# /reference の Cache-Control の max-age (秒)。期限後は ETag (データのバージョン) で再検証する
+REFERENCE_MAX_AGE = int(os.environ.get('REFERENCE_MAX_AGE', 300))
 
-# C値を取得するヘルパー関数
-def get_c_value(p1, p2):
-    val = part_c_lookup_asymmetric.get((p1, p2))
-    if val is not None:
-        return val
-    return part_c_lookup_symmetric.get(tuple(sorted((p1, p2))))
-
-part_affinity_lookup = part_affinity_df.set_index(['parent_bloodline', 'grandpa_bloodline', 'grandma_bloodline', 'child_bloodline']).to_dict()['main_affinity']
-
-# 親と子から最適な祖父母を見つけるためのルックアップを事前に計算
-best_ab_lookup = {}
-all_bloodlines = part_affinity_df['child_bloodline'].cat.categories.tolist()
-for parent in all_bloodlines:
-    for child in all_bloodlines:
-        max_affinity = -1
-        best_gp = None
-        best_gm = None
-        for gp, gm in itertools.product(all_bloodlines, repeat=2):
-            affinity = part_affinity_lookup.get((parent, gp, gm, child), None)
-            if affinity is not None and affinity > max_affinity:
-                max_affinity = affinity
-                best_gp = gp
-                best_gm = gm
-        best_ab_lookup[(parent, child)] = (max_affinity, best_gp, best_gm)
-
-print("--- ルックアップ辞書の構築が完了しました ---")
+_reference_data = {}
+
+def reference_data(store):
+    # 画面と /reference で使う血統・モン類の一覧。データのバージョンごとに1回だけ作る
+    # bloodlines の並びは血統コードの順で、コンパクト形式の結果はこの添字で血統を表す
+    reference = _reference_data.get(store.version)
+    if reference is None:
+        monsters_by_category = defaultdict(list, store.monsters_by_category)
+        reference = {
+            'data_version': store.version,
+            'bloodlines': list(store.bloodlines),
+            'monster_categories': sorted(monsters_by_category.keys()),
+            'monsters_by_category': dict(monsters_by_category),
+            'target_symbols': list(TARGET_AFFINITY_SCORES.keys()),
+        }
+        _reference_data.clear()
+        _reference_data[store.version] = reference
+    return reference
+
+reference_data(data_bundle.store)
 
 @app.route('/')
 def index():
-    main_bloodlines = sorted(part_affinity_df['child_bloodline'].cat.categories.tolist())
-    target_symbols = list(TARGET_AFFINITY_SCORES.keys())
-    monster_categories = sorted(monsters_by_category.keys())
-    return render_template('index.html', bloodlines=main_bloodlines, target_symbols=target_symbols, monster_categories=monster_categories, monsters_by_category=dict(monsters_by_category))
+    # 血統の一覧などは /reference から取得する (ブラウザのキャッシュを使う)
+    reference = reference_data(data_bundle.store)
+    return render_template('index.html', monster_categories=reference['monster_categories'])
+
+@app.route('/reference', methods=['GET'])
+def reference():
+    response = jsonify(reference_data(data_bundle.store))
+    response.set_etag(data_bundle.version, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = REFERENCE_MAX_AGE
+    return response.make_conditional(request)
 
 @app.route('/cancel_exploration', methods=['POST'])
 def cancel_exploration():
-    print("--- 探索中止リクエストを受信しました ---")
-    is_exploration_cancelled.set()
-    return jsonify({"message": "Exploration cancellation requested."})
+    request_id = (request.get_json(silent=True) or {}).get('request_id')
+    if not request_id:
+        return jsonify({"error": "request_id を指定してください。"}), 400
+    print(f"--- 探索中止リクエストを受信しました: {request_id} ---")
+    with running_explorations_lock:
+        cancel_event = running_explorations.get(request_id)
+    if cancel_event is not None:
+        cancel_event.set()
+    return jsonify({"message": "Exploration cancellation requested.", "request_id": request_id, "found": cancel_event is not None})
+
+def request_fixed_bonus(data):
+    # 共通秘伝とサブ血統レアボーナスによる固定ボーナス
+    common_secret_iii = int(data.get('common_secret_iii', 0))
+    common_secret_ii = int(data.get('common_secret_ii', 0))
+    common_secret_bonus = (common_secret_iii * COMMON_SECRET_III_BONUS) + (common_secret_ii * COMMON_SECRET_II_BONUS)
+    return common_secret_bonus + SUB_BLOODLINE_RARE_BONUS
+
+def request_target_min(data):
+    # 目標相性値 (数値の指定が優先、なければ記号の下限値)
+    target_symbol = data.get('target_symbol', '◎')
+    target_affinity_value = data.get('target_affinity_value', None)
+    if target_affinity_value is not None and target_affinity_value != '':
+        try:
+            return float(target_affinity_value)
+        except (ValueError, TypeError):
+            pass
+    target_min, _ = TARGET_AFFINITY_SCORES.get(target_symbol, (496, 614))
+    return target_min
+
+def request_sampling_mode(data):
+    # "sampling": true なら常に標本抽出、"auto" なら厳密な探索が予算に収まらない見積もりの場合だけ標本抽出
+    sampling = data.get('sampling')
+    if sampling == 'auto':
+        return 'auto'
+    return True if sampling else None
+
+def request_budget(data):
+    # 実行計画の予算 (秒)。deadline_ms があればその値
+    return budget_seconds(data.get('deadline_ms', None))
+
+def request_sampling(data):
+    # "sampling" を指定した場合の標本抽出の設定 (seed を省略すると毎回変わり、使ったシードを統計で返す)
+    if not data.get('sampling'):
+        return None
+    seed = data.get('seed', None)
+    return {
+        'seed': int(seed) if seed is not None else None,
+        'max_samples': int(data.get('max_samples', SAMPLING_MAX_SAMPLES)),
+        'round_size': int(data.get('sample_round_size', SAMPLING_ROUND_SIZE)),
+        'stable_rounds': int(data.get('stable_rounds', SAMPLING_STABLE_ROUNDS)),
+    }
+
+def request_allowed_monsters(data):
+    # 所持モンスター (allowed_monsters) を スロット -> 血統名の一覧 (制限の無いスロットは None) にする
+    # 全スロット共通の一覧か、親・祖父母のスロットごとの一覧の辞書で指定する。指定が無ければ None
+    allowed = data.get('allowed_monsters', None)
+    if allowed is None:
+        return None
+    if isinstance(allowed, list):
+        return {slot: allowed for slot in SLOT_NAMES}
+    if (not isinstance(allowed, dict) or not set(allowed) <= set(SLOT_NAMES)
+            or any(names is not None and not isinstance(names, list) for names in allowed.values())):
+        raise ValueError(f"allowed_monsters には血統名の一覧か、{', '.join(SLOT_NAMES)} ごとの一覧を指定してください。")
+    return {slot: allowed.get(slot, None) for slot in SLOT_NAMES}
+
+def request_slot_categories(data):
+    # スロットごとのモン類の制約 (slot_categories)。スロット -> モン類名の辞書
+    categories = data.get('slot_categories', None) or {}
+    if not isinstance(categories, dict) or not set(categories) <= set(SLOT_NAMES):
+        raise ValueError(f"slot_categories には {', '.join(SLOT_NAMES)} ごとのモン類を指定してください。")
+    unknown = [category for category in categories.values()
+               if not isinstance(category, str) or category not in data_bundle.store.monsters_by_category]
+    if unknown:
+        raise ValueError(f"不明なモン類です: {', '.join(map(str, unknown))}")
+    return categories
+
+def request_inventory(data, excluded_monsters):
+    # 所持モンスターを スロット -> 使える血統コードの一覧 (コード順) にする。除外モンスターと未知の血統は除く
+    # モン類の制約があるスロットは、さらにそのモン類の血統に絞る
+    # どちらの指定も無ければ None。戻り値は (一覧, エラーのレスポンス)
+    affinity_store = data_bundle.store
+    try:
+        allowed = request_allowed_monsters(data)
+        categories = request_slot_categories(data)
+    except ValueError as e:
+        return None, ({"error": str(e)}, 400)
+    if categories:
+        allowed = allowed or {slot: None for slot in SLOT_NAMES}
+        for slot, category in categories.items():
+            members = affinity_store.monsters_by_category[category]
+            allowed[slot] = members if allowed[slot] is None else [bl for bl in allowed[slot] if bl in members]
+    if allowed is None:
+        return None, None
+    usable = np.ones(affinity_store.size, dtype=bool)
+    usable[[affinity_store.code(bl) for bl in excluded_monsters if bl in affinity_store.codes]] = False
+    inventory = {}
+    for slot, names in allowed.items():
+        if names is None:
+            inventory[slot] = None
+            continue
+        mask = np.zeros(affinity_store.size, dtype=bool)
+        mask[[affinity_store.code(bl) for bl in names if bl in affinity_store.codes]] = True
+        inventory[slot] = np.flatnonzero(mask & usable).tolist()
+    return inventory, None
+
+def inventory_explorable_codes(inventory, explorable_codes):
+    # サマリー・マルチモードのスロットごとの探索対象 (所持モンスターの指定が無ければ全スロット共通)
+    if inventory is None:
+        return explorable_codes
+    return {slot: codes if codes is not None else explorable_codes for slot, codes in inventory.items()}
+
+def inventory_cache_key(data):
+    allowed = request_allowed_monsters(data)
+    categories = request_slot_categories(data)
+    key = ()
+    if allowed is not None:
+        key += ('allowed',) + tuple(tuple(sorted(set(names))) if names is not None else None for names in allowed.values())
+    if categories:
+        key += ('slot_categories',) + tuple(sorted(categories.items()))
+    return key
+
+def request_deadline(data):
+    # deadline_ms を指定すると、その時間で探索を打ち切り、それまでの暫定結果を返す
+    return deadline_after(data.get('deadline_ms', None))
+
+def interrupted_response(context, payload, best=None, upper_bound=None):
+    # 中止・期限切れで打ち切った探索の暫定結果に、打ち切りの情報を付けて返す
+    # upper_bound は未探索の組み合わせも含めて到達しうる値の上限で、optimality_gap はそれと暫定の最良値 best の差
+    # (0 なら暫定の最良値が最適)。上限が分からない探索では None
+    if upper_bound is None:
+        upper_bound = context.upper_bound
+    if upper_bound is not None and best is not None:
+        upper_bound = max(upper_bound, best)
+    if upper_bound is not None and not np.isfinite(upper_bound):
+        upper_bound = None
+    interrupted = {
+        'reason': context.stop_reason() or 'cancelled',
+        'elapsed_ms': round(context.elapsed() * 1000),
+        'best': best,
+        'upper_bound': upper_bound,
+        'optimality_gap': upper_bound - best if upper_bound is not None and best is not None else None,
+    }
+    print(f"--- 探索を打ち切りました ({interrupted['reason']}) ---")
+    if isinstance(payload, list):
+        return {'results': payload, 'interrupted': interrupted}, 200
+    return {**payload, 'interrupted': interrupted}, 200
 
 def calculate_affinity(child, p1, p2, gp1, gm1, gp2, gm2, fixed_bonus):
     c_val = get_c_value(p1, p2)
-    a_val = part_affinity_lookup.get((p1, gp1, gm1, child), None)
-    b_val = part_affinity_lookup.get((p2, gp2, gm2, child), None)
+    a_val = get_main_affinity(p1, gp1, gm1, child)
+    b_val = get_main_affinity(p2, gp2, gm2, child)
     
     if c_val is not None and a_val is not None and b_val is not None:
         return a_val + b_val + c_val + fixed_bonus
     return -1
 
-@app.route('/explore', methods=['POST'])
-def explore_combinations():
-    print("--- シングルモード探索開始 ---")
-    is_exploration_cancelled.clear()
+def request_parent_pairs(fixed_slots, excluded_monsters, inventory=None):
+    # 子指定の探索で調べる親ペアを (親①, 親②, C値) のコードで列挙する
+    # 固定された親・除外モンスターに合わないペアと、C値が無いペアは除く
+    # 親が所持モンスターで絞り込まれていれば、全ての親ペアではなく候補の組み合わせだけを調べる
+    affinity_store = data_bundle.store
+    if inventory is not None and (inventory['parent1'] is not None or inventory['parent2'] is not None):
+        yield from inventory_parent_pairs(fixed_slots, excluded_monsters, inventory)
+        return
+    if fixed_slots['parent1'] is not None and fixed_slots['parent2'] is not None:
+        p1_cand = fixed_slots['parent1']
+        p2_cand = fixed_slots['parent2']
+        c_val = get_c_value(p1_cand, p2_cand)
+        if c_val is None:
+            return
+        c_candidates = [((p1_cand, p2_cand), c_val)]
+    else:
+        c_candidates = affinity_store.c_pairs()
 
-    data = request.json
+    for (p1_cand, p2_cand), c_val in c_candidates:
+        if fixed_slots['parent1'] is not None and p1_cand != fixed_slots['parent1']:
+            continue
+        if fixed_slots['parent2'] is not None and p2_cand != fixed_slots['parent2']:
+            continue
+        if p1_cand in excluded_monsters or p2_cand in excluded_monsters:
+            continue
+        yield affinity_store.code(p1_cand), affinity_store.code(p2_cand), c_val
+
+def inventory_parent_pairs(fixed_slots, excluded_monsters, inventory):
+    # request_parent_pairs の所持モンスター版 (順序は C値の表の行優先で同じ)
+    affinity_store = data_bundle.store
+    candidates = []
+    for slot in ('parent1', 'parent2'):
+        if fixed_slots[slot] is not None:
+            if fixed_slots[slot] in excluded_monsters or fixed_slots[slot] not in affinity_store.codes:
+                return
+            candidates.append([affinity_store.code(fixed_slots[slot])])
+        elif inventory[slot] is not None:
+            candidates.append(inventory[slot])
+        else:
+            candidates.append([affinity_store.code(bl) for bl in affinity_store.bloodlines if bl not in excluded_monsters])
+    p1_codes, p2_codes = candidates
+    c_sub = affinity_store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    rows, cols = np.nonzero(~np.isnan(c_sub))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        yield p1_codes[i], p2_codes[j], float(c_sub[i, j])
+
+def run_explore(data, context):
+    # /explore と /jobs から共通で呼ばれる探索本体。(レスポンス, ステータスコード) を返す
+    affinity_store = data_bundle.store
+    print("--- シングルモード探索開始 ---")
     
-    common_secret_iii = int(data.get('common_secret_iii', 0))
-    common_secret_ii = int(data.get('common_secret_ii', 0))
-    target_symbol = data.get('target_symbol', '◎')
-    target_affinity_value = data.get('target_affinity_value', None)
     excluded_monsters = set(data.get('excluded_monsters', []))
+    # 所持モンスターの指定があれば、親・祖父母はその中から選ぶ
+    inventory, error = request_inventory(data, excluded_monsters)
+    if error:
+        return error
     limit = int(data.get('limit', 50))
+    # 子の代わりにモン類を指定すると、そのモン類のいずれかの子を生む血統を探す
+    child_category = data.get('child_category', None)
+    # サマリーの結果にモン類ごとの一致数を付けるか
+    group_by_category = bool(data.get('group_by_category', False))
+    # 子指定の探索で、祖父母違いも含めて上位 limit 件を返すか (既定)、同じ親ペアからは1件だけ返すか
+    distinct_parents = bool(data.get('distinct_parents', False))
     
     fixed_slots = {
         'child': data.get('child', None),
@@ -128,23 +347,21 @@ def explore_combinations():
         'grandma2': data.get('grandma2', None)
     }
 
-    common_secret_bonus = (common_secret_iii * COMMON_SECRET_III_BONUS) + (common_secret_ii * COMMON_SECRET_II_BONUS)
-    fixed_bonus = common_secret_bonus + SUB_BLOODLINE_RARE_BONUS
+    fixed_bonus = request_fixed_bonus(data)
 
-    if target_affinity_value is not None and target_affinity_value != '':
-        try:
-            target_min = float(target_affinity_value)
-        except (ValueError, TypeError):
-            target_min, _ = TARGET_AFFINITY_SCORES.get(target_symbol, (496, 614))
-    else:
-        target_min, _ = TARGET_AFFINITY_SCORES.get(target_symbol, (496, 614))
+    target_min = request_target_min(data)
 
     exploring_slot_keys = [key for key, value in fixed_slots.items() if value is None]
-    all_bloodlines = part_affinity_df['child_bloodline'].cat.categories.tolist()
+    all_bloodlines = list(affinity_store.bloodlines)
     explorable_bloodlines = [bl for bl in all_bloodlines if bl not in excluded_monsters]
+    profile = context.profile
+    profile.lap('parse')
 
     # すべてのスロットが固定されている場合の処理
     if not exploring_slot_keys:
+        profile.set_branch('all_fixed')
+        if context.explain:
+            return plan_lookup('all_fixed', 1, request_budget(data)), 200
         child = fixed_slots['child']
         p1 = fixed_slots['parent1']
         p2 = fixed_slots['parent2']
@@ -164,14 +381,45 @@ def explore_combinations():
                     'parent2': p2, 'grandpa2': gp2, 'grandma2': gm2
                 }
             }
-            return jsonify([result])
+            return [result], 200
         else:
-            return jsonify([])
+            return [], 200
+
+    # モン類が子に指定されている場合の処理
+    if fixed_slots['child'] is None and child_category is not None:
+        print("--- モン類が指定されているため、モン類単位の探索を実行します ---")
+        profile.set_branch('category_child')
+        if not isinstance(child_category, str) or child_category not in affinity_store.monsters_by_category:
+            return {"error": f"不明なモン類です: {child_category}"}, 400
+        fixed_codes = {key: affinity_store.code(value) if value is not None else None for key, value in fixed_slots.items()}
+        if any(value is not None and fixed_codes[key] is None for key, value in fixed_slots.items()):
+            return [], 200
+        excluded_codes = {affinity_store.code(bl) for bl in excluded_monsters if bl in affinity_store.codes}
+        if context.explain:
+            parent_pairs = sum(1 for _ in request_parent_pairs(fixed_slots, excluded_monsters, inventory))
+            children = len(affinity_store.category_codes(child_category))
+            return plan_category_lineages(parent_pairs, children, limit, distinct_parents, request_budget(data)), 200
+
+        try:
+            results = top_category_lineages(
+                affinity_store, child_category, request_parent_pairs(fixed_slots, excluded_monsters, inventory),
+                fixed_codes, excluded_codes, fixed_bonus, limit,
+                distinct_parents=distinct_parents, context=context, allowed_codes=inventory
+            )
+        except ExplorationCancelled:
+            partial = context.partial_result or []
+            return interrupted_response(context, partial, best=partial[0]['best_affinity'] if partial else None)
+
+        print("--- モン類単位の探索完了 ---")
+        return results, 200
 
     # 親・祖父母は固定されているが、子が探索対象の場合の処理
     fixed_parent_slots = [fixed_slots['parent1'], fixed_slots['parent2'], fixed_slots['grandpa1'], fixed_slots['grandma1'], fixed_slots['grandpa2'], fixed_slots['grandma2']]
     if fixed_slots['child'] is None and all(fixed_parent_slots) and len(exploring_slot_keys) == 1:
         print("--- 子のみが探索対象のため、詳細情報を生成します ---")
+        profile.set_branch('child_only')
+        if context.explain:
+            return plan_lookup('child_only', len(explorable_bloodlines), request_budget(data)), 200
         detailed_results = []
         
         p1 = fixed_slots['parent1']
@@ -183,14 +431,14 @@ def explore_combinations():
         
         c_val = get_c_value(p1, p2)
         if c_val is None:
-            return jsonify([])
+            return [], 200
         
         for child_bloodline in explorable_bloodlines:
-            if is_exploration_cancelled.is_set():
-                return jsonify({"error": "探索が中止されました"}), 500
+            if context.is_cancelled():
+                return interrupted_response(context, detailed_results)
             
-            a_val = part_affinity_lookup.get((p1, gp1, gm1, child_bloodline), None)
-            b_val = part_affinity_lookup.get((p2, gp2, gm2, child_bloodline), None)
+            a_val = get_main_affinity(p1, gp1, gm1, child_bloodline)
+            b_val = get_main_affinity(p2, gp2, gm2, child_bloodline)
             
             total_affinity = 0
             if a_val is not None and b_val is not None:
@@ -201,261 +449,108 @@ def explore_combinations():
                 'total_affinity': total_affinity if total_affinity > 0 else None
             })
         
-        return jsonify(detailed_results)
+        return detailed_results, 200
 
     # ここから改善されたアルゴリズム (子指定あり)
     if fixed_slots['child']:
         print("--- 子が指定されているため、ヒューリスティック探索を実行します ---")
-        best_affinity = -1
-        best_combination = None
-        
-        child_bl = fixed_slots['child']
-
-        if fixed_slots['parent1'] is not None and fixed_slots['parent2'] is not None:
-            p1_cand = fixed_slots['parent1']
-            p2_cand = fixed_slots['parent2']
-            c_val = get_c_value(p1_cand, p2_cand)
-            if c_val is None:
-                return jsonify([])
-            c_candidates = [((p1_cand, p2_cand), c_val)]
-        else:
-            c_candidates = part_c_df.set_index(['parent1_bloodline', 'parent2_bloodline']).to_dict()['c_affinity'].items()
-            
-        processed_count = 0
-        for (p1_cand, p2_cand), c_val in c_candidates:
-            if is_exploration_cancelled.is_set():
-                print("--- 探索が中断されました ---")
-                return jsonify({"error": "探索が中止されました"}), 500
-
-            if fixed_slots['parent1'] is not None and p1_cand != fixed_slots['parent1']:
-                continue
-            if fixed_slots['parent2'] is not None and p2_cand != fixed_slots['parent2']:
-                continue
-                
-            if p1_cand in excluded_monsters or p2_cand in excluded_monsters:
-                continue
-
-            best_a_val = -1
-            best_b_val = -1
-            
-            # --- ここから修正 ---
-            # parent1の祖父母を探索
-            if fixed_slots['grandpa1'] and fixed_slots['grandma1']:
-                best_gp1 = fixed_slots['grandpa1']
-                best_gm1 = fixed_slots['grandma1']
-                a_val = part_affinity_lookup.get((p1_cand, best_gp1, best_gm1, child_bl), None)
-                best_a_val = a_val if a_val is not None else -1
-            elif fixed_slots['grandpa1']:
-                best_gp1 = fixed_slots['grandpa1']
-                best_gm1 = None
-                max_affinity = -1
-                for gm in explorable_bloodlines:
-                    affinity = part_affinity_lookup.get((p1_cand, best_gp1, gm, child_bl), None)
-                    if affinity is not None and affinity > max_affinity:
-                        max_affinity = affinity
-                        best_gm1 = gm
-                best_a_val = max_affinity
-            elif fixed_slots['grandma1']:
-                best_gp1 = None
-                best_gm1 = fixed_slots['grandma1']
-                max_affinity = -1
-                for gp in explorable_bloodlines:
-                    affinity = part_affinity_lookup.get((p1_cand, gp, best_gm1, child_bl), None)
-                    if affinity is not None and affinity > max_affinity:
-                        max_affinity = affinity
-                        best_gp1 = gp
-                best_a_val = max_affinity
-            else:
-                # 既存のルックアップテーブルから取得
-                a_val, gp1_cand, gm1_cand = best_ab_lookup.get((p1_cand, child_bl), (None, None, None))
-                # ルックアップテーブルの祖父母が除外リストに含まれていないか確認
-                if gp1_cand in excluded_monsters or gm1_cand in excluded_monsters:
-                    # 除外されていた場合、除外リストを考慮して再探索
-                    max_affinity = -1
-                    best_gp1 = None
-                    best_gm1 = None
-                    for gp_new, gm_new in itertools.product(explorable_bloodlines, repeat=2):
-                        affinity = part_affinity_lookup.get((p1_cand, gp_new, gm_new, child_bl), None)
-                        if affinity is not None and affinity > max_affinity:
-                            max_affinity = affinity
-                            best_gp1 = gp_new
-                            best_gm1 = gm_new
-                    best_a_val = max_affinity
-                else:
-                    # 除外されていなければそのまま使用
-                    best_a_val = a_val if a_val is not None else -1
-                    best_gp1 = gp1_cand
-                    best_gm1 = gm1_cand
-                
-            # parent2の祖父母を探索
-            if fixed_slots['grandpa2'] and fixed_slots['grandma2']:
-                best_gp2 = fixed_slots['grandpa2']
-                best_gm2 = fixed_slots['grandma2']
-                b_val = part_affinity_lookup.get((p2_cand, best_gp2, best_gm2, child_bl), None)
-                best_b_val = b_val if b_val is not None else -1
-            elif fixed_slots['grandpa2']:
-                best_gp2 = fixed_slots['grandpa2']
-                best_gm2 = None
-                max_affinity = -1
-                for gm in explorable_bloodlines:
-                    affinity = part_affinity_lookup.get((p2_cand, best_gp2, gm, child_bl), None)
-                    if affinity is not None and affinity > max_affinity:
-                        max_affinity = affinity
-                        best_gm2 = gm
-                best_b_val = max_affinity
-            elif fixed_slots['grandma2']:
-                best_gp2 = None
-                best_gm2 = fixed_slots['grandma2']
-                max_affinity = -1
-                for gp in explorable_bloodlines:
-                    affinity = part_affinity_lookup.get((p2_cand, gp, best_gm2, child_bl), None)
-                    if affinity is not None and affinity > max_affinity:
-                        max_affinity = affinity
-                        best_gp2 = gp
-                best_b_val = max_affinity
-            else:
-                # 既存のルックアップテーブルから取得
-                b_val, gp2_cand, gm2_cand = best_ab_lookup.get((p2_cand, child_bl), (None, None, None))
-                # ルックアップテーブルの祖父母が除外リストに含まれていないか確認
-                if gp2_cand in excluded_monsters or gm2_cand in excluded_monsters:
-                    # 除外されていた場合、除外リストを考慮して再探索
-                    max_affinity = -1
-                    best_gp2 = None
-                    best_gm2 = None
-                    for gp_new, gm_new in itertools.product(explorable_bloodlines, repeat=2):
-                        affinity = part_affinity_lookup.get((p2_cand, gp_new, gm_new, child_bl), None)
-                        if affinity is not None and affinity > max_affinity:
-                            max_affinity = affinity
-                            best_gp2 = gp_new
-                            best_gm2 = gm_new
-                    best_b_val = max_affinity
-                else:
-                    # 除外されていなければそのまま使用
-                    best_b_val = b_val if b_val is not None else -1
-                    best_gp2 = gp2_cand
-                    best_gm2 = gm2_cand
-            # --- 修正ここまで ---
-
-            if best_a_val != -1 and best_b_val != -1:
-                total_affinity = best_a_val + best_b_val + c_val + fixed_bonus
-                
-                if total_affinity > best_affinity:
-                    best_affinity = total_affinity
-                    best_combination = {
-                        'parent1': p1_cand,
-                        'grandpa1': best_gp1,
-                        'grandma1': best_gm1,
-                        'parent2': p2_cand,
-                        'grandpa2': best_gp2,
-                        'grandma2': best_gm2
-                    }
-            
-            processed_count += 1
-            if processed_count % 100 == 0:
-                print(f"  -> 親ペア候補を {processed_count} 件処理中...", end='\r')
+        profile.set_branch('child_specified')
 
-        print("\n--- ヒューリスティック探索完了 ---")
-        if best_combination:
-            result_combination = {key: value for key, value in best_combination.items()}
-            result = {
-                'best_affinity': best_affinity,
-                'combination': result_combination
-            }
-            return jsonify([result])
-        else:
-            return jsonify([])
+        # 血統名はコードに変換して扱う (未知の血統が固定されている場合は組み合わせが成立しない)
+        fixed_codes = {key: affinity_store.code(value) if value is not None else None for key, value in fixed_slots.items()}
+        if any(value is not None and fixed_codes[key] is None for key, value in fixed_slots.items()):
+            return [], 200
+        excluded_codes = {affinity_store.code(bl) for bl in excluded_monsters if bl in affinity_store.codes}
+        if context.explain:
+            parent_pairs = sum(1 for _ in request_parent_pairs(fixed_slots, excluded_monsters, inventory))
+            return plan_top_lineages(parent_pairs, limit, distinct_parents, request_budget(data)), 200
+
+        # 上位 limit 件の血統を有界ヒープで保持しながら1回で走査する
+        try:
+            results = top_lineages(
+                affinity_store, fixed_codes['child'], request_parent_pairs(fixed_slots, excluded_monsters, inventory),
+                fixed_codes, excluded_codes, fixed_bonus, limit,
+                distinct_parents=distinct_parents, context=context, allowed_codes=inventory
+            )
+        except ExplorationCancelled:
+            partial = context.partial_result or []
+            return interrupted_response(context, partial, best=partial[0]['best_affinity'] if partial else None)
+
+        print("--- ヒューリスティック探索完了 ---")
+        return results, 200
 
     else:
         print("--- 子が指定されていないため、サマリーを生成します ---")
-        summary_results = {}
+        profile.set_branch('summary')
         exploring_slot_keys = [key for key, value in fixed_slots.items() if value is None and key != 'child']
-        all_bloodlines = part_affinity_df['child_bloodline'].cat.categories.tolist()
-        explorable_bloodlines = [bl for bl in all_bloodlines if bl not in excluded_monsters]
-
-        C_AFFINITY_THRESHOLD = 0.90
-        top_c_threshold = part_c_df['c_affinity'].quantile(C_AFFINITY_THRESHOLD)
-        part_c_lookup_for_summary = part_c_df[part_c_df['c_affinity'] >= top_c_threshold].set_index(['parent1_bloodline', 'parent2_bloodline']).to_dict()['c_affinity']
-    
         if not exploring_slot_keys:
-            return jsonify([])
-    
-        exploration_space = [explorable_bloodlines] * len(exploring_slot_keys)
-        all_exploring_combinations = itertools.product(*exploration_space)
-    
-        is_fast_mode = len(exploring_slot_keys) >= 4
-        if is_fast_mode:
-            print("空きスロットが4つ以上の為、高速モードで探索します。")
-            sample_size = 40000
-            sampled_combinations = [
-                tuple(random.choices(explorable_bloodlines, k=len(exploring_slot_keys)))
-                for _ in range(sample_size)
-            ]
-            all_exploring_combinations = sampled_combinations
-            
-        processed_count = 0
-        for combo in all_exploring_combinations:
-            if is_exploration_cancelled.is_set():
-                print("--- 探索が中断されました ---")
-                return jsonify({"error": "探索が中止されました"}), 500
-
-            current_fixed_slots = fixed_slots.copy()
-            for i, key in enumerate(exploring_slot_keys):
-                current_fixed_slots[key] = combo[i]
-            
-            p1 = current_fixed_slots['parent1']
-            p2 = current_fixed_slots['parent2']
-    
-            if not p1 or not p2: continue
-            
-            c_val = get_c_value(p1, p2)
-            if c_val is None: continue
-            
-            combo_parts = [current_fixed_slots[key] for key in exploring_slot_keys]
-            summary_key = tuple(combo_parts)
-            
-            if summary_key not in summary_results:
-                summary_results[summary_key] = {'combination': {}, 'matched_children': set()}
-                for i, key in enumerate(exploring_slot_keys):
-                    summary_results[summary_key]['combination'][key] = combo[i]
+            return [], 200
 
-            processed_count += 1
-            print(f"  -> 処理中: {processed_count}件目の組み合わせ...", end='\r')
-
-            for child_bloodline in all_bloodlines:
-                a_val = part_affinity_lookup.get((p1, current_fixed_slots['grandpa1'], current_fixed_slots['grandma1'], child_bloodline), None)
-                b_val = part_affinity_lookup.get((p2, current_fixed_slots['grandpa2'], current_fixed_slots['grandma2'], child_bloodline), None)
-    
-                if a_val is not None and b_val is not None:
-                    total_affinity = a_val + b_val + c_val + fixed_bonus
-                    if total_affinity >= target_min:
-                         summary_results[summary_key]['matched_children'].add(child_bloodline)
-
-        final_summary_list = []
-        for key, value in summary_results.items():
-            final_summary_list.append({
-                'parent_bloodline': " / ".join(value['combination'].values()),
-                'matches': len(value['matched_children']),
-                'combination': value['combination']
-            })
+        # 空きスロットの全組み合わせ × 全ての子をチャンク単位の配列演算で評価する (厳密・再現可能)
+        # 実行計画で、単一プロセス (vectorized)・親ごとに分割した複数プロセス (parallel)・
+        # 標本抽出 (sampled。結果と抽出の統計を返す) のいずれかを選ぶ
+        explorable_codes = inventory_explorable_codes(
+            inventory, [affinity_store.code(bl) for bl in explorable_bloodlines]
+        )
+        sampling = request_sampling(data)
+        if context.memo is None:
+            # 実行計画と探索で中間テーブルを共有する
+            context.memo = {}
+        plan = plan_summary(
+            affinity_store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit, request_budget(data),
+            sampling=request_sampling_mode(data), sampling_options=sampling, detailed=context.explain, context=context
+        )
+        if context.explain:
+            return plan, 200
+        profile.lap('plan')
+        try:
+            started = time.perf_counter()
+            if plan['chosen'] == 'sampled':
+                profile.set_branch('summary_sampled')
+                final_summary_list, sampling_stats = sampled_summary(
+                    affinity_store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                    context=context, **sampling
+                )
+            else:
+                final_summary_list = sharded_summarize_combinations(
+                    affinity_store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                    context=context, workers=plan['workers']
+                )
+                record_cost(plan, time.perf_counter() - started)
+        except ExplorationCancelled:
+            partial = context.partial_result or []
+            return interrupted_response(context, partial, best=partial[0]['matches'] if partial else None)
 
-        print(f"\n--- 探索完了（サマリー生成）---")
-        final_summary_list.sort(key=lambda x: x['matches'], reverse=True)
-        return jsonify(final_summary_list[:limit]) 
+        print(f"--- 探索完了（サマリー生成）---")
+        if group_by_category:
+            add_category_matches(affinity_store, fixed_slots, final_summary_list, fixed_bonus, target_min)
+        if plan['chosen'] == 'sampled':
+            payload = {'results': final_summary_list, 'sampling': sampling_stats}
+            if context.stop_reason():
+                return interrupted_response(
+                    context, payload, best=final_summary_list[0]['matches'] if final_summary_list else None,
+                    upper_bound=sampling_stats['upper_bound'] if sampling_stats else None
+                )
+            return payload, 200
+        return final_summary_list, 200
 
-@app.route('/explore_multi', methods=['POST'])
-def explore_multi_combinations():
+def run_explore_multi(data, context):
+    # マルチモード探索の本体。(レスポンス, ステータスコード) を返す
+    affinity_store = data_bundle.store
     print("--- マルチモード探索開始 ---")
-    is_exploration_cancelled.clear()
-
-    data = request.json
     
-    common_secret_iii = int(data.get('common_secret_iii', 0))
-    common_secret_ii = int(data.get('common_secret_ii', 0))
     excluded_monsters = set(data.get('excluded_monsters', []))
+    inventory, error = request_inventory(data, excluded_monsters)
+    if error:
+        return error
     selected_children = data.get('selected_children', [])
     
     if len(selected_children) < 2:
-        return jsonify({"error": "マルチモードでは子モンスターを2体以上選択してください。"}), 400
+        return {"error": "マルチモードでは子モンスターを2体以上選択してください。"}, 400
+    # "pareto": true の場合は、最低保証相性値が最大の1件ではなくパレート解の一覧を返す
+    pareto = bool(data.get('pareto', False))
+    if pareto and len(selected_children) > PARETO_FRONT_MAX_CHILDREN:
+        return {"error": f"パレート解の探索では子モンスターは {PARETO_FRONT_MAX_CHILDREN} 体までです。"}, 400
 
     fixed_slots = {
         'parent1': data.get('parent1', None),
@@ -466,128 +561,134 @@ def explore_multi_combinations():
         'grandma2': data.get('grandma2', None)
     }
 
-    common_secret_bonus = (common_secret_iii * COMMON_SECRET_III_BONUS) + (common_secret_ii * COMMON_SECRET_II_BONUS)
-    fixed_bonus = common_secret_bonus + SUB_BLOODLINE_RARE_BONUS
+    fixed_bonus = request_fixed_bonus(data)
 
-    all_bloodlines = part_affinity_df['child_bloodline'].cat.categories.tolist()
+    all_bloodlines = list(affinity_store.bloodlines)
     explorable_bloodlines = [bl for bl in all_bloodlines if bl not in excluded_monsters]
+    context.profile.set_branch('multi')
+    context.profile.lap('parse')
 
-    # 選択肢のフィルタリング
-    candidate_lists = []
-    slot_names = ['parent1', 'grandpa1', 'grandma1', 'parent2', 'grandpa2', 'grandma2']
-    
-    for slot in slot_names:
-        if fixed_slots[slot] is not None:
-            candidate_lists.append([fixed_slots[slot]])
-        else:
-            candidate_lists.append(explorable_bloodlines)
-            
-    # 親の組み合わせを重複なく生成するための工夫
-    parent_cand_lists = [
-        [fixed_slots['parent1']] if fixed_slots['parent1'] else explorable_bloodlines,
-        [fixed_slots['parent2']] if fixed_slots['parent2'] else explorable_bloodlines
-    ]
-
-    best_min_affinity = -1
-    best_combination = None
-    processed_count = 0
-    total_calculations = 1
-    
-    for cand_list in candidate_lists:
-        total_calculations *= len(cand_list)
+    # 固定スロットに除外モンスターが含まれる場合は成立する組み合わせが無い
+    if any(value is not None and value in excluded_monsters for value in fixed_slots.values()):
+        return [], 200
 
-    EXPLORATION_THRESHOLD = 1_000_000
-    is_fast_mode = total_calculations > EXPLORATION_THRESHOLD
+    child_codes = [affinity_store.code(child_bl) for child_bl in selected_children]
+    if None in child_codes:
+        return [], 200
 
-    if is_fast_mode:
-        sample_size = min(40000, total_calculations)
-        print(f"総計算量 ({total_calculations}) が閾値 ({EXPLORATION_THRESHOLD}) を超えたため、高速モードで探索します（{sample_size}件の組み合わせをサンプリング）。")
-        exploration_iterator = (tuple(random.choice(candidate_lists[i]) for i in range(len(slot_names))) for _ in range(sample_size))
-    else:
-        print(f"総計算量 ({total_calculations}) が閾値 ({EXPLORATION_THRESHOLD}) 以内のため、網羅的探索を実行します。")
-        exploration_iterator = itertools.product(*candidate_lists)
-
-    for combo in exploration_iterator:
-        if is_exploration_cancelled.is_set():
-            print("--- 探索が中断されました ---")
-            return jsonify({"error": "探索が中止されました"}), 500
+    explorable_codes = inventory_explorable_codes(inventory, [affinity_store.code(bl) for bl in explorable_bloodlines])
+    if context.memo is None:
+        context.memo = {}
+    if pareto:
+        return run_pareto_multi(selected_children, fixed_slots, explorable_codes, child_codes, fixed_bonus, data, context)
 
-        p1_cand, gp1_cand, gm1_cand, p2_cand, gp2_cand, gm2_cand = combo
-
-        if p1_cand in excluded_monsters or p2_cand in excluded_monsters or \
-           gp1_cand in excluded_monsters or gm1_cand in excluded_monsters or \
-           gp2_cand in excluded_monsters or gm2_cand in excluded_monsters:
-            continue
-
-        c_val = get_c_value(p1_cand, p2_cand)
-        if c_val is None:
-            continue
-        
-        min_affinity_for_this_combo = float('inf')
-        valid_combo = True
-        
-        for child_bl in selected_children:
-            total_affinity = calculate_affinity(
-                child_bl,
-                p1_cand, p2_cand,
-                gp1_cand, gm1_cand,
-                gp2_cand, gm2_cand,
-                fixed_bonus
+    # 分枝限定法で最低保証相性値の最大値を厳密に求める
+    # 実行計画で、単一プロセス (decomposed)・複数プロセス (parallel)・標本抽出 (sampled) のいずれかを選ぶ
+    sampling = request_sampling(data)
+    plan = plan_maximin(
+        affinity_store, fixed_slots, explorable_codes, child_codes, fixed_bonus, request_budget(data),
+        sampling=request_sampling_mode(data), sampling_options=sampling, detailed=context.explain, context=context
+    )
+    if context.explain:
+        return plan, 200
+    context.profile.lap('plan')
+    try:
+        started = time.perf_counter()
+        if plan['chosen'] == 'sampled':
+            context.profile.set_branch('multi_sampled')
+            solution, sampling_stats = sampled_maximin(
+                affinity_store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                context=context, **sampling
             )
-            
-            if total_affinity != -1:
-                min_affinity_for_this_combo = min(min_affinity_for_this_combo, total_affinity)
-            else:
-                valid_combo = False
-                break
-        
-        if valid_combo and min_affinity_for_this_combo > best_min_affinity:
-            best_min_affinity = min_affinity_for_this_combo
-            best_combination = {
-                'parent1': p1_cand,
-                'grandpa1': gp1_cand,
-                'grandma1': gm1_cand,
-                'parent2': p2_cand,
-                'grandpa2': gp2_cand,
-                'grandma2': gm2_cand
-            }
+        else:
+            solution = sharded_maximin_combination(
+                affinity_store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                context=context, workers=plan['workers']
+            )
+            record_cost(plan, time.perf_counter() - started)
+    except ExplorationCancelled:
+        partial = context.partial_result or []
+        results = [multi_result(selected_children, entry['min_guaranteed_affinity'], entry['combination'], fixed_bonus)
+                   for entry in partial]
+        return interrupted_response(context, results, best=results[0]['min_guaranteed_affinity'] if results else None)
 
-        processed_count += 1
-        if processed_count % 1000 == 0:
-            print(f"  -> 組み合わせ候補を {processed_count} 件処理中...", end='\r')
-
-    print("\n--- マルチモード探索完了 ---")
-    if best_combination:
-        # 詳細情報も再計算して格納
-        all_children_affinities = {}
-        for child_bl in selected_children:
-            total_affinity = calculate_affinity(
-                child_bl,
-                best_combination['parent1'], best_combination['parent2'],
-                best_combination['grandpa1'], best_combination['grandma1'],
-                best_combination['grandpa2'], best_combination['grandma2'],
-                fixed_bonus
+    print("--- マルチモード探索完了 ---")
+    results = []
+    if solution is not None and solution[1]:
+        results.append(multi_result(selected_children, solution[0], solution[1], fixed_bonus))
+    if plan['chosen'] == 'sampled':
+        payload = {'results': results, 'sampling': sampling_stats}
+        if context.stop_reason():
+            return interrupted_response(
+                context, payload, best=results[0]['min_guaranteed_affinity'] if results else None,
+                upper_bound=sampling_stats['upper_bound'] if sampling_stats else None
             )
-            all_children_affinities[child_bl] = {
-                'affinity': total_affinity,
-            }
+        return payload, 200
+    return results, 200
 
-        result = {
-            'min_guaranteed_affinity': best_min_affinity,
-            'combination': best_combination,
-            'children_details': all_children_affinities
+def multi_result(selected_children, min_affinity, combination, fixed_bonus):
+    # 詳細情報も再計算して格納
+    all_children_affinities = {}
+    for child_bl in selected_children:
+        total_affinity = calculate_affinity(
+            child_bl,
+            combination['parent1'], combination['parent2'],
+            combination['grandpa1'], combination['grandma1'],
+            combination['grandpa2'], combination['grandma2'],
+            fixed_bonus
+        )
+        all_children_affinities[child_bl] = {
+            'affinity': total_affinity,
         }
-        return jsonify([result])
-    else:
-        return jsonify([])
+    return {
+        'min_guaranteed_affinity': min_affinity,
+        'combination': combination,
+        'children_details': all_children_affinities
+    }
 
-@app.route('/get_details', methods=['POST'])
-def get_details():
+def run_pareto_multi(selected_children, fixed_slots, explorable_codes, child_codes, fixed_bonus, data, context):
+    # 子ごとの相性値のベクトルが他の組み合わせに支配されない組み合わせを全て求め、
+    # 最低保証相性値の降順 (同値なら合計の降順) に並べて返す。limit を指定すると先頭の limit 件だけ返す
+    affinity_store = data_bundle.store
+    context.profile.set_branch('multi_pareto')
+    if context.explain:
+        return plan_pareto(affinity_store, fixed_slots, explorable_codes, child_codes, request_budget(data), context=context), 200
+    try:
+        front = pareto_combinations(
+            affinity_store, fixed_slots, explorable_codes, child_codes, fixed_bonus, context=context
+        )
+    except ExplorationCancelled:
+        # 暫定の非劣解 (まだ調べていない組み合わせに支配されうる) を同じ順に並べて返す
+        partial = context.partial_result or []
+        partial.sort(key=lambda entry: (
+            -entry['min_guaranteed_affinity'], -sum(details['affinity'] for details in entry['children_details'].values())
+        ))
+        partial = pareto_limit(partial, data)
+        return interrupted_response(context, partial, best=partial[0]['min_guaranteed_affinity'] if partial else None)
+
+    front.sort(key=lambda entry: (-min(entry[0]), -sum(entry[0])))
+    front = pareto_limit(front, data)
+    results = []
+    for vector, combination in front:
+        results.append({
+            'min_guaranteed_affinity': min(vector),
+            'combination': combination,
+            'children_details': {child_bl: {'affinity': affinity} for child_bl, affinity in zip(selected_children, vector)},
+        })
+    print(f"--- マルチモード探索完了 (パレート解 {len(front)} 件) ---")
+    return results, 200
+
+def pareto_limit(front, data):
+    limit = data.get('limit', None)
+    if limit is not None:
+        return front[:max(0, int(limit))]
+    return front
+
+def run_get_details(data, context):
     print("--- 詳細情報取得リクエストを受信 ---")
-    data = request.json
+    affinity_store = data_bundle.store
+    context.profile.set_branch('details')
      
-    common_secret_iii = int(data.get('common_secret_iii', 0))
-    common_secret_ii = int(data.get('common_secret_ii', 0))
     excluded_monsters = set(data.get('excluded_monsters', []))
      
     fixed_slots = {
@@ -600,10 +701,9 @@ def get_details():
     }
  
     if not fixed_slots['parent1'] or not fixed_slots['parent2']:
-        return jsonify([])
+        return [], 200
  
-    common_secret_bonus = (common_secret_iii * COMMON_SECRET_III_BONUS) + (common_secret_ii * COMMON_SECRET_II_BONUS)
-    fixed_bonus = common_secret_bonus + SUB_BLOODLINE_RARE_BONUS
+    fixed_bonus = request_fixed_bonus(data)
      
     detailed_results = []
      
@@ -613,12 +713,13 @@ def get_details():
     gm1 = fixed_slots['grandma1']
     gp2 = fixed_slots['grandpa2']
     gm2 = fixed_slots['grandma2']
+    context.profile.lap('parse')
 
     c_val = get_c_value(p1, p2)
     if c_val is None:
-        return jsonify([])
+        return [], 200
  
-    all_bloodlines = part_affinity_df['child_bloodline'].cat.categories.tolist()
+    all_bloodlines = list(affinity_store.bloodlines)
  
     for child_bloodline in all_bloodlines:
         total_affinity = calculate_affinity(child_bloodline, p1, p2, gp1, gm1, gp2, gm2, fixed_bonus)
@@ -627,9 +728,633 @@ def get_details():
             'child_bloodline': child_bloodline,
             'total_affinity': total_affinity if total_affinity > 0 else None
         })
+    context.profile.lap('lookup')
  
     print(f"--- 詳細情報取得完了 ---")
-    return jsonify(detailed_results)
+    return detailed_results, 200
+
+# 全件列挙の1ページの上限
+EXPLORATION_PAGE_MAX = int(os.environ.get('EXPLORATION_PAGE_MAX', 1000))
+
+def encode_cursor(key):
+    # 次のページのキー (探索状態は持たない) をデータのバージョンと一緒に不透明な文字列にする
+    affinity_store = data_bundle.store
+    if key is None:
+        return None
+    neg_total, index, i, j = key
+    body = json.dumps({'version': affinity_store.version, 'key': [float(neg_total), int(index), int(i), int(j)]})
+    return base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # (キー, エラーメッセージ) を返す
+    affinity_store = data_bundle.store
+    try:
+        body = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        neg_total, index, i, j = body['key']
+        key = (float(neg_total), int(index), int(i), int(j))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None, "カーソルが不正です。"
+    if body.get('version') != affinity_store.version:
+        return None, "データが更新されたため、最初のページから取得し直してください。"
+    return key, None
+
+def run_what_if(data, context):
+    # 全スロット固定の血統について、1スロットずつ別の血統に替えた場合の相性値を全ての子について求め、
+    # 子ごとに相性値が上がる置き換えを上位 limit 件返す
+    affinity_store = data_bundle.store
+    print("--- 置き換え候補の計算を開始 ---")
+    context.profile.set_branch('what_if')
+    slots = {slot: data.get(slot, None) for slot in SLOT_NAMES}
+    if not all(slots.values()):
+        return {"error": "親・祖父母の6スロットを全て指定してください。"}, 400
+    limit = int(data.get('limit', 3))
+    fixed_bonus = request_fixed_bonus(data)
+    excluded_monsters = set(data.get('excluded_monsters', []))
+    children = data.get('children') or list(affinity_store.bloodlines)
+    context.profile.lap('parse')
+
+    codes = [affinity_store.code(slots[slot]) for slot in SLOT_NAMES]
+    child_codes = [affinity_store.code(child_bl) for child_bl in children]
+    if None in codes or None in child_codes:
+        return [], 200
+
+    current, table = slot_sensitivity(affinity_store, codes)
+    current = current[child_codes] + fixed_bonus
+    table = table[:, :, child_codes] + fixed_bonus
+    context.profile.lap('lookup')
+
+    # 除外モンスターへの置き換えと、現在の値以下になる置き換えは候補にしない
+    # (現在の血統が成立しない子では、成立する置き換えは全て改善とみなす)
+    n = len(affinity_store.bloodlines)
+    replaceable = np.array([bl not in excluded_monsters for bl in affinity_store.bloodlines])
+    gains = table.reshape(len(SLOT_NAMES) * n, len(child_codes))
+    with np.errstate(invalid='ignore'):
+        improving = replaceable[np.tile(np.arange(n), len(SLOT_NAMES))][:, None] & ~np.isnan(gains) & ~(gains <= current)
+    ranked = np.argsort(-np.where(improving, gains, -np.inf), axis=0, kind='stable')[:max(limit, 0)]
+
+    results = []
+    for column, child_bl in enumerate(children):
+        current_affinity = current[column].item()
+        swaps = []
+        for row in ranked[:, column].tolist():
+            if not improving[row, column]:
+                break
+            slot_index, code = divmod(row, n)
+            affinity = gains[row, column].item()
+            swaps.append({
+                'slot': SLOT_NAMES[slot_index],
+                'bloodline': affinity_store.bloodlines[code],
+                'total_affinity': affinity,
+                'delta': affinity - current_affinity if current_affinity == current_affinity else None,
+            })
+        results.append({
+            'child_bloodline': child_bl,
+            'total_affinity': current_affinity if current_affinity > 0 else None,
+            'best_swaps': swaps,
+        })
+    context.profile.lap('aggregation')
+    print("--- 置き換え候補の計算完了 ---")
+    return results, 200
+
+def run_explore_all(data, context):
+    # 子を指定し、目標値以上になる全ての血統の件数と、相性値の降順の1ページ分を返す
+    # 続きは next_cursor を cursor に指定して取得する (同じ探索条件で使うこと)
+    affinity_store = data_bundle.store
+    print("--- 全件列挙開始 ---")
+    child = data.get('child', None)
+    if not child:
+        return {"error": "全件列挙では子モンスターを指定してください。"}, 400
+
+    excluded_monsters = set(data.get('excluded_monsters', []))
+    limit = max(0, min(int(data.get('limit', 50)), EXPLORATION_PAGE_MAX))
+    include_count = bool(data.get('include_count', True))
+    fixed_slots = {slot: data.get(slot, None) for slot in ['child'] + SLOT_NAMES}
+    fixed_bonus = request_fixed_bonus(data)
+    target_min = request_target_min(data)
+
+    after = None
+    if data.get('cursor'):
+        after, error = decode_cursor(data['cursor'])
+        if error:
+            return {"error": error}, 400
+    context.profile.set_branch('threshold')
+    context.profile.lap('parse')
+
+    empty = {'total_count': 0 if include_count else None, 'results': [], 'next_cursor': None, 'target_min': target_min}
+    fixed_codes = {key: affinity_store.code(value) if value is not None else None for key, value in fixed_slots.items()}
+    if any(value is not None and fixed_codes[key] is None for key, value in fixed_slots.items()):
+        return empty, 200
+    excluded_codes = {affinity_store.code(bl) for bl in excluded_monsters if bl in affinity_store.codes}
+
+    # 判定は A + B + C >= 目標値 - 固定ボーナス
+    # ページを先に求めるので、件数を数える途中で打ち切った場合もページは返せる
+    # (件数は None になり、count_at_least にそれまでに数えた件数を返す)
+    threshold = target_min - fixed_bonus
+    results, next_key = [], None
+    try:
+        pairs = threshold_parent_pairs(
+            affinity_store, fixed_codes['child'], request_parent_pairs(fixed_slots, excluded_monsters),
+            fixed_codes, excluded_codes, threshold
+        )
+        if context.explain:
+            return plan_threshold(len(pairs), limit, include_count, request_budget(data)), 200
+        results, next_key = lineages_above(
+            affinity_store, pairs, threshold, fixed_bonus, limit, after=after, context=context
+        )
+        total_count = count_lineages_above(pairs, threshold, context=context) if include_count else None
+    except ExplorationCancelled:
+        return interrupted_response(context, {
+            'total_count': None,
+            'count_at_least': context.progress.get('lineages_counted', 0) if include_count else None,
+            'results': results,
+            'next_cursor': encode_cursor(next_key),
+            'target_min': target_min,
+        })
+
+    print(f"--- 全件列挙完了 ({total_count} 件中 {len(results)} 件) ---")
+    return {
+        'total_count': total_count,
+        'results': results,
+        'next_cursor': encode_cursor(next_key),
+        'target_min': target_min,
+    }, 200
+
+def run_plan_pedigree(data, context):
+    # 子を生むまでの複数世代の配合計画。親・祖父母の配合も遡って計画し、家系図全体を返す
+    # 各世代の配合の相性値に、1世代遡るごとに generation_weight を掛けた和が最大になる家系図を選ぶ
+    affinity_store = data_bundle.store
+    print("--- 家系図計画開始 ---")
+    child = data.get('child', None)
+    if not child:
+        return {"error": "家系図計画では子モンスターを指定してください。"}, 400
+    depth = int(data.get('depth', 2))
+    if not 1 <= depth <= PEDIGREE_MAX_DEPTH:
+        return {"error": f"計画する世代数は 1〜{PEDIGREE_MAX_DEPTH} で指定してください。"}, 400
+    weight = float(data.get('generation_weight', 1.0))
+    if not weight > 0:
+        return {"error": "generation_weight には正の値を指定してください。"}, 400
+
+    excluded_monsters = set(data.get('excluded_monsters', []))
+    fixed_bonus = request_fixed_bonus(data)
+    context.profile.set_branch('pedigree')
+    context.profile.lap('parse')
+
+    empty = {'depth': depth, 'score': None, 'pedigree': None}
+    fixed_parents = {slot: data.get(slot, None) for slot in ('parent1', 'parent2')}
+    codes = {slot: affinity_store.code(value) if value is not None else None for slot, value in fixed_parents.items()}
+    child_code = affinity_store.code(child)
+    if child_code is None or any(value is not None and codes[slot] is None for slot, value in fixed_parents.items()):
+        return empty, 200
+    excluded_codes = {affinity_store.code(bl) for bl in excluded_monsters if bl in affinity_store.codes}
+    if context.explain:
+        cached = cached_depth(affinity_store, excluded_codes, weight)
+        return plan_pedigree_tables(affinity_store.size, depth, cached, request_budget(data)), 200
+
+    try:
+        plan = plan_pedigree(
+            affinity_store, child_code, depth, excluded_codes, codes['parent1'], codes['parent2'],
+            fixed_bonus=fixed_bonus, weight=weight, context=context
+        )
+    except ExplorationCancelled:
+        # DP 表が揃うまでは家系図を組み立てられないので、暫定結果は無い
+        return interrupted_response(context, empty)
+
+    print("--- 家系図計画完了 ---")
+    if plan is None:
+        return empty, 200
+    score, pedigree = plan
+    return {'depth': depth, 'score': score, 'pedigree': pedigree}, 200
+
+### 結果キャッシュ ###
+# 同じ条件の探索は結果を使い回す。キーは結果に影響する項目だけを正規化したもの。
+# 固定ボーナスは合計値を一律にずらすだけなので、順位が変わらない探索ではキーに含めず、
+# 別のボーナスで計算した結果を差分だけずらして返す
+result_cache = ResultCache()
+
+def shift_best_affinity(results, delta):
+    return [{**result, 'best_affinity': result['best_affinity'] + delta} for result in results]
+
+def shift_multi_affinity(results, delta):
+    return [{
+        **result,
+        'min_guaranteed_affinity': result['min_guaranteed_affinity'] + delta,
+        'children_details': {
+            child_bl: {**details, 'affinity': details['affinity'] + delta}
+            for child_bl, details in result['children_details'].items()
+        }
+    } for result in results]
+
+def sampling_cache_key(data):
+    # 標本抽出の結果はシードと抽出の設定で決まる。シードの無い抽出はキャッシュしない (None を返す)
+    # "auto" では予算 (deadline_ms) によって標本抽出するかが変わるので、予算もキーに含める
+    sampling = request_sampling(data)
+    if sampling is None:
+        return ()
+    if sampling['seed'] is None:
+        return None
+    key = ('sampling',) + tuple(sorted(sampling.items()))
+    if request_sampling_mode(data) == 'auto':
+        key += ('auto', request_budget(data))
+    return key
+
+def explore_cache_key(data):
+    # (キー, 固定ボーナス, 補正関数) を返す。補正できない場合は固定ボーナスをキーに含める
+    # キーが None ならキャッシュしない
+    slots = tuple(data.get(slot, None) for slot in ['child'] + SLOT_NAMES)
+    excluded = tuple(sorted(set(data.get('excluded_monsters', [])))) + inventory_cache_key(data)
+    fixed_bonus = request_fixed_bonus(data)
+    child = data.get('child', None)
+    if None not in slots:
+        return ('explore', slots), fixed_bonus, shift_best_affinity
+    limit = int(data.get('limit', 50))
+    if child is None and data.get('child_category') is not None:
+        distinct_parents = bool(data.get('distinct_parents', False))
+        category = ('child_category', str(data['child_category']))
+        return ('explore', slots, excluded, limit, distinct_parents, category), fixed_bonus, shift_best_affinity
+    if child is None and None not in slots[1:]:
+        # 子のみ探索: 0 以下の合計値を None にするので、ボーナスが違えば結果も変わる
+        return ('explore', slots, excluded, fixed_bonus), fixed_bonus, None
+    if child is not None:
+        distinct_parents = bool(data.get('distinct_parents', False))
+        return ('explore', slots, excluded, limit, distinct_parents), fixed_bonus, shift_best_affinity
+    # サマリー: 判定は A + B + C >= 目標値 - 固定ボーナス なので、その差が同じなら結果も同じ
+    threshold = request_target_min(data) - fixed_bonus
+    sampling = sampling_cache_key(data)
+    if sampling is None:
+        return None, fixed_bonus, None
+    group_by_category = bool(data.get('group_by_category', False))
+    return ('explore', slots, excluded, limit, threshold, group_by_category) + sampling, fixed_bonus, None
+
+def explore_multi_cache_key(data):
+    slots = tuple(data.get(slot, None) for slot in SLOT_NAMES)
+    excluded = tuple(sorted(set(data.get('excluded_monsters', [])))) + inventory_cache_key(data)
+    children = tuple(sorted(data.get('selected_children', [])))
+    sampling = sampling_cache_key(data)
+    if sampling is None:
+        return None, request_fixed_bonus(data), None
+    if sampling:
+        # 標本抽出の結果は {"results", "sampling"} の形なので、ボーナスの補正はせずキーに含める
+        return ('explore_multi', slots, excluded, children, request_fixed_bonus(data)) + sampling, request_fixed_bonus(data), None
+    if data.get('pareto'):
+        # パレート解は子の順で children_details を並べ、件数も limit で変わる
+        children = tuple(data.get('selected_children', []))
+        limit = data.get('limit', None)
+        limit = int(limit) if limit is not None else None
+        return ('explore_multi', slots, excluded, children, 'pareto', limit), request_fixed_bonus(data), shift_multi_affinity
+    return ('explore_multi', slots, excluded, children), request_fixed_bonus(data), shift_multi_affinity
+
+def get_details_cache_key(data):
+    slots = tuple(data.get(slot, None) for slot in SLOT_NAMES)
+    fixed_bonus = request_fixed_bonus(data)
+    return ('get_details', slots, fixed_bonus), fixed_bonus, None
+
+def with_result_cache(runner, cache_key):
+    def run(data, context):
+        try:
+            key, fixed_bonus, shift = cache_key(data)
+        except (ValueError, TypeError, AttributeError):
+            # 正規化できないリクエストはキャッシュせず、そのまま実行してエラーを返す
+            return runner(data, context)
+        if key is None or context.explain:
+            return runner(data, context)
+        version = data_bundle.version
+        cached = result_cache.get(version, key, fixed_bonus, shift)
+        if cached is not None:
+            context.profile.set_branch('cache_hit')
+            return cached, 200
+        payload, status = runner(data, context)
+        if status == 200 and not context.is_cancelled():
+            result_cache.put(version, key, payload, fixed_bonus)
+        return payload, status
+    return run
+
+cached_explore = with_result_cache(run_explore, explore_cache_key)
+cached_explore_multi = with_result_cache(run_explore_multi, explore_multi_cache_key)
+cached_get_details = with_result_cache(run_get_details, get_details_cache_key)
+
+def run_legacy_exploration(mode, runner):
+    # 従来の同期 API: リクエストごとに中止フラグを持ち、request_id があれば /cancel_exploration で中止できる
+    # "stream": true の場合はジョブとして実行し、進捗と暫定結果をストリーミングで返す
+    data = request.json
+    if data.get('stream'):
+        try:
+            job = job_manager.submit(mode, data, deadline=request_deadline(data))
+        except JobQueueFull:
+            return jsonify({"error": "実行待ちの探索が多すぎます。しばらくしてから再度お試しください。"}), 503
+        return stream_job(job, cancel_on_disconnect=True)
+    request_id = data.get('request_id')
+    cancel_event = Event()
+    if request_id:
+        with running_explorations_lock:
+            running_explorations[request_id] = cancel_event
+    try:
+        context = SearchContext(cancel_event=cancel_event, profile=new_profile(mode), deadline=request_deadline(data))
+        payload, status = runner(data, context)
+    finally:
+        if request_id:
+            with running_explorations_lock:
+                # 同じ request_id で後から始まった探索の中止フラグは残す
+                if running_explorations.get(request_id) is cancel_event:
+                    del running_explorations[request_id]
+    return profiled_response(encoded_response(payload), status, context.profile)
+
+def accepts_msgpack():
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES and msgpack_available()
+
+def encoded_response(payload):
+    # Accept に application/msgpack があれば、血統をコードにしたコンパクト形式の msgpack で返す (既定は JSON)
+    if not accepts_msgpack():
+        response = jsonify(payload)
+    else:
+        response = Response(pack_compact(payload, data_bundle.store.codes), mimetype=MSGPACK_MIMETYPES[0])
+    response.vary.add('Accept')
+    return response
+
+def profiled_response(response, status, profile):
+    # 計測を記録し、X-Profile ヘッダー付きのリクエストには段階別の所要時間を返す
+    profile.lap('serialization')
+    profile.finish()
+    if request.headers.get('X-Profile') and profile.phases:
+        response.headers['Server-Timing'] = profile.server_timing()
+        response.headers['X-Profile-Branch'] = profile.branch or ''
+        response.headers['X-Profile-Counters'] = ', '.join(f"{name}={value}" for name, value in profile.counters.items())
+    return response, status
+
+def stream_job(job, cancel_on_disconnect=False):
+    # ジョブのフレームを NDJSON (既定)・Server-Sent Events・コンパクト形式の msgpack (フレームを連結して送る) で送る
+    use_sse = request.accept_mimetypes.best == 'text/event-stream'
+    use_msgpack = not use_sse and accepts_msgpack()
+    codes = data_bundle.store.codes
+
+    def generate():
+        finished = False
+        try:
+            for frame in job.frames():
+                if use_msgpack:
+                    yield pack_compact(frame, codes)
+                    continue
+                body = json.dumps(frame, ensure_ascii=False)
+                yield f"event: {frame['type']}\ndata: {body}\n\n" if use_sse else body + "\n"
+            finished = True
+        finally:
+            # 結果を受け取る前に接続が切れたら、その探索は中止する
+            if cancel_on_disconnect and not finished:
+                job_manager.cancel(job.job_id)
+
+    mimetype = 'text/event-stream' if use_sse else MSGPACK_MIMETYPES[0] if use_msgpack else 'application/x-ndjson'
+    response = Response(generate(), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Job-Id': job.job_id})
+    response.vary.add('Accept')
+    return response
+
+@app.route('/explore', methods=['POST'])
+def explore_combinations():
+    return run_legacy_exploration('explore', cached_explore)
+
+@app.route('/explore_multi', methods=['POST'])
+def explore_multi_combinations():
+    return run_legacy_exploration('explore_multi', cached_explore_multi)
+
+@app.route('/explore_all', methods=['POST'])
+def explore_all_lineages():
+    return run_legacy_exploration('explore_all', run_explore_all)
+
+@app.route('/plan_pedigree', methods=['POST'])
+def plan_pedigree_route():
+    return run_legacy_exploration('plan_pedigree', run_plan_pedigree)
+
+### 一括探索 ###
+# 複数のクエリを1回のリクエストで受け取り、固定スロット (親・祖父母) と除外モンスターが同じクエリを
+# まとめて実行する。グループ内では候補の列挙や相性表などの中間テーブルを1回だけ作って使い回す
+EXPLORATION_BATCH_MAX_QUERIES = int(os.environ.get('EXPLORATION_BATCH_MAX_QUERIES', 256))
+BATCH_RUNNERS = {
+    'explore': cached_explore,
+    'explore_multi': cached_explore_multi,
+    'get_details': cached_get_details,
+    'what_if': run_what_if,
+    'explore_all': run_explore_all,
+    'plan_pedigree': run_plan_pedigree,
+}
+
+def batch_group_key(query):
+    excluded = query.get('excluded_monsters') or []
+    if isinstance(excluded, list):
+        excluded = sorted(set(map(str, excluded)))
+    return json.dumps([query.get(slot) for slot in SLOT_NAMES] + [excluded], ensure_ascii=False, default=str)
+
+def run_explore_batch(data, context):
+    # 結果はクエリと同じ順で [{"status": ステータスコード, "result": レスポンス}] の形で返す
+    print("--- 一括探索開始 ---")
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return {"error": "queries に探索条件の配列を指定してください。"}, 400
+    if len(queries) > EXPLORATION_BATCH_MAX_QUERIES:
+        return {"error": f"一度に指定できる探索条件は {EXPLORATION_BATCH_MAX_QUERIES} 件までです。"}, 400
+
+    results = [None] * len(queries)
+    groups = {}
+    for position, query in enumerate(queries):
+        mode = query.get('mode', 'explore') if isinstance(query, dict) else None
+        if mode not in BATCH_RUNNERS:
+            results[position] = {'status': 400, 'result': {"error": f"不明な探索モードです: {mode}"}}
+            continue
+        groups.setdefault(batch_group_key(query), []).append(position)
+
+    completed = 0
+    for positions in groups.values():
+        # 中間テーブルはグループごとに作り、グループが終わったら捨てる
+        memo = {}
+        for position in positions:
+            query = queries[position]
+            try:
+                # クエリごとの deadline_ms と一括探索全体の期限のうち早い方で打ち切る
+                deadlines = [deadline for deadline in (context.deadline, request_deadline(query)) if deadline is not None]
+                query_context = SearchContext(cancel_event=context.cancel_event, profile=context.profile, memo=memo,
+                                              deadline=min(deadlines) if deadlines else None, explain=context.explain)
+                payload, status = BATCH_RUNNERS[query.get('mode', 'explore')](query, query_context)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                payload, status = {"error": f"探索条件が不正です: {e}"}, 400
+            results[position] = {'status': status, 'result': payload}
+            completed += 1
+            context.report_progress(queries_done=completed, queries_total=len(queries))
+            context.report_partial(lambda: list(results))
+            if context.is_cancelled():
+                # 実行していないクエリの結果は None のまま返す
+                return interrupted_response(context, results)
+
+    context.profile.set_branch('batch')
+    print(f"--- 一括探索完了 ({len(queries)} 件, {len(groups)} グループ) ---")
+    return results, 200
+
+@app.route('/explore_batch', methods=['POST'])
+def explore_batch():
+    return run_legacy_exploration('explore_batch', run_explore_batch)
+
+### 非同期ジョブ API ###
+# 探索をワーカープールで実行し、ジョブごとに進捗の取得・中止ができる
+EXPLORATION_RUNNERS = {
+    'explore': cached_explore,
+    'explore_multi': cached_explore_multi,
+    'explore_all': run_explore_all,
+    'plan_pedigree': run_plan_pedigree,
+    'explore_batch': run_explore_batch,
+}
+
+def pinned_runner(runner):
+    # ジョブのスレッドでも、探索の間は開始時のバージョンのデータを使い、そのバージョンをジョブの結果に残す
+    def run(data, context):
+        with data_bundle.pinned() as store:
+            context.data_version = store.version
+            return runner(data, context)
+    return run
+
+job_manager = JobManager({mode: pinned_runner(runner) for mode, runner in EXPLORATION_RUNNERS.items()})
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    data = request.json or {}
+    mode = data.get('mode', 'explore')
+    if mode not in EXPLORATION_RUNNERS:
+        return jsonify({"error": f"不明な探索モードです: {mode}"}), 400
+    try:
+        job = job_manager.submit(mode, data, deadline=request_deadline(data))
+    except JobQueueFull:
+        return jsonify({"error": "実行待ちの探索が多すぎます。しばらくしてから再度お試しください。"}), 503
+    return jsonify({"job_id": job.job_id, "status": job.status}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return encoded_response(job.to_dict())
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job_frames(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return stream_job(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job.to_dict())
+
+### 実行計画 ###
+@app.route('/explain', methods=['POST'])
+def explain():
+    # 探索と同じリクエスト (mode で探索の種類を指定) を受け取り、探索は実行せずに
+    # 各戦略の見積もりと選ばれる戦略を返す。探索せずに答えが決まる条件では plan は None
+    # 一括探索では、各クエリの実行計画を {"status", "result"} の配列で返す
+    data = request.json or {}
+    mode = data.get('mode', 'explore')
+    if mode not in EXPLORATION_RUNNERS:
+        return jsonify({"error": f"不明な探索モードです: {mode}"}), 400
+    context = SearchContext(profile=new_profile('explain'), explain=True)
+    started = time.perf_counter()
+    payload, status = EXPLORATION_RUNNERS[mode](data, context)
+    if status != 200:
+        return profiled_response(jsonify(payload), status, context.profile)
+    is_plan = mode == 'explore_batch' or (isinstance(payload, dict) and 'chosen' in payload)
+    return profiled_response(jsonify({
+        'mode': mode,
+        'plan': payload if is_plan else None,
+        'planning_ms': round((time.perf_counter() - started) * 1000, 3),
+        'calibration': feedback.stats(),
+    }), 200, context.profile)
+
+@app.route('/get_details', methods=['POST'])
+def get_details():
+    context = SearchContext(profile=new_profile('get_details'))
+    payload, status = cached_get_details(request.json, context)
+    return profiled_response(encoded_response(payload), status, context.profile)
+
+@app.route('/what_if', methods=['POST'])
+def what_if():
+    context = SearchContext(profile=new_profile('what_if'))
+    payload, status = run_what_if(request.json, context)
+    return profiled_response(encoded_response(payload), status, context.profile)
+
+### データの再読み込み ###
+# DATA_RELOAD_TOKEN を設定した場合は、同じ値の X-Admin-Token ヘッダーが必要
+DATA_RELOAD_TOKEN = os.environ.get('DATA_RELOAD_TOKEN')
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_data():
+    # 元ファイルが変わっていれば裏で相性ストアを再構築して差し替える (実行中の探索は古いバージョンのまま終わる)
+    if DATA_RELOAD_TOKEN and request.headers.get('X-Admin-Token') != DATA_RELOAD_TOKEN:
+        return jsonify({"error": "権限がありません"}), 403
+    started = data_bundle.reload_in_background()
+    return jsonify(dict(data_bundle.status(), started=started)), 202
+
+@app.route('/admin/data', methods=['GET'])
+def data_status():
+    return jsonify(data_bundle.status())
+
+### 計測 ###
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # リクエストの間は同じバージョンのデータを使う (途中で差し替えられても影響しない)
+    g.data_store = data_bundle.pin()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        registry.observe('http_request_duration_seconds', time.perf_counter() - started,
+                         endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    # クライアントやキャッシュがデータのバージョンをキーにできるよう、全てのレスポンスに付ける
+    store = g.get('data_store') or data_bundle.store
+    response.headers['X-Data-Version'] = store.version or ''
+    return compressed(response)
+
+def compressed(response):
+    # Accept-Encoding に gzip があれば、一定以上の大きさの本文を gzip で圧縮する (ストリーミングは除く)
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings.quality('gzip') > 0:
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip_body(body))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.teardown_request
+def release_data_store(exception=None):
+    data_bundle.unpin()
+
+def collect_runtime_gauges():
+    stats = result_cache.stats()
+    jobs = job_manager.status_counts()
+    gauges = [
+        ('result_cache_entries', {}, stats['entries']),
+        ('result_cache_bytes', {}, stats['bytes']),
+        ('result_cache_hits', {}, stats['hits']),
+        ('result_cache_shifted_hits', {}, stats['shifted_hits']),
+        ('result_cache_misses', {}, stats['misses']),
+        ('result_cache_evictions', {}, stats['evictions']),
+    ]
+    gauges.extend(('exploration_jobs', {'status': status}, count) for status, count in jobs.items())
+    gauges.append(('data_reloads', {}, data_bundle.reloads))
+    return gauges
+
+registry.register_gauges(collect_runtime_gauges)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
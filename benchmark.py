@@ -0,0 +1,240 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 合成データで各探索経路の所要時間・ピークメモリ・処理速度を測るベンチマーク
+#   python benchmark.py --bloodlines 10 20 32 --output benchmark_results.json
+#   python benchmark.py --baseline benchmark_baseline.json   (基準値と比較し、劣化があれば終了コード 1)
+# 血統数ごとに別プロセスで、合成テーブルの生成 → 相性ストアの構築 → アプリの起動 → 各シナリオ を実行する
+
+DEFAULT_BLOODLINES = [10, 20, 32]
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.2
+# これより小さい差は計測誤差として扱う (秒)
+DEFAULT_MIN_DELTA = 0.002
+DEFAULT_OUTPUT = 'benchmark_results.json'
+
+# 空きにするスロットの順番 (k 個空ける場合は先頭から k 個)
+OPEN_ORDER = ['grandma2', 'grandpa2', 'grandma1', 'grandpa1', 'parent2', 'parent1']
+
+
+def fixed_lineage(names):
+    return {
+        'parent1': names[0], 'grandpa1': names[2], 'grandma1': names[3],
+        'parent2': names[4], 'grandpa2': names[5], 'grandma2': names[6],
+    }
+
+
+def open_slots(names, count):
+    lineage = fixed_lineage(names)
+    for slot in OPEN_ORDER[:count]:
+        del lineage[slot]
+    return lineage
+
+
+def exclusions(names, count):
+    # 固定スロットに使う先頭の血統と重ならないよう、末尾から除外する
+    return names[len(names) - count:] if count else []
+
+
+def scenarios(names):
+    # (シナリオ名, エンドポイント, リクエスト, 空きスロット数, 除外数) の一覧
+    n = len(names)
+    child = names[1]
+    items = [
+        ('all_fixed', '/explore', {'child': child, **fixed_lineage(names)}, 0, 0),
+        ('child_only', '/explore', fixed_lineage(names), 0, 0),
+        ('get_details', '/get_details', fixed_lineage(names), 0, 0),
+    ]
+    for count in range(1, 7):
+        items.append((f'child_open{count}', '/explore', {'child': child, 'limit': 50, **open_slots(names, count)}, count, 0))
+    for count in range(1, 7):
+        items.append((f'summary_open{count}', '/explore', {'limit': 50, 'target_symbol': '◎', **open_slots(names, count)}, count, 0))
+    for excluded in sorted({n // 4, n // 2}):
+        items.append((f'child_open6_excl{excluded}', '/explore', {
+            'child': child, 'limit': 50, 'excluded_monsters': exclusions(names, excluded), **open_slots(names, 6)
+        }, 6, excluded))
+        items.append((f'summary_open4_excl{excluded}', '/explore', {
+            'limit': 50, 'target_symbol': '◎', 'excluded_monsters': exclusions(names, excluded), **open_slots(names, 4)
+        }, 4, excluded))
+    for children in (2, 4, 8, 16):
+        if children <= n:
+            items.append((f'multi_children{children}', '/explore_multi', {'selected_children': names[:children]}, 6, 0))
+    return items
+
+
+def _timed(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def _peak_memory(function):
+    # Python と numpy の確保量のピーク (tracemalloc で計測するので時間計測とは別に1回実行する)
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_worker(n, data_dir, repeat, seed, selected):
+    # 1つの血統数についての計測 (子プロセスで実行される)
+    # 結果キャッシュは無効にし、毎回探索を実行させる
+    os.environ['AFFINITY_STORE_PATH'] = os.path.join(data_dir, 'part_affinity_store.bin')
+    os.environ['RESULT_CACHE_MAX_BYTES'] = '0'
+    os.chdir(data_dir)
+
+    from synthetic_tables import synthetic_bloodlines, write_tables
+    from affinity_store import build_store, open_store
+
+    with contextlib.redirect_stdout(sys.stderr):
+        generate_seconds, paths = _timed(lambda: write_tables(data_dir, n, seed=seed))
+        build_seconds, _ = _timed(lambda: build_store(paths, os.environ['AFFINITY_STORE_PATH']))
+        open_seconds, _ = _timed(lambda: open_store(os.environ['AFFINITY_STORE_PATH']))
+        boot_seconds, app_module = _timed(lambda: __import__('app'))
+    client = app_module.app.test_client()
+
+    startup = {
+        'generate_seconds': generate_seconds,
+        'build_store_seconds': build_seconds,
+        'open_store_seconds': open_seconds,
+        'app_boot_seconds': boot_seconds,
+    }
+    names = synthetic_bloodlines(n)
+    devnull = open(os.devnull, 'w')
+    results = []
+    for name, endpoint, payload, open_count, excluded in scenarios(names):
+        if selected and not any(name.startswith(prefix) for prefix in selected):
+            continue
+        print(f"  N={n} {name} ...", file=sys.stderr)
+
+        def call():
+            with contextlib.redirect_stdout(devnull):
+                return client.post(endpoint, json=payload)
+
+        response = call()  # ウォームアップ (プロセスプールの起動などを計測から除く)
+        timings = [_timed(call)[0] for _ in range(repeat)]
+        median = statistics.median(timings)
+        # 探索空間の大きさ = 空きスロットの候補数の積
+        combinations = (n - excluded) ** open_count
+        results.append({
+            'bloodlines': n,
+            'scenario': name,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'results': len(response.get_json() or []),
+            'wall_seconds_min': min(timings),
+            'wall_seconds_median': median,
+            'peak_memory_bytes': _peak_memory(call),
+            'combinations': combinations,
+            'combinations_per_second': combinations / median if median > 0 else None,
+        })
+    return {'bloodlines': n, 'startup': startup, 'results': results}
+
+
+def run_benchmarks(bloodline_counts, repeat, seed, selected):
+    runs = []
+    for n in bloodline_counts:
+        print(f"--- N={n} のベンチマークを実行します ---", file=sys.stderr)
+        with tempfile.TemporaryDirectory(prefix=f'bench-n{n}-') as data_dir:
+            result_path = os.path.join(data_dir, 'result.json')
+            command = [
+                sys.executable, os.path.abspath(__file__), '--worker', str(n), '--data-dir', data_dir,
+                '--result-file', result_path, '--repeat', str(repeat), '--seed', str(seed),
+            ]
+            if selected:
+                command += ['--scenarios', *selected]
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+            subprocess.run(command, check=True, env=env)
+            with open(result_path, encoding='utf-8') as f:
+                runs.append(json.load(f))
+    import numpy as np
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat,
+            'seed': seed,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'runs': runs,
+    }
+
+
+def compare(current, baseline, tolerance, min_delta=DEFAULT_MIN_DELTA):
+    # 中央値が基準値より tolerance の割合以上、かつ min_delta 秒以上遅くなったシナリオを劣化として返す
+    def index(report):
+        table = {}
+        for run in report['runs']:
+            for name, seconds in run['startup'].items():
+                table[(run['bloodlines'], f'startup:{name}')] = seconds
+            for result in run['results']:
+                table[(run['bloodlines'], result['scenario'])] = result['wall_seconds_median']
+        return table
+
+    now, before = index(current), index(baseline)
+    regressions = []
+    print(f"{'N':>3} {'シナリオ':<32} {'基準(秒)':>10} {'今回(秒)':>10} {'比':>6}")
+    for key in sorted(set(now) & set(before)):
+        ratio = now[key] / before[key] if before[key] > 0 else float('inf')
+        mark = ''
+        delta = now[key] - before[key]
+        if ratio > 1 + tolerance and delta > min_delta:
+            mark = ' 劣化'
+            regressions.append({'bloodlines': key[0], 'scenario': key[1], 'baseline': before[key], 'current': now[key], 'ratio': ratio})
+        elif ratio < 1 - tolerance and -delta > min_delta:
+            mark = ' 改善'
+        print(f"{key[0]:>3} {key[1]:<32} {before[key]:>10.4f} {now[key]:>10.4f} {ratio:>6.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合成データによる探索エンドポイントのベンチマーク')
+    parser.add_argument('--bloodlines', type=int, nargs='+', default=DEFAULT_BLOODLINES, help='血統数 N (10〜60)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='各シナリオの計測回数')
+    parser.add_argument('--seed', type=int, default=0, help='合成データの乱数シード')
+    parser.add_argument('--scenarios', nargs='*', default=[], help='実行するシナリオ名の接頭辞 (省略時は全て)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='結果の JSON の出力先')
+    parser.add_argument('--baseline', help='比較する基準の結果 JSON')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='劣化とみなす遅延の割合')
+    parser.add_argument('--min-delta', type=float, default=DEFAULT_MIN_DELTA, help='劣化とみなす最小の差 (秒)')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        report = run_worker(args.worker, args.data_dir, args.repeat, args.seed, args.scenarios)
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False)
+        return 0
+
+    report = run_benchmarks(args.bloodlines, args.repeat, args.seed, args.scenarios)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"--- 結果を書き出しました: {args.output} ---", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"--- {len(regressions)} 件のシナリオで劣化を検出しました ---", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from affinity_store import DEFAULT_STORE_PATH, file_identity, load_or_build_store
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 元ファイルとスナップショットの更新を確認する間隔 (秒。0 なら自動では確認せず、/admin/reload でのみ再読み込みする)
+# 他のワーカーが再構築したスナップショットもこの確認で読み込む
+DATA_RELOAD_INTERVAL = float(os.environ.get('DATA_RELOAD_INTERVAL', 10))
+
+
+def _file_stat(path):
+    try:
+        return file_identity(path)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _build_lock(path):
+    # 同じスナップショットを複数のワーカーが同時に再構築しないよう、ロックファイルで排他する
+    # (後から来たワーカーは、先に再構築されたスナップショットをそのまま開く)
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DataBundle:
+    # 相性ストア (全テーブルと派生インデックス) の現在のバージョンを保持し、再構築したものと差し替える
+    # 差し替えは参照の付け替えだけで行い、探索中のスレッドは pin したバージョンを最後まで使う
+    def __init__(self, sources, path=DEFAULT_STORE_PATH):
+        self.sources = dict(sources)
+        self.path = path
+        self._local = threading.local()
+        self._reload_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._reloading = False
+        self._watcher = None
+        self.watch_interval = 0
+        self.reloads = 0
+        self.last_error = None
+        self.last_checked_at = None
+        source_stats = self._file_stats()
+        with _build_lock(path):
+            self._store = load_or_build_store(sources['affinity'], sources['c'], sources['monsters'], path=path)
+        self._loaded_stats = self._merge_snapshot_stat(source_stats)
+        self.loaded_at = time.time()
+
+    @property
+    def store(self):
+        # このスレッドで pin したストア (無ければ最新のストア)
+        pinned = getattr(self._local, 'store', None)
+        return pinned if pinned is not None else self._store
+
+    @property
+    def version(self):
+        return self.store.version
+
+    def pin(self):
+        # 以降このスレッドでは unpin まで同じストアを使う (リクエストの開始時に呼ぶ)
+        store = self._local.store = self._store
+        return store
+
+    def unpin(self):
+        self._local.store = None
+
+    @contextmanager
+    def pinned(self):
+        # with の間は同じストアを使う。既に pin されていればそれを引き継ぐ
+        previous = getattr(self._local, 'store', None)
+        store = self._local.store = previous if previous is not None else self._store
+        try:
+            yield store
+        finally:
+            self._local.store = previous
+
+    def _file_stats(self):
+        return {name: _file_stat(path) for name, path in self.sources.items()}
+
+    def _merge_snapshot_stat(self, stats):
+        return dict(stats, snapshot=_file_stat(self.path))
+
+    def _current_stats(self):
+        return self._merge_snapshot_stat(self._file_stats())
+
+    def reload(self):
+        # 元ファイルが変わっていればスナップショットを再構築し、バージョンが変わった場合だけ差し替える
+        # 失敗した場合は今のストアを使い続け、エラーを last_error に残す
+        # 戻り値は差し替えたかどうか
+        with self._reload_lock:
+            source_stats = self._file_stats()
+            try:
+                with _build_lock(self.path):
+                    store = load_or_build_store(
+                        self.sources['affinity'], self.sources['c'], self.sources['monsters'], path=self.path
+                    )
+            except Exception as e:
+                print(f"エラー: 相性ストアの再読み込みに失敗しました: {e}")
+                self.last_error = str(e)
+                self._loaded_stats = self._merge_snapshot_stat(source_stats)
+                return False
+            self._loaded_stats = self._merge_snapshot_stat(source_stats)
+            self.last_error = None
+            if store.version == self._store.version:
+                return False
+            previous = self._store.version
+            self._store = store
+            self.loaded_at = time.time()
+            self.reloads += 1
+            print(f"--- 相性ストアを差し替えました: {previous} -> {store.version} ---")
+            return True
+
+    def reload_in_background(self):
+        # 再読み込みを別スレッドで始める。既に実行中なら何もせず False を返す
+        with self._state_lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+
+        def run():
+            try:
+                self.reload()
+            finally:
+                with self._state_lock:
+                    self._reloading = False
+
+        threading.Thread(target=run, name='data-reload', daemon=True).start()
+        return True
+
+    def start_watcher(self, interval=DATA_RELOAD_INTERVAL):
+        # 元ファイルとスナップショットの (inode, サイズ, 更新時刻) を定期的に確認し、変わっていれば再読み込みする
+        # 書き込み途中のファイルを読まないよう、前回の確認から変化が止まってから再読み込みする
+        if interval <= 0 or self._watcher is not None:
+            return
+        self.watch_interval = interval
+
+        def watch():
+            previous = None
+            while True:
+                time.sleep(interval)
+                stats = self._current_stats()
+                self.last_checked_at = time.time()
+                if stats != self._loaded_stats and stats == previous:
+                    self.reload_in_background()
+                previous = stats
+
+        self._watcher = threading.Thread(target=watch, name='data-watcher', daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        store = self._store
+        with self._state_lock:
+            reloading = self._reloading
+        return {
+            'data_version': store.version,
+            'loaded_at': self.loaded_at,
+            'reloading': reloading,
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+            'last_checked_at': self.last_checked_at,
+            'watch_interval': self.watch_interval,
+            'stale': self._current_stats() != self._loaded_stats,
+        }
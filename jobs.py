@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import new_profile
+from search_engine import SearchContext
+
+# 同時に実行する探索の数と、終了したジョブの結果を保持する秒数
+JOB_WORKERS = int(os.environ.get('EXPLORATION_JOB_WORKERS', 4))
+JOB_RESULT_TTL = float(os.environ.get('EXPLORATION_JOB_TTL', 600))
+# 実行待ちを含めて受け付けるジョブの上限 (超えた分は 503 で断る)
+JOB_MAX_PENDING = int(os.environ.get('EXPLORATION_JOB_MAX_PENDING', 64))
+# ストリーミングで進捗フレームを送る間隔 (秒)
+JOB_STREAM_INTERVAL = float(os.environ.get('EXPLORATION_JOB_STREAM_INTERVAL', 0.5))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+ERROR = 'error'
+FINISHED_STATUSES = (DONE, CANCELLED, ERROR)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    # 1件の探索ジョブ。進捗と暫定結果は SearchContext 経由で探索スレッドから更新される
+    def __init__(self, mode, data, deadline=None):
+        self.job_id = uuid.uuid4().hex
+        self.mode = mode
+        self.data = data
+        # 期限 (time.monotonic() の値) は受け付けた時点から数える
+        self.context = SearchContext(deadline=deadline)
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def to_dict(self):
+        job = {
+            'job_id': self.job_id,
+            'mode': self.mode,
+            'status': self.status,
+            'progress': dict(self.context.progress),
+        }
+        if self.context.data_version is not None:
+            job['data_version'] = self.context.data_version
+        if self.status in (QUEUED, RUNNING, CANCELLED):
+            # 中止されたジョブでも、それまでに見つかった暫定結果は返す
+            job['partial_result'] = self.context.partial_result
+        if self.result is not None:
+            # 中止されたジョブでは、暫定結果に打ち切りの情報を付けたレスポンス
+            job['result'] = self.result
+        if self.error is not None:
+            job['error'] = self.error
+        return job
+
+    def frames(self, interval=JOB_STREAM_INTERVAL):
+        # 進捗・暫定結果・最終結果を順にフレームとして返す (ストリーミング用)
+        # 暫定結果は前回から変わったときだけ送り、最後に必ず終了フレームを1つ送る
+        last_partial = None
+        while not self.finished.wait(interval):
+            yield {'type': 'progress', 'status': self.status, 'progress': dict(self.context.progress)}
+            partial = self.context.partial_result
+            if partial is not None and partial != last_partial:
+                last_partial = partial
+                yield {'type': 'partial', 'results': partial}
+
+        if self.status == DONE:
+            yield {'type': 'result', 'results': self.result, 'data_version': self.context.data_version}
+        elif self.status == CANCELLED:
+            yield {'type': 'cancelled', 'results': self.context.partial_result, 'result': self.result,
+                   'data_version': self.context.data_version}
+        else:
+            yield {'type': 'error', 'error': self.error}
+
+
+class JobManager:
+    # 探索ジョブを上限付きのスレッドプールで実行し、結果を一定時間保持する
+    # runners は モード名 -> runner(data, context) で、(レスポンス, ステータスコード) を返す関数
+    def __init__(self, runners, max_workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL, max_pending=JOB_MAX_PENDING):
+        self.runners = runners
+        self.result_ttl = result_ttl
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='exploration-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, mode, data, deadline=None):
+        job = Job(mode, data, deadline)
+        with self._lock:
+            self._expire_locked()
+            pending = sum(1 for other in self._jobs.values() if other.status not in FINISHED_STATUSES)
+            if pending >= self.max_pending:
+                raise JobQueueFull()
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire_locked()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.context.cancel()
+        with self._lock:
+            # まだ実行されていないジョブはその場で中止扱いにする
+            if job.status == QUEUED:
+                self._finish_locked(job, CANCELLED)
+        return job
+
+    def _run(self, job):
+        with self._lock:
+            if job.status != QUEUED:
+                return
+            job.status = RUNNING
+        job.context.profile = new_profile(job.mode)
+        try:
+            payload, status = self.runners[job.mode](job.data, job.context)
+            job.context.profile.finish()
+        except Exception as e:
+            print(f"エラー: ジョブ {job.job_id} の実行に失敗しました: {e}")
+            with self._lock:
+                job.error = str(e)
+                self._finish_locked(job, ERROR)
+            return
+
+        with self._lock:
+            # 期限切れで打ち切った探索は暫定結果を返して完了とし、利用者による中止だけを中止扱いにする
+            if job.context.stop_reason() == 'cancelled':
+                job.result = payload if status < 400 else None
+                self._finish_locked(job, CANCELLED)
+            elif status >= 400:
+                job.error = payload.get('error') if isinstance(payload, dict) else None
+                self._finish_locked(job, ERROR)
+            else:
+                job.result = payload
+                self._finish_locked(job, DONE)
+
+    def status_counts(self):
+        with self._lock:
+            counts = {status: 0 for status in (QUEUED, RUNNING, DONE, CANCELLED, ERROR)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def _finish_locked(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+        job.finished.set()
+
+    def _expire_locked(self):
+        # 保持期間を過ぎた終了済みジョブを破棄する
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
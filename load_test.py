@@ -0,0 +1,476 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# 複数の利用者が同時に探索する状況を再現する負荷試験
+#   python load_test.py --users 8 --duration 30                       (Flask のテストクライアントに対して実行)
+#   python load_test.py --url http://127.0.0.1:8000 --users 16        (起動済みのサーバーに対して実行)
+#   python load_test.py --gunicorn --workers 2 --threads 4 --users 16 (gunicorn をローカルに起動して実行)
+#   python load_test.py --replay request_log.jsonl --speed 2          (記録したリクエストを再生)
+# エンドポイント・分岐ごとのスループット、p50/p95/p99 の待ち時間、エラー率と、
+# 他の利用者のリクエストによる影響 (/cancel_exploration による巻き添えの中止、単独実行と比べた遅延) を報告する
+# /cancel_exploration は誰も使っていない request_id を送るので、中止が他の探索に漏れていなければ巻き添えは 0 になる
+
+DEFAULT_USERS = 4
+DEFAULT_DURATION = 20.0
+DEFAULT_THINK_MS = 200.0
+DEFAULT_SOLO_REPEAT = 3
+DEFAULT_OUTPUT = 'load_test_results.json'
+DEFAULT_TIMEOUT = 120.0
+PERCENTILES = (50, 95, 99)
+
+# シナリオ名 -> 既定の重み
+DEFAULT_MIX = {
+    'explore_child': 30,
+    'explore_summary': 25,
+    'explore_summary_heavy': 5,
+    'explore_multi': 15,
+    'get_details': 22,
+    'cancel_exploration': 3,
+}
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LINEAGE_SLOTS = ['parent1', 'grandpa1', 'grandma1', 'parent2', 'grandpa2', 'grandma2']
+
+
+def _lineage(rng, names, open_count):
+    # 6スロットのうち open_count 個を空けた血統
+    lineage = {slot: rng.choice(names) for slot in LINEAGE_SLOTS}
+    for slot in rng.sample(LINEAGE_SLOTS, open_count):
+        del lineage[slot]
+    return lineage
+
+
+def make_request(scenario, rng, names):
+    # シナリオからリクエスト (メソッド, パス, 本文) を作る。血統はランダムに選び、結果キャッシュが当たりすぎないようにする
+    if scenario == 'explore_child':
+        return 'POST', '/explore', {'child': rng.choice(names), 'limit': 10, **_lineage(rng, names, rng.randint(2, 6))}
+    if scenario == 'explore_summary':
+        return 'POST', '/explore', {'limit': 10, 'target_symbol': '◎', **_lineage(rng, names, rng.randint(1, 3))}
+    if scenario == 'explore_summary_heavy':
+        return 'POST', '/explore', {'limit': 10, 'target_symbol': '◎', **_lineage(rng, names, 4)}
+    if scenario == 'explore_multi':
+        children = rng.sample(names, rng.randint(2, 4))
+        return 'POST', '/explore_multi', {'selected_children': children, **_lineage(rng, names, 3)}
+    if scenario == 'get_details':
+        return 'POST', '/get_details', _lineage(rng, names, 0)
+    if scenario == 'cancel_exploration':
+        return 'POST', '/cancel_exploration', {'request_id': f'load-test-{rng.getrandbits(32):08x}'}
+    raise ValueError(f"不明なシナリオです: {scenario}")
+
+
+class ClientTarget:
+    # Flask のテストクライアント (同じプロセス内のスレッドで実行するので、GIL の競合も含めて計測できる)
+    # アプリの print は計測中ずっと捨てる (リクエストごとに標準出力を差し替えるとスレッド間で競合する)
+    def __init__(self, disable_cache=False):
+        if disable_cache:
+            os.environ['RESULT_CACHE_MAX_BYTES'] = '0'
+        # アプリは相性テーブルを作業ディレクトリからの相対パスで読む
+        os.chdir(APP_DIR)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app
+        self.app = app.app
+        self._local = threading.local()
+        self.description = 'flask-test-client'
+
+    def request(self, method, path, body, headers):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, dict(response.headers), response.get_data()
+
+
+class HttpTarget:
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.description = self.url
+
+    def request(self, method, path, body, headers):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers=dict(headers))
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, dict(response.headers), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read()
+
+
+@contextlib.contextmanager
+def gunicorn_server(workers, threads, env=None):
+    # 空いているポートで gunicorn を起動し、応答するようになるまで待つ
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [
+        sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+        '--bind', f'127.0.0.1:{port}', '--timeout', str(int(DEFAULT_TIMEOUT)), 'app:app',
+    ]
+    process = subprocess.Popen(command, cwd=APP_DIR,
+                               env=dict(os.environ, **(env or {})), stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 120
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"gunicorn が終了しました (終了コード {process.returncode})")
+            try:
+                urllib.request.urlopen(url + '/reference', timeout=1).read()
+                break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                if time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn の起動を待てませんでした")
+                time.sleep(0.2)
+        yield url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class Recorder:
+    # 1件ごとの結果を集める (複数のスレッドから呼ばれる)
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+
+
+def send(target, user, scenario, method, path, body, started_at, recorder):
+    # 1件送り、待ち時間・ステータス・分岐・中止されたかを記録する
+    sent = time.perf_counter()
+    sample = {
+        'user': user, 'scenario': scenario, 'method': method, 'path': path, 'body': body,
+        'offset': sent - started_at, 'status': None, 'branch': None, 'interrupted': None, 'error': None,
+    }
+    try:
+        status, headers, payload = target.request(method, path, body, {'X-Profile': '1'})
+        sample['status'] = status
+        sample['branch'] = headers.get('X-Profile-Branch') or None
+        sample['data_version'] = headers.get('X-Data-Version')
+        if payload[:1] == b'{':
+            try:
+                interrupted = json.loads(payload).get('interrupted')
+            except ValueError:
+                interrupted = None
+            if interrupted:
+                sample['interrupted'] = interrupted.get('reason')
+    except Exception as e:
+        sample['error'] = f"{type(e).__name__}: {e}"
+    sample['latency'] = time.perf_counter() - sent
+    recorder.add(sample)
+    return sample
+
+
+def run_mix(target, names, users, duration, requests_per_user, mix, think_ms, seed, recorder):
+    # users 人の利用者がそれぞれ重み付きでシナリオを選び、考える時間 (指数分布) を挟みながら送り続ける
+    scenarios, weights = zip(*[(name, weight) for name, weight in mix.items() if weight > 0])
+    started_at = time.perf_counter()
+    stop_at = started_at + duration if duration else None
+
+    def user_loop(user):
+        rng = random.Random(seed * 1000 + user)
+        count = 0
+        while (stop_at is None or time.perf_counter() < stop_at) and (not requests_per_user or count < requests_per_user):
+            scenario = rng.choices(scenarios, weights)[0]
+            method, path, body = make_request(scenario, rng, names)
+            send(target, user, scenario, method, path, body, started_at, recorder)
+            count += 1
+            if think_ms > 0:
+                time.sleep(rng.expovariate(1000.0 / think_ms))
+
+    _run_users(users, user_loop)
+    return time.perf_counter() - started_at
+
+
+def load_log(path):
+    # 記録したリクエストログ (1行1件の JSON: path, method, json, 任意で offset 秒) を読む
+    # パスの無い行 (他の形式のログ) は数えて読み飛ばす
+    entries, skipped = [], 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            path_value = record.get('path') or record.get('endpoint') if isinstance(record, dict) else None
+            if not isinstance(path_value, str) or not path_value.startswith('/'):
+                skipped += 1
+                continue
+            body = record.get('json', record.get('body'))
+            entries.append({
+                'method': record.get('method', 'POST' if body is not None else 'GET'),
+                'path': path_value,
+                'body': body if isinstance(body, (dict, list)) else None,
+                'offset': record.get('offset'),
+                'scenario': record.get('scenario') or path_value,
+            })
+    if any(entry['offset'] is not None for entry in entries):
+        entries.sort(key=lambda entry: entry['offset'] if entry['offset'] is not None else 0.0)
+    return entries, skipped
+
+
+def run_replay(target, entries, users, speed, recorder):
+    # 記録の順に users 本のスレッドで送る。speed > 0 で offset があれば、記録時の間隔を speed 倍速で再現する
+    started_at = time.perf_counter()
+    position = [0]
+    lock = threading.Lock()
+
+    def user_loop(user):
+        while True:
+            with lock:
+                if position[0] >= len(entries):
+                    return
+                entry = entries[position[0]]
+                position[0] += 1
+            if speed > 0 and entry['offset'] is not None:
+                wait = started_at + entry['offset'] / speed - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            send(target, user, entry['scenario'], entry['method'], entry['path'], entry['body'], started_at, recorder)
+
+    _run_users(users, user_loop)
+    return time.perf_counter() - started_at
+
+
+def _run_users(users, user_loop):
+    threads = [threading.Thread(target=user_loop, args=(user,), name=f'load-user-{user}') for user in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def solo_requests(mix, names, repeat, seed):
+    # 単独実行の基準に使うリクエスト (負荷をかける前に送るので、負荷をかけるときとは別の乱数で作る)
+    rng = random.Random(-1 - seed)
+    return [(scenario,) + make_request(scenario, rng, names)
+            for scenario, weight in mix.items() if weight > 0 for _ in range(repeat)]
+
+
+def run_solo(target, requests, repeat):
+    # 負荷をかけていない状態の待ち時間 (シナリオごとの中央値)。requests は (シナリオ, メソッド, パス, 本文) で、1件ずつ順に送る
+    # 結果キャッシュに当たったものは比べられないので除く
+    recorder = Recorder()
+    counts = {}
+    started_at = time.perf_counter()
+    for scenario, method, path, body in requests:
+        if path == '/cancel_exploration' or counts.get(scenario, 0) >= repeat:
+            continue
+        counts[scenario] = counts.get(scenario, 0) + 1
+        send(target, 0, scenario, method, path, body, started_at, recorder)
+    latencies = {}
+    for sample in recorder.samples:
+        if _ok(sample) and sample['branch'] != 'cache_hit':
+            latencies.setdefault(sample['scenario'], []).append(sample['latency'])
+    return {scenario: _percentile(sorted(values), 50) for scenario, values in latencies.items()}
+
+
+def _ok(sample):
+    return sample['error'] is None and sample['status'] is not None and sample['status'] < 400
+
+
+def _percentile(values, q):
+    # 最近接順位法 (values は昇順)
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s['latency'] for s in samples)
+    errors = sum(1 for s in samples if not _ok(s))
+    summary = {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': errors / len(samples) if samples else 0.0,
+        'throughput': len(samples) / elapsed if elapsed > 0 else None,
+        'max': latencies[-1] if latencies else None,
+    }
+    for q in PERCENTILES:
+        summary[f'p{q}'] = _percentile(latencies, q)
+    return summary
+
+
+def _grouped(samples, key, elapsed):
+    groups = {}
+    for sample in samples:
+        groups.setdefault(key(sample), []).append(sample)
+    return {name: summarize(items, elapsed) for name, items in sorted(groups.items())}
+
+
+def build_report(samples, elapsed, solo, meta):
+    cancels = [s for s in samples if s['path'] == '/cancel_exploration']
+    # 利用者は自分の探索を中止しないので、中止された探索は全て他の利用者の /cancel_exploration の巻き添え (本来は 0)
+    collateral = [s for s in samples if s['interrupted'] == 'cancelled']
+    scenarios = _grouped(samples, lambda s: s['scenario'], elapsed)
+    for name, stats in scenarios.items():
+        base = solo.get(name)
+        stats['solo_p50'] = base
+        stats['slowdown_p50'] = stats['p50'] / base if base and stats['p50'] is not None else None
+    searches = [s for s in samples if s['path'] in ('/explore', '/explore_multi')]
+    return {
+        'meta': meta,
+        'total': summarize(samples, elapsed),
+        'elapsed_seconds': elapsed,
+        'endpoints': _grouped(samples, lambda s: s['path'], elapsed),
+        'branches': _grouped(samples, lambda s: f"{s['path']} {s['branch'] or '-'}", elapsed),
+        'scenarios': scenarios,
+        'interference': {
+            'cancel_requests': len(cancels),
+            'cancelled_by_other_users': len(collateral),
+            'cancelled_search_ratio': len(collateral) / len(searches) if searches else 0.0,
+            'deadline_interrupted': sum(1 for s in samples if s['interrupted'] == 'deadline'),
+            'data_versions': sorted({s.get('data_version') for s in samples if s.get('data_version')}),
+        },
+        'errors': sorted({s['error'] or f"HTTP {s['status']}" for s in samples if not _ok(s)})[:20],
+    }
+
+
+def print_report(report):
+    def ms(value):
+        return f"{value * 1000:>9.1f}" if value is not None else f"{'-':>9}"
+
+    total = report['total']
+    print(f"--- {total['requests']} 件 / {report['elapsed_seconds']:.1f} 秒 "
+          f"({total['throughput']:.1f} 件/秒, エラー率 {total['error_rate']:.1%}) ---")
+    for title, table in (('エンドポイント', report['endpoints']), ('分岐', report['branches']), ('シナリオ', report['scenarios'])):
+        print(f"{title:<36} {'件数':>6} {'件/秒':>7} {'エラー率':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'単独比':>6}")
+        for name, stats in table.items():
+            slowdown = stats.get('slowdown_p50')
+            slowdown = f"{slowdown:>6.2f}" if slowdown is not None else f"{'-':>6}"
+            print(f"{name:<40} {stats['requests']:>6} {stats['throughput']:>7.2f} {stats['error_rate']:>9.1%} "
+                  f"{ms(stats['p50'])} {ms(stats['p95'])} {ms(stats['p99'])} {slowdown}")
+    interference = report['interference']
+    print(f"--- /cancel_exploration {interference['cancel_requests']} 件で、他の利用者の探索 "
+          f"{interference['cancelled_by_other_users']} 件 ({interference['cancelled_search_ratio']:.1%}) が中止されました ---")
+    for error in report['errors']:
+        print(f"  エラー: {error}")
+
+
+def write_log(path, samples):
+    # 送ったリクエストを --replay で再生できる形式で書き出す
+    with open(path, 'w', encoding='utf-8') as f:
+        for sample in sorted(samples, key=lambda s: s['offset']):
+            f.write(json.dumps({
+                'offset': round(sample['offset'], 4), 'method': sample['method'], 'path': sample['path'],
+                'json': sample['body'], 'scenario': sample['scenario'],
+            }, ensure_ascii=False) + '\n')
+
+
+def parse_mix(items):
+    mix = dict(DEFAULT_MIX)
+    for item in items:
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f"不明なシナリオです: {name} ({', '.join(DEFAULT_MIX)})")
+        mix[name] = float(weight)
+    return mix
+
+
+def run(args, target):
+    status, _, body = target.request('GET', '/reference', None, {})
+    if status != 200:
+        raise SystemExit(f"/reference を取得できませんでした (HTTP {status})")
+    names = json.loads(body)['bloodlines']
+
+    recorder = Recorder()
+    solo = {}
+    if args.replay:
+        entries, skipped = load_log(args.replay)
+        print(f"--- {len(entries)} 件のリクエストを再生します (読み飛ばした行 {skipped}) ---", file=sys.stderr)
+        elapsed = run_replay(target, entries, args.users, args.speed, recorder)
+        if args.solo_repeat > 0:
+            # 再生したリクエストを送り直して基準にする (結果キャッシュが有効なら、当たったものは除かれる)
+            solo = run_solo(target, [(e['scenario'], e['method'], e['path'], e['body']) for e in entries], args.solo_repeat)
+    else:
+        mix = parse_mix(args.mix)
+        if args.solo_repeat > 0:
+            print(f"--- 単独実行の基準を計測します ---", file=sys.stderr)
+            solo = run_solo(target, solo_requests(mix, names, args.solo_repeat, args.seed), args.solo_repeat)
+        print(f"--- {args.users} 人で {args.duration or '-'} 秒間の負荷をかけます ({target.description}) ---", file=sys.stderr)
+        elapsed = run_mix(target, names, args.users, args.duration, args.requests, mix, args.think_ms, args.seed, recorder)
+    samples = recorder.samples
+    meta = {
+        'target': target.description,
+        'users': args.users,
+        'duration': args.duration,
+        'think_ms': args.think_ms,
+        'seed': args.seed,
+        'replay': args.replay,
+        'cpu_count': os.cpu_count(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    report = build_report(samples, elapsed, solo, meta)
+    if args.record:
+        write_log(args.record, samples)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='探索 API の同時アクセスの負荷試験')
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS, help='同時に操作する利用者の数')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='負荷をかける秒数 (0 なら --requests で止める)')
+    parser.add_argument('--requests', type=int, default=0, help='利用者1人あたりのリクエスト数 (0 なら無制限)')
+    parser.add_argument('--think-ms', type=float, default=DEFAULT_THINK_MS, help='リクエストの間隔の平均 (ミリ秒)')
+    parser.add_argument('--mix', nargs='*', default=[], help='シナリオの重み (例: explore_multi=30 cancel_exploration=0)')
+    parser.add_argument('--seed', type=int, default=0, help='リクエストを作る乱数のシード')
+    parser.add_argument('--url', help='起動済みのサーバーの URL (省略時は Flask のテストクライアント)')
+    parser.add_argument('--gunicorn', action='store_true', help='gunicorn をローカルに起動して計測する')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn のワーカー数')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn のワーカーあたりのスレッド数')
+    parser.add_argument('--disable-result-cache', action='store_true', help='結果キャッシュを無効にする (テストクライアント・gunicorn)')
+    parser.add_argument('--replay', help='再生するリクエストログ (JSON Lines)')
+    parser.add_argument('--speed', type=float, default=0.0, help='再生の速度 (記録の offset を使う倍率。0 なら待たずに送る)')
+    parser.add_argument('--record', help='送ったリクエストを再生用のログとして書き出す')
+    parser.add_argument('--solo-repeat', type=int, default=DEFAULT_SOLO_REPEAT, help='単独実行の基準を測る件数 (シナリオごと。0 で省略)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='結果の JSON の出力先')
+    args = parser.parse_args()
+    for name in ('replay', 'record', 'output'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    if args.gunicorn:
+        env = {'RESULT_CACHE_MAX_BYTES': '0'} if args.disable_result_cache else {}
+        with gunicorn_server(args.workers, args.threads, env) as url:
+            report = run(args, HttpTarget(url))
+    elif args.url:
+        report = run(args, HttpTarget(args.url))
+    else:
+        target = ClientTarget(args.disable_result_cache)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            report = run(args, target)
+
+    print_report(report)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"--- 結果を書き出しました: {args.output} ---", file=sys.stderr)
+    return 1 if report['total']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
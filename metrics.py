@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+# 計測の有効・無効 (無効にすると計測用の呼び出しは何もしない)
+INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED', '1') != '0'
+# レイテンシのヒストグラムの区切り (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    body = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+    return '{' + body + '}'
+
+
+class MetricsRegistry:
+    # カウンタとヒストグラムを保持し、Prometheus のテキスト形式で出力する
+    def __init__(self, enabled=INSTRUMENTATION_ENABLED, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def register_gauges(self, collect):
+        # collect() は [(名前, ラベルの辞書, 値)] を返す関数。出力のたびに呼ばれる
+        self._gauges.append(collect)
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for collect in self._gauges:
+            for name, labels, value in collect():
+                header(name, 'gauge')
+                lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+registry.describe('exploration_duration_seconds', '探索1回あたりの所要時間 (エンドポイント・分岐別)')
+registry.describe('exploration_phase_seconds', '探索の各段階の所要時間')
+registry.describe('exploration_combinations_total', '評価・枝刈りした組み合わせの数')
+registry.describe('http_request_duration_seconds', 'HTTP リクエストの処理時間')
+
+
+class RequestProfile:
+    # 1回の探索の段階別タイマーとカウンタ
+    # lap(段階名) は前回の lap (または開始) からの経過時間をその段階に加算する
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.branch = None
+        self.phases = {}
+        self.counters = {}
+        self._started = self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._last)
+        self._last = now
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_branch(self, branch):
+        self.branch = branch
+
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+    def finish(self):
+        # レジストリに記録する (探索の終了時に1回だけ呼ぶ)
+        branch = self.branch or 'none'
+        registry.observe('exploration_duration_seconds', self.elapsed(), endpoint=self.endpoint, branch=branch)
+        for phase, seconds in self.phases.items():
+            registry.observe('exploration_phase_seconds', seconds, endpoint=self.endpoint, branch=branch, phase=phase)
+        for name, value in self.counters.items():
+            registry.inc('exploration_combinations_total', value, endpoint=self.endpoint, branch=branch, kind=name)
+
+    def server_timing(self):
+        # Server-Timing ヘッダーの値 (ミリ秒)
+        entries = [f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in self.phases.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.3f}")
+        return ', '.join(entries)
+
+
+class _NullProfile:
+    # 計測無効時の代わり。全ての呼び出しが何もしない
+    endpoint = None
+    branch = None
+    phases = {}
+    counters = {}
+
+    def lap(self, phase):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def set_branch(self, branch):
+        pass
+
+    def finish(self):
+        pass
+
+    def server_timing(self):
+        return ''
+
+
+NULL_PROFILE = _NullProfile()
+
+
+def new_profile(endpoint):
+    return RequestProfile(endpoint) if registry.enabled else NULL_PROFILE
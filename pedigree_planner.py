@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from search_engine import _profile, _raise_if_cancelled
+
+# 多世代の血統計画
+# 子 b を親 x, y から生む配合の相性値は A(x, 祖父母①, b) + A(y, 祖父母②, b) + C(x, y) + ボーナス で、
+# 祖父母①は x 自身の親でもある。x も配合で生むなら、その相性値は x の親 (=祖父母①) と
+# さらにその親で決まる。目的関数 (計画内の全ての配合の相性値の重み付き和) は親の側ごとに分かれるので、
+#   H_1[x, b] = max_{xa, xb} A(x, xa, xb, b)
+#   H_d[x, b] = max_{xa, xb} A(x, xa, xb, b) + w * (C(xa, xb) + H_{d-1}[xa, x] + H_{d-1}[xb, x])
+# を深さ順に求めれば、血統の組み合わせを列挙せずに最適な家系図が得られる (w は1世代遡るごとの重み)。
+# H は (除外モンスター, 重み) ごとに共有でき、深さ d の表は深さ d-1 の表から作る。
+
+# 計画できる世代数の上限 (深さ k の家系図の末端は 2^(k+1) 体)
+PEDIGREE_MAX_DEPTH = int(os.environ.get('PEDIGREE_MAX_DEPTH', 4))
+# 保持する DP 表の組 (除外モンスター・重み・データのバージョンごと) の数
+PEDIGREE_TABLE_CACHE_SIZE = int(os.environ.get('PEDIGREE_TABLE_CACHE_SIZE', 8))
+
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def _level(affinity, c_matrix, allowed, previous, weight, context):
+    # previous (深さ d-1 の H) から深さ d の (H, 最良の親の組の番号) を求める
+    # previous が None なら深さ 1 (親の配合は計画しない)
+    n = affinity.shape[0]
+    values = np.full((n, n), -np.inf)
+    choices = np.full((n, n), -1, dtype=np.int64)
+    blocked = ~(allowed[:, None] & allowed[None, :])
+    if previous is not None:
+        pair_base = np.where(np.isnan(c_matrix) | blocked, -np.inf, c_matrix)
+    for x in range(n):
+        _raise_if_cancelled(context)
+        # scores[xa, xb, b]: x を xa, xb から生み、x を b の親として使う場合の値
+        scores = np.where(np.isnan(affinity[x]), -np.inf, affinity[x])
+        if previous is None:
+            scores = np.where(blocked[:, :, None], -np.inf, scores)
+        else:
+            ancestry = pair_base + previous[:, x][:, None] + previous[:, x][None, :]
+            scores = scores + weight * ancestry[:, :, None]
+        flat = scores.reshape(n * n, n)
+        best = flat.argmax(axis=0)
+        values[x] = flat[best, np.arange(n)]
+        choices[x] = np.where(np.isfinite(values[x]), best, -1)
+    return values, choices
+
+
+def _table_key(store, excluded_codes, weight):
+    return (store.version, tuple(sorted(excluded_codes)), float(weight))
+
+
+def cached_depth(store, excluded_codes, weight=1.0):
+    # 同じ条件で計算済みの DP 表の深さ (実行計画の見積もり用)
+    with _tables_lock:
+        levels = _tables.get(_table_key(store, excluded_codes, weight))
+    return len(levels) if levels is not None else 0
+
+
+def pedigree_tables(store, excluded_codes, depth, weight=1.0, context=None):
+    # 深さ 1〜depth の (H, 最良の親の組) の一覧。同じ条件の表は使い回し、足りない深さだけ計算する
+    key = _table_key(store, excluded_codes, weight)
+    with _tables_lock:
+        levels = _tables.get(key)
+        if levels is not None:
+            _tables.move_to_end(key)
+            levels = list(levels)
+    if levels is None:
+        levels = []
+    if len(levels) >= depth:
+        return levels[:depth]
+
+    affinity = np.asarray(store.affinity)
+    allowed = np.ones(store.size, dtype=bool)
+    allowed[list(excluded_codes)] = False
+    while len(levels) < depth:
+        previous = levels[-1][0] if levels else None
+        levels.append(_level(affinity, store.c_matrix, allowed, previous, weight, context))
+    _profile(context).lap('lookup')
+
+    with _tables_lock:
+        cached = _tables.get(key)
+        if cached is None or len(cached) < len(levels):
+            _tables[key] = levels
+        _tables.move_to_end(key)
+        while len(_tables) > PEDIGREE_TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return levels
+
+
+def plan_pedigree(store, child, depth, excluded_codes=frozenset(), parent1=None, parent2=None,
+                  fixed_bonus=0.0, weight=1.0, context=None):
+    # 子 child を生むまでの depth 世代分の家系図のうち、重み付きの相性値の和が最大のものを返す
+    # 戻り値は (スコア, 家系図)。成立する家系図が無ければ None
+    # 家系図のノードは {'bloodline', 'affinity' (その配合の相性値。配合を計画したノードのみ), 'parents'}
+    levels = pedigree_tables(store, excluded_codes, depth, weight, context)
+    values, _ = levels[depth - 1]
+    n = store.size
+    child_values = values[:, child]
+
+    allowed = np.ones(n, dtype=bool)
+    allowed[list(excluded_codes)] = False
+    root = np.where(np.isnan(store.c_matrix), -np.inf, store.c_matrix)
+    root = root + child_values[:, None] + child_values[None, :]
+    root[~(allowed[:, None] & allowed[None, :])] = -np.inf
+    if parent1 is not None:
+        root[np.arange(n) != parent1, :] = -np.inf
+    if parent2 is not None:
+        root[:, np.arange(n) != parent2] = -np.inf
+    best = int(root.argmax())
+    if not np.isfinite(root.flat[best]):
+        return None
+    p1, p2 = divmod(best, n)
+
+    def build(x, b, d):
+        # b の親として使う x のノード (d は x から遡って計画する世代数)
+        xa, xb = divmod(int(levels[d - 1][1][x, b]), n)
+        if d == 1:
+            return {'bloodline': store.bloodlines[x], 'parents': [{'bloodline': store.bloodlines[xa]}, {'bloodline': store.bloodlines[xb]}]}
+        parents = [build(xa, x, d - 1), build(xb, x, d - 1)]
+        return _bred_node(store, x, xa, xb, parents, fixed_bonus)
+
+    tree = _bred_node(store, child, p1, p2, [build(p1, child, depth), build(p2, child, depth)], fixed_bonus)
+    _profile(context).lap('aggregation')
+    return _weighted_score(tree, weight), tree
+
+
+def _bred_node(store, x, xa, xb, parents, fixed_bonus):
+    # x を xa, xb から生む配合のノード。相性値は親ノードが持つ x の祖父母から計算する
+    codes = [[store.code(grand['bloodline']) for grand in parent['parents']] for parent in parents]
+    affinity = (
+        store.affinity[xa, codes[0][0], codes[0][1], x] + store.affinity[xb, codes[1][0], codes[1][1], x]
+        + store.c_matrix[xa, xb] + fixed_bonus
+    )
+    return {'bloodline': store.bloodlines[x], 'affinity': float(affinity), 'parents': parents}
+
+
+def _weighted_score(node, weight, scale=1.0):
+    if 'affinity' not in node:
+        return 0.0
+    return scale * node['affinity'] + sum(_weighted_score(parent, weight, scale * weight) for parent in node['parents'])
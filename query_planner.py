@@ -0,0 +1,297 @@
+import math
+import os
+import threading
+
+import numpy as np
+
+import sharded_search
+from sampled_search import SAMPLING_MAX_SAMPLES, sampled_maximin, sampled_summary
+from search_engine import BOUND_EPSILON, SearchContext, side_tables
+
+# 探索の実行計画
+# リクエストごとに使える戦略 (vectorized / parallel / sampled / indexed / decomposed / exhaustive) の所要時間を
+# データの統計 (探索空間の大きさ・子の数・親ペアの上界) から見積もり、予算内で最も安い厳密な戦略を選ぶ。
+# 枝刈りされずに残る組み合わせの数は、少数の標本抽出 (パイロット) で得た暫定解を下限として、
+# その下限に届きうる親ペア・祖父母の組の数から見積もる (実際の枝刈りはこれより強いので多めの見積もり)。
+# 見積もりと実測の比は分岐ごとに記録し (CostFeedback)、以降の見積もりを補正する。
+
+# 予算 (ミリ秒)。deadline_ms を指定したリクエストではその値を使う
+PLANNER_BUDGET_MS = float(os.environ.get('PLANNER_BUDGET_MS', 5000))
+# パイロットの標本数と、パイロットを省略する最悪の場合の見積もり (秒)
+PLANNER_PILOT_SAMPLES = int(os.environ.get('PLANNER_PILOT_SAMPLES', 2000))
+PLANNER_PILOT_MIN_SECONDS = float(os.environ.get('PLANNER_PILOT_MIN_SECONDS', 0.05))
+
+# 費用モデルの係数 (秒)。開発環境で計測した値で、環境に合わせて環境変数で調整する
+# 配列演算で (組み合わせ, 子) を1つ評価する時間
+PLANNER_SECONDS_PER_CELL = float(os.environ.get('PLANNER_SECONDS_PER_CELL', 1e-9))
+# 家系図計画の DP 表の1要素あたりの時間
+PLANNER_SECONDS_PER_DP_CELL = float(os.environ.get('PLANNER_SECONDS_PER_DP_CELL', 5e-9))
+# マルチモードで親ペアを1つ調べるときの、祖父母の組・子あたりの前処理の時間
+PLANNER_SECONDS_PER_ROW = float(os.environ.get('PLANNER_SECONDS_PER_ROW', 1e-8))
+# 子指定の探索で親ペアを1つ調べる時間と、血統を1件取り出す時間
+PLANNER_SECONDS_PER_PARENT_PAIR = float(os.environ.get('PLANNER_SECONDS_PER_PARENT_PAIR', 2e-5))
+PLANNER_SECONDS_PER_LINEAGE = float(os.environ.get('PLANNER_SECONDS_PER_LINEAGE', 5e-6))
+# 1件の組み合わせを Python で評価する時間 (総当たり)
+PLANNER_SECONDS_PER_LOOKUP = float(os.environ.get('PLANNER_SECONDS_PER_LOOKUP', 2e-6))
+# 並列探索の1回あたりの通信の時間と、プロセスプールの起動時間 (最初の1回だけ)
+PLANNER_PARALLEL_OVERHEAD_SECONDS = float(os.environ.get('PLANNER_PARALLEL_OVERHEAD_SECONDS', 0.06))
+PLANNER_PROCESS_STARTUP_SECONDS = float(os.environ.get('PLANNER_PROCESS_STARTUP_SECONDS', 0.6))
+# 実測による補正の重み (指数移動平均)。これより短い見積もりは計測誤差が大きいので記録しない (秒)
+PLANNER_FEEDBACK_SMOOTHING = float(os.environ.get('PLANNER_FEEDBACK_SMOOTHING', 0.2))
+PLANNER_FEEDBACK_MIN_SECONDS = float(os.environ.get('PLANNER_FEEDBACK_MIN_SECONDS', 0.005))
+
+
+class CostFeedback:
+    # 実行した探索の 実測 / 見積もり の比を (分岐, 見積もり方法) ごとに対数の指数移動平均で保持する
+    def __init__(self, smoothing=PLANNER_FEEDBACK_SMOOTHING, min_seconds=PLANNER_FEEDBACK_MIN_SECONDS):
+        self.smoothing = smoothing
+        self.min_seconds = min_seconds
+        self._log_ratios = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def factor(self, key):
+        with self._lock:
+            return math.exp(self._log_ratios.get(key, 0.0))
+
+    def record(self, key, estimated_seconds, actual_seconds):
+        if estimated_seconds < self.min_seconds or actual_seconds <= 0:
+            return
+        observed = math.log(actual_seconds / estimated_seconds)
+        with self._lock:
+            previous = self._log_ratios.get(key)
+            self._log_ratios[key] = observed if previous is None else previous + self.smoothing * (observed - previous)
+            self._samples[key] = self._samples.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return [{'branch': key[0], 'estimate': key[1], 'factor': math.exp(value), 'samples': self._samples[key]}
+                    for key, value in sorted(self._log_ratios.items())]
+
+
+feedback = CostFeedback()
+
+
+def record_cost(plan, seconds):
+    # 単一プロセスで実行した厳密な戦略の実測時間を記録する (並列・標本抽出は見積もりの前提が違うので記録しない)
+    if plan['chosen'] in ('vectorized', 'decomposed', 'indexed', 'exhaustive'):
+        statistics = plan['statistics']
+        feedback.record((plan['branch'], statistics['estimate']), statistics['raw_estimated_ms'] / 1000, seconds)
+
+
+def budget_seconds(deadline_ms=None):
+    return (float(deadline_ms) if deadline_ms is not None else PLANNER_BUDGET_MS) / 1000
+
+
+def _calibrated(branch, method, raw_seconds, statistics):
+    # 見積もりを実測の比で補正し、補正前後の値を統計に残す
+    factor = feedback.factor((branch, method))
+    statistics.update({'estimate': method, 'raw_estimated_ms': round(raw_seconds * 1000, 3), 'calibration': factor})
+    return raw_seconds * factor
+
+
+def _strategy(name, exact, seconds, **work):
+    return {'strategy': name, 'exact': exact, 'estimated_ms': round(seconds * 1000, 3), 'work': work}
+
+
+def _plan(branch, strategies, budget, statistics=None, sampling=None, workers=1):
+    # 予算内で最も安い厳密な戦略を選ぶ (予算内に無ければ最も安い厳密な戦略)
+    # sampling が 'auto' なら、厳密な戦略が予算を超える場合だけ標本抽出を選び、True なら常に標本抽出を選ぶ
+    exact = [strategy for strategy in strategies if strategy['exact']]
+    approximate = [strategy for strategy in strategies if not strategy['exact']]
+    chosen = min(exact, key=lambda strategy: strategy['estimated_ms']) if exact else approximate[0]
+    reason = 'cheapest_exact'
+    if approximate and sampling is True:
+        chosen, reason = approximate[0], 'requested'
+    elif approximate and sampling == 'auto' and chosen['estimated_ms'] > budget * 1000:
+        chosen, reason = approximate[0], 'over_budget'
+    return {
+        'branch': branch,
+        'chosen': chosen['strategy'],
+        'exact': chosen['exact'],
+        'reason': reason,
+        'estimated_ms': chosen['estimated_ms'],
+        'budget_ms': round(budget * 1000, 3),
+        'within_budget': chosen['estimated_ms'] <= budget * 1000,
+        'workers': workers if chosen['strategy'] == 'parallel' else 1,
+        'statistics': statistics or {},
+        'strategies': strategies,
+    }
+
+
+def plan_lookup(branch, lookups, budget):
+    # 全スロット固定・子のみ探索: 組み合わせを1件ずつ評価する
+    statistics = {'combinations': lookups}
+    seconds = _calibrated(branch, 'count', lookups * PLANNER_SECONDS_PER_LOOKUP, statistics)
+    return _plan(branch, [_strategy('exhaustive', True, seconds, lookups=lookups)], budget, statistics)
+
+
+def plan_top_lineages(parent_pairs, limit, distinct_parents, budget):
+    # 子指定の探索: 順位表 (索引) で親ペアごとの最良の候補だけを調べる
+    lineages = limit if distinct_parents else limit * 2
+    statistics = {'parent_pairs': parent_pairs}
+    seconds = _calibrated('child_specified', 'count', parent_pairs * PLANNER_SECONDS_PER_PARENT_PAIR
+                          + lineages * PLANNER_SECONDS_PER_LINEAGE, statistics)
+    return _plan('child_specified', [_strategy('indexed', True, seconds, parent_pairs=parent_pairs, lineages=lineages)],
+                 budget, statistics)
+
+
+def plan_category_lineages(parent_pairs, children, limit, distinct_parents, budget):
+    # モン類を子に指定した探索: 子ごとに子指定の探索を行う (上界で除く子・親ペアは数えない最悪の場合の見積もり)
+    lineages = (limit if distinct_parents else limit * 2) * children
+    statistics = {'parent_pairs': parent_pairs, 'children': children}
+    seconds = _calibrated('category_child', 'worst_case', parent_pairs * children * PLANNER_SECONDS_PER_PARENT_PAIR
+                          + lineages * PLANNER_SECONDS_PER_LINEAGE, statistics)
+    return _plan('category_child', [_strategy('indexed', True, seconds, parent_pairs=parent_pairs * children,
+                                              lineages=lineages)], budget, statistics)
+
+
+def plan_threshold(parent_pairs, limit, include_count, budget):
+    # 全件列挙: 両側の降順リストの二分探索で数え、ヒープで1ページ分を取り出す
+    statistics = {'parent_pairs': parent_pairs}
+    seconds = _calibrated('threshold', 'count', parent_pairs * PLANNER_SECONDS_PER_PARENT_PAIR * (2 if include_count else 1)
+                          + limit * PLANNER_SECONDS_PER_LINEAGE, statistics)
+    return _plan('threshold', [_strategy('indexed', True, seconds, parent_pairs=parent_pairs, lineages=limit)],
+                 budget, statistics)
+
+
+def plan_pedigree_tables(size, depth, cached_levels, budget):
+    # 家系図計画: 深さごとの DP 表 (1段あたり N^4) を、キャッシュに無い深さだけ作る
+    cells = size ** 4 * max(0, depth - cached_levels)
+    statistics = {'bloodlines': size, 'depth': depth, 'cached_levels': cached_levels}
+    seconds = _calibrated('pedigree', 'count', cells * PLANNER_SECONDS_PER_DP_CELL, statistics)
+    return _plan('pedigree', [_strategy('decomposed', True, seconds, cells=cells)], budget, statistics)
+
+
+def _parallel_strategy(serial_seconds, workers, **work):
+    # 分担の数だけ速くなるが、CPU 数を超える分は速くならない。通信と (未起動なら) プロセスの起動の時間がかかる
+    effective = max(1, min(workers, os.cpu_count() or 1))
+    seconds = serial_seconds / effective + PLANNER_PARALLEL_OVERHEAD_SECONDS
+    if sharded_search._executor is None:
+        seconds += PLANNER_PROCESS_STARTUP_SECONDS
+    return _strategy('parallel', True, seconds, workers=workers, effective_workers=effective, **work)
+
+
+def _viable_mass(viable, bounds):
+    # 親ごとの、条件を満たす祖父母の組の数
+    counts = np.concatenate([[0], np.cumsum(viable)])
+    return counts[bounds[1:]] - counts[bounds[:-1]]
+
+
+def plan_summary(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit, budget,
+                 sampling=None, sampling_options=None, detailed=False, context=None):
+    # サマリー探索: 全ての子について一致数を数える (組み合わせ数 × 子の数 の配列演算)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    k1, k2 = len(tables.side1), len(tables.side2)
+    n_children = store.size
+    space = k1 * k2
+    statistics = {'combinations': space, 'children': n_children, 'side1': k1, 'side2': k2}
+    worst = space * n_children * PLANNER_SECONDS_PER_CELL
+    evaluated = space
+    workers = sharded_search.SEARCH_PROCESS_WORKERS
+
+    if space and (detailed or (worst > PLANNER_PILOT_MIN_SECONDS and (sampling == 'auto' or workers > 1))):
+        # パイロットの limit 件目の一致数を下限として、それに届きうる組み合わせの数を見積もる
+        results, _ = sampled_summary(
+            store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit, seed=0,
+            max_samples=PLANNER_PILOT_SAMPLES, round_size=PLANNER_PILOT_SAMPLES, stable_rounds=1,
+            context=SearchContext(memo=context.memo if context is not None else None)
+        )
+        floor = results[-1]['matches'] if len(results) >= limit else 0
+        a_table, b_table = tables.tables()
+        p1_codes, p1_bounds, p2_codes, p2_bounds = tables.groups()
+        a_group_max, b_group_max = tables.group_maxima()
+        threshold = target_min - fixed_bonus - BOUND_EPSILON
+        c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+        c_max = np.nanmax(c_sub) if not np.isnan(c_sub).all() else 0.0
+        with np.errstate(invalid='ignore'):
+            pair_bound = ((a_group_max[:, None, :] + b_group_max[None, :, :] + c_sub[:, :, None]) >= threshold).sum(axis=2)
+            row_bound = ((a_table + b_group_max.max(axis=0) + c_max) >= threshold).sum(axis=1)
+            col_bound = ((b_table + a_group_max.max(axis=0) + c_max) >= threshold).sum(axis=1)
+        candidate_pairs = (pair_bound >= floor) & ~np.isnan(c_sub)
+        rows = _viable_mass(row_bound >= floor, p1_bounds)
+        cols = _viable_mass(col_bound >= floor, p2_bounds)
+        evaluated = int((rows[:, None] * cols[None, :])[candidate_pairs].sum())
+        statistics.update({
+            'parent_pairs': int(pair_bound.size),
+            'candidate_parent_pairs': int(candidate_pairs.sum()),
+            'pilot_floor': int(floor),
+            'estimated_evaluated': evaluated,
+        })
+
+    method = 'pilot' if 'pilot_floor' in statistics else 'worst_case'
+    serial = _calibrated('summary', method, evaluated * n_children * PLANNER_SECONDS_PER_CELL, statistics)
+    strategies = [_strategy('vectorized', True, serial, cells=evaluated * n_children)]
+    if sharded_search._can_shard(store, fixed_slots, explorable_codes, workers):
+        strategies.append(_parallel_strategy(serial, workers, cells=evaluated * n_children))
+    strategies.append(_sampled_strategy(n_children, sampling_options))
+    return _plan('summary', strategies, budget, statistics, sampling, workers)
+
+
+def plan_maximin(store, fixed_slots, explorable_codes, child_codes, fixed_bonus, budget,
+                 sampling=None, sampling_options=None, detailed=False, context=None):
+    # マルチモード: 片側ごとに分解した分枝限定法。調べる親ペアごとに祖父母の組の前処理がかかる
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    k1, k2 = len(tables.side1), len(tables.side2)
+    n_children = len(child_codes)
+    space = k1 * k2
+    statistics = {'combinations': space, 'children': n_children, 'side1': k1, 'side2': k2}
+    p1_codes, p1_bounds, p2_codes, p2_bounds = tables.groups() if space else ([], [0], [], [0])
+    pairs = len(p1_codes) * len(p2_codes)
+    worst_pairs, worst_rows, evaluated = pairs, pairs * (k1 // max(1, len(p1_codes)) + k2 // max(1, len(p2_codes))), space
+    workers = sharded_search.SEARCH_PROCESS_WORKERS
+    worst = space * n_children * PLANNER_SECONDS_PER_CELL
+
+    if space and (detailed or (worst > PLANNER_PILOT_MIN_SECONDS and (sampling == 'auto' or workers > 1))):
+        # パイロットの最低保証相性値を下限として、それを超えうる親ペア・祖父母の組の数を見積もる
+        solution, _ = sampled_maximin(
+            store, fixed_slots, explorable_codes, child_codes, fixed_bonus, seed=0,
+            max_samples=PLANNER_PILOT_SAMPLES, round_size=PLANNER_PILOT_SAMPLES, stable_rounds=1,
+            context=SearchContext(memo=context.memo if context is not None else None)
+        )
+        floor = solution[0] - fixed_bonus if solution is not None else -np.inf
+        a_table, b_table = (table[:, child_codes] for table in tables.tables())
+        a_group_max, b_group_max = (maxima[:, child_codes] for maxima in tables.group_maxima())
+        c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+        c_max = np.nanmax(c_sub) if not np.isnan(c_sub).all() else 0.0
+        pair_bound = (a_group_max[:, None, :] + b_group_max[None, :, :]).min(axis=2) + c_sub
+        candidate_pairs = pair_bound > floor
+        with np.errstate(invalid='ignore'):
+            rows = _viable_mass((a_table + b_group_max.max(axis=0)).min(axis=1) + c_max > floor, p1_bounds)
+            cols = _viable_mass((b_table + a_group_max.max(axis=0)).min(axis=1) + c_max > floor, p2_bounds)
+        group_rows = np.diff(p1_bounds)[:, None] + np.diff(p2_bounds)[None, :]
+        worst_pairs = int(candidate_pairs.sum())
+        worst_rows = int(group_rows[candidate_pairs].sum())
+        evaluated = int((rows[:, None] * cols[None, :])[candidate_pairs].sum())
+        statistics.update({
+            'parent_pairs': pairs,
+            'candidate_parent_pairs': worst_pairs,
+            'pilot_floor': float(floor + fixed_bonus) if np.isfinite(floor) else None,
+            'estimated_evaluated': evaluated,
+        })
+
+    # 総当たりの評価は制約の厳しい子だけで行い、残りの子は候補についてのみ調べる
+    probe = min(n_children, 3)
+    method = 'pilot' if 'pilot_floor' in statistics else 'worst_case'
+    serial = _calibrated('multi', method, worst_rows * n_children * PLANNER_SECONDS_PER_ROW
+                         + evaluated * probe * PLANNER_SECONDS_PER_CELL, statistics)
+    strategies = [_strategy('decomposed', True, serial, parent_pairs=worst_pairs, rows=worst_rows, cells=evaluated * probe)]
+    if sharded_search._can_shard(store, fixed_slots, explorable_codes, workers):
+        strategies.append(_parallel_strategy(serial, workers, parent_pairs=worst_pairs, cells=evaluated * probe))
+    strategies.append(_sampled_strategy(n_children, sampling_options))
+    return _plan('multi', strategies, budget, statistics, sampling, workers)
+
+
+def plan_pareto(store, fixed_slots, explorable_codes, child_codes, budget, context=None):
+    # パレート解: 支配されない組み合わせを全て求めるので、標本抽出や打ち切りの戦略は無い
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    space = len(tables.side1) * len(tables.side2)
+    cells = space * len(child_codes)
+    statistics = {'combinations': space, 'children': len(child_codes)}
+    seconds = _calibrated('multi_pareto', 'worst_case', cells * PLANNER_SECONDS_PER_CELL, statistics)
+    return _plan('multi_pareto', [_strategy('decomposed', True, seconds, cells=cells)], budget, statistics)
+
+
+def _sampled_strategy(n_children, options):
+    samples = (options or {}).get('max_samples', SAMPLING_MAX_SAMPLES)
+    return _strategy('sampled', False, samples * n_children * PLANNER_SECONDS_PER_CELL * 50, samples=samples)
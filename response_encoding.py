@@ -0,0 +1,56 @@
+import gzip
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 結果のコンパクト形式
+# 血統名を /reference の bloodlines の添字 (血統コード) に置き換え、表示用に組み立てた文字列は省く。
+# 血統コードはデータのバージョンごとに決まるので、クライアントは X-Data-Version が
+# 手元の参照データと同じかを確かめてから名前に戻す。
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+# 血統名を値に持つ項目と、血統名をキーに持つ項目
+# (キーは血統コードを文字列にしたもの。msgpack の標準の復号は整数のキーを受け付けない)
+BLOODLINE_FIELDS = frozenset((
+    'child', 'parent1', 'grandpa1', 'grandma1', 'parent2', 'grandpa2', 'grandma2', 'child_bloodline', 'bloodline',
+))
+BLOODLINE_KEYED_FIELDS = frozenset(('children_details',))
+# combination から組み立て直せる表示用の項目
+DERIVED_FIELDS = frozenset(('parent_bloodline',))
+# これより小さい本文は圧縮しない (バイト)
+GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', 6))
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def to_compact(payload, codes):
+    # codes は 血統名 -> 血統コード。未知の名前はそのまま残す
+    if isinstance(payload, list):
+        return [to_compact(item, codes) for item in payload]
+    if not isinstance(payload, dict):
+        return payload
+    compact = {}
+    for key, value in payload.items():
+        if key in DERIVED_FIELDS:
+            continue
+        if key in BLOODLINE_FIELDS and isinstance(value, str):
+            compact[key] = codes.get(value, value)
+        elif key in BLOODLINE_KEYED_FIELDS and isinstance(value, dict):
+            compact[key] = {str(codes[name]) if name in codes else name: to_compact(item, codes) for name, item in value.items()}
+        else:
+            compact[key] = to_compact(value, codes)
+    return compact
+
+
+def pack_compact(payload, codes):
+    return msgpack.packb(to_compact(payload, codes), use_bin_type=True)
+
+
+def gzip_body(body):
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# 結果キャッシュの上限 (JSON に直したときのおおよそのバイト数)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+class ResultCache:
+    # 正規化したリクエストをキーにした、サイズ上限付きの LRU キャッシュ
+    # 各エントリはデータのバージョンと、計算したときの固定ボーナスを持つ。
+    # 固定ボーナスは合計値を一律にずらすだけなので、ずらせる結果は shift で補正して使い回す
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._bytes = 0
+        self.hits = 0
+        self.shifted_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_version(self, version):
+        # データが更新されたら古い結果は全て捨てる
+        if version != self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, version, key, fixed_bonus=None, shift=None):
+        # キャッシュ済みの結果を返す (無ければ None)
+        # shift(結果, 差分) を渡した場合は、別の固定ボーナスで計算した結果も補正して返す
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            payload, cached_bonus, _ = entry
+            self.hits += 1
+            if shift is None or cached_bonus == fixed_bonus:
+                return payload
+            self.shifted_hits += 1
+        return shift(payload, fixed_bonus - cached_bonus)
+
+    def put(self, version, key, payload, fixed_bonus=None):
+        size = len(json.dumps(payload, ensure_ascii=False))
+        with self._lock:
+            self._check_version(version)
+            if size > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (payload, fixed_bonus, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shifted_hits': self.shifted_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'data_version': self._version,
+            }
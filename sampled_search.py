@@ -0,0 +1,248 @@
+import os
+
+import numpy as np
+
+from search_engine import (
+    BOUND_EPSILON, SLOT_NAMES, _profile, _report, _summary_entries, _top_merge, side_tables
+)
+
+# 標本抽出による探索 (厳密探索の代わりに、指定した回数以内で打ち切る)
+# 親ペアを層として、上界の余裕 (C値と両側の子ごとの最大値から求めた上界 - 暫定解) に比例した確率で層を選び、
+# 層内の祖父母の組もそれぞれの上界の余裕に比例して選ぶ。暫定解を超えられない親ペア・祖父母の組は
+# 選ばないので、ラウンドを重ねるほど見込みのある組み合わせに集中する。
+# 上位の結果が stable_rounds ラウンド続けて変わらなければ打ち切る。乱数はシードで再現できる。
+
+SAMPLING_MAX_SAMPLES = int(os.environ.get('SAMPLING_MAX_SAMPLES', 40000))
+SAMPLING_ROUND_SIZE = int(os.environ.get('SAMPLING_ROUND_SIZE', 2000))
+SAMPLING_STABLE_ROUNDS = int(os.environ.get('SAMPLING_STABLE_ROUNDS', 5))
+
+
+def _group_bounds(side):
+    # 辞書順に並んだ候補の、親ごとの区切り (親コード, 区切り位置)
+    codes, start = np.unique(side[:, 0], return_index=True)
+    return codes, np.append(start, len(side))
+
+
+class _Sampler:
+    # 親ペアごとの重みで標本を抽出し、抽出済みの組み合わせと停止条件を管理する
+    def __init__(self, p1_bounds, p2_bounds, seed, max_samples, round_size, stable_rounds):
+        self.seed = int(seed) if seed is not None else int(np.random.SeedSequence().entropy % (2 ** 32))
+        self.rng = np.random.default_rng(self.seed)
+        self.p1_bounds = p1_bounds
+        self.p2_bounds = p2_bounds
+        self.p1_sizes = np.diff(p1_bounds)
+        self.p2_sizes = np.diff(p2_bounds)
+        self.k2 = int(p2_bounds[-1])
+        self.space = int(p1_bounds[-1]) * self.k2
+        self.max_samples = max(0, int(max_samples))
+        self.round_size = max(1, int(round_size))
+        self.stable_rounds = max(1, int(stable_rounds))
+        self.samples = 0
+        self.rounds = 0
+        self.stable = 0
+        self.since_change = 0
+        self.exhausted = False
+        self.seen = np.empty(0, dtype=np.int64)
+
+    def draw(self, headroom, row_weights, col_weights):
+        # headroom[g1, g2]: 親ペアの上界が暫定解をどれだけ上回るか (0 以下の親ペアは選ばない)
+        # row_weights / col_weights: 各側の祖父母の組の重み (その組単独の上界の余裕。0 なら選ばない)
+        # 親ペアは 余裕 × 両側の重みの和 に比例して選び、その中の行・列は重みに比例して選ぶ
+        # 戻り値は (行番号, 列番号, 親①の番号, 親②の番号)。抽出できる親ペアが無ければ None
+        row_cum = np.concatenate([[0.0], np.cumsum(row_weights)])
+        col_cum = np.concatenate([[0.0], np.cumsum(col_weights)])
+        row_mass = row_cum[self.p1_bounds[1:]] - row_cum[self.p1_bounds[:-1]]
+        col_mass = col_cum[self.p2_bounds[1:]] - col_cum[self.p2_bounds[:-1]]
+        weights = np.where(headroom > 0, row_mass[:, None] * col_mass[None, :] * headroom, 0.0).ravel()
+        total = weights.sum()
+        size = min(self.round_size, self.max_samples - self.samples)
+        if not total > 0:
+            self.exhausted = True
+            return None
+        if size <= 0:
+            return None
+        pairs = self.rng.choice(len(weights), size=size, p=weights / total)
+        g1, g2 = np.divmod(pairs, len(self.p2_sizes))
+        rows = self._pick(row_cum, self.p1_bounds, g1, row_mass)
+        cols = self._pick(col_cum, self.p2_bounds, g2, col_mass)
+        self.samples += size
+        self.rounds += 1
+        self.seen = np.union1d(self.seen, rows * self.k2 + cols)
+        return rows, cols, g1, g2
+
+    def _pick(self, cum, bounds, groups, mass):
+        # 各標本の親の区間内で、重みの累積和を逆引きして行 (列) を選ぶ
+        targets = cum[bounds[groups]] + self.rng.random(len(groups)) * mass[groups]
+        picked = np.searchsorted(cum, targets, side='right') - 1
+        return np.clip(picked, bounds[groups], bounds[groups + 1] - 1)
+
+    def settle(self, changed, size):
+        # 1ラウンドの結果を記録し、打ち切るかどうかを返す
+        if changed:
+            self.stable = 0
+            self.since_change = 0
+        else:
+            self.stable += 1
+            self.since_change += size
+        return self.stable >= self.stable_rounds or self.samples >= self.max_samples
+
+    def stats(self, upper_bound):
+        # coverage: 評価した組み合わせの割合
+        # improvement_rate_95: 最後に結果が変わって以降の標本から見た、1標本で結果が改善する確率の
+        #   95% 上限 (改善が0回なら 3 / 標本数)。exhausted なら残りの親ペアでは改善しえないので結果は厳密
+        return {
+            'seed': self.seed,
+            'samples': self.samples,
+            'unique_samples': int(len(self.seen)),
+            'rounds': self.rounds,
+            'coverage': len(self.seen) / self.space if self.space else 1.0,
+            'stopped_early': self.exhausted or (self.stable >= self.stable_rounds and self.samples < self.max_samples),
+            'exhausted': self.exhausted,
+            'improvement_rate_95': 0.0 if self.exhausted else (3.0 / self.since_change if self.since_change else 1.0),
+            'upper_bound': upper_bound,
+        }
+
+
+def sampled_summary(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit, seed=None,
+                    max_samples=SAMPLING_MAX_SAMPLES, round_size=SAMPLING_ROUND_SIZE,
+                    stable_rounds=SAMPLING_STABLE_ROUNDS, context=None):
+    # summarize_combinations の標本抽出版。戻り値は (結果, 抽出の統計)
+    # 親ペアの上界は summary_top と同じ「到達しうる一致数」で、上界の余裕は 上界 - 暫定の limit 件目の一致数 + 1
+    profile = _profile(context)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    side1, side2 = tables.side1, tables.side2
+    exploring = [slot for slot in SLOT_NAMES if fixed_slots.get(slot) is None]
+    if not exploring or limit <= 0 or len(side1) == 0 or len(side2) == 0:
+        return [], None
+    a_table, b_table = tables.tables()
+    p1_codes, p1_bounds, p2_codes, p2_bounds = tables.groups()
+    a_group_max, b_group_max = tables.group_maxima()
+    profile.lap('lookup')
+
+    c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    threshold = target_min - fixed_bonus - BOUND_EPSILON
+    with np.errstate(invalid='ignore'):
+        pair_bound = ((a_group_max[:, None, :] + b_group_max[None, :, :] + c_sub[:, :, None]) >= threshold).sum(axis=2)
+    pair_bound = np.where(np.isnan(c_sub), -1, pair_bound)
+
+    # 祖父母の組ごとの上界: 相手側の全体の最大値と C値の最大値で到達しうる一致数
+    c_max = np.nanmax(c_sub) if not np.isnan(c_sub).all() else 0.0
+    with np.errstate(invalid='ignore'):
+        row_bound = ((a_table + b_group_max.max(axis=0) + c_max) >= threshold).sum(axis=1)
+        col_bound = ((b_table + a_group_max.max(axis=0) + c_max) >= threshold).sum(axis=1)
+
+    sampler = _Sampler(p1_bounds, p2_bounds, seed, max_samples, round_size, stable_rounds)
+    best_matches = np.empty(0, dtype=np.int64)
+    best_index = np.empty(0, dtype=np.int64)
+    while True:
+        if context is not None and context.is_cancelled():
+            # 中止・期限切れの場合も、それまでの抽出結果と統計を返す
+            break
+        kth = best_matches[-1] if len(best_matches) >= limit else 0
+        # 一致数 0 の組み合わせも結果に含めるので、上位が埋まるまでは全ての親ペアを対象にする
+        slack = 1 if len(best_matches) < limit else 0
+        drawn = sampler.draw(
+            (pair_bound - kth + slack).astype(np.float64),
+            np.maximum(row_bound - kth + slack, 0).astype(np.float64),
+            np.maximum(col_bound - kth + slack, 0).astype(np.float64),
+        )
+        if drawn is None:
+            break
+        rows, cols, g1, g2 = drawn
+        with np.errstate(invalid='ignore'):
+            matches = ((a_table[rows] + b_table[cols] + c_sub[g1, g2][:, None]) >= threshold).sum(axis=1)
+        index, first = np.unique(rows * sampler.k2 + cols, return_index=True)
+        matches = matches[first]
+        fresh = ~np.isin(index, best_index)
+        previous = best_index
+        best_matches, best_index = _top_merge(best_matches, best_index, matches[fresh], index[fresh], limit)
+        changed = not np.array_equal(previous, best_index)
+        _report(context, partial=lambda: _summary_entries(store, fixed_slots, side1, side2, best_matches, best_index),
+                samples=sampler.samples)
+        if sampler.settle(changed, len(rows)):
+            break
+
+    profile.count('evaluated', sampler.samples)
+    profile.lap('aggregation')
+    results = _summary_entries(store, fixed_slots, side1, side2, best_matches, best_index)
+    return results, sampler.stats(int(pair_bound.max()))
+
+
+def sampled_maximin(store, fixed_slots, explorable_codes, child_codes, fixed_bonus, seed=None,
+                    max_samples=SAMPLING_MAX_SAMPLES, round_size=SAMPLING_ROUND_SIZE,
+                    stable_rounds=SAMPLING_STABLE_ROUNDS, context=None):
+    # maximin_combination の標本抽出版。戻り値は ((最低保証相性値, 組み合わせ) または None, 抽出の統計)
+    # 親ペアの上界は C + min_k(maxA[k] + maxB[k]) で、上界の余裕は 上界 - 暫定解
+    profile = _profile(context)
+    child_codes = np.asarray(child_codes, dtype=np.intp)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    side1, side2 = tables.side1, tables.side2
+    if len(side1) == 0 or len(side2) == 0 or len(child_codes) == 0:
+        return None, None
+    a_table, b_table = tables.tables()
+    a_table, b_table = a_table[:, child_codes], b_table[:, child_codes]
+    a_valid = ~np.isnan(a_table).any(axis=1)
+    b_valid = ~np.isnan(b_table).any(axis=1)
+    side1, a_table = side1[a_valid], a_table[a_valid]
+    side2, b_table = side2[b_valid], b_table[b_valid]
+    if len(side1) == 0 or len(side2) == 0:
+        return None, None
+    p1_codes, p1_bounds = _group_bounds(side1)
+    p2_codes, p2_bounds = _group_bounds(side2)
+    a_group_max = np.stack([a_table[p1_bounds[g]:p1_bounds[g + 1]].max(axis=0) for g in range(len(p1_codes))])
+    b_group_max = np.stack([b_table[p2_bounds[g]:p2_bounds[g + 1]].max(axis=0) for g in range(len(p2_codes))])
+    profile.lap('lookup')
+
+    c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    pair_bound = (a_group_max[:, None, :] + b_group_max[None, :, :]).min(axis=2) + c_sub
+    pair_bound[np.isnan(c_sub)] = -np.inf
+    if not np.isfinite(pair_bound).any():
+        return None, None
+    lowest = pair_bound[np.isfinite(pair_bound)].min()
+
+    # 祖父母の組ごとの上界: 相手側の全体の最大値と C値の最大値で到達しうる最低相性値
+    c_max = np.nanmax(c_sub[np.isfinite(pair_bound)])
+    row_bound = (a_table + b_group_max.max(axis=0)).min(axis=1) + c_max
+    col_bound = (b_table + a_group_max.max(axis=0)).min(axis=1) + c_max
+
+    sampler = _Sampler(p1_bounds, p2_bounds, seed, max_samples, round_size, stable_rounds)
+    best_value = -np.inf
+    best_pair = None
+
+    def solution():
+        if best_pair is None:
+            return None
+        codes = side1[best_pair[0]].tolist() + side2[best_pair[1]].tolist()
+        combination = {slot: store.bloodlines[code] for slot, code in zip(SLOT_NAMES, codes)}
+        return float(best_value + fixed_bonus), combination
+
+    def partial_solution():
+        current = solution()
+        return [] if current is None else [{'min_guaranteed_affinity': current[0], 'combination': current[1]}]
+
+    while True:
+        if context is not None and context.is_cancelled():
+            break
+        # 暫定解が無いうちは全ての親ペアを対象にする
+        floor = best_value if best_pair is not None else lowest - 1
+        headroom = np.where(np.isfinite(pair_bound), pair_bound - floor, 0.0)
+        drawn = sampler.draw(headroom, np.maximum(row_bound - floor, 0.0), np.maximum(col_bound - floor, 0.0))
+        if drawn is None:
+            break
+        rows, cols, g1, g2 = drawn
+        values = (a_table[rows] + b_table[cols]).min(axis=1) + c_sub[g1, g2]
+        # 同値なら組み合わせ番号の小さい方を残す (抽出順に依らない結果にする)
+        order = np.lexsort((rows * sampler.k2 + cols, -values))
+        top = order[0]
+        changed = False
+        if values[top] > best_value or (values[top] == best_value and best_pair is not None
+                                         and (rows[top], cols[top]) < best_pair):
+            best_value, best_pair = values[top], (int(rows[top]), int(cols[top]))
+            changed = True
+        _report(context, partial=partial_solution, samples=sampler.samples)
+        if sampler.settle(changed, len(rows)):
+            break
+
+    profile.count('evaluated', sampler.samples)
+    profile.lap('aggregation')
+    return solution(), sampler.stats(float(pair_bound.max() + fixed_bonus))
@@ -0,0 +1,1200 @@
+import heapq
+import time
+from threading import Event
+
+import numpy as np
+
+from metrics import NULL_PROFILE
+
+# 探索エンジン
+# 相性ストアの配列をまとめて演算し、Python のループを使わずに探索する。
+
+SLOT_NAMES = ['parent1', 'grandpa1', 'grandma1', 'parent2', 'grandpa2', 'grandma2']
+SIDE_SLOTS = (('parent1', 'grandpa1', 'grandma1'), ('parent2', 'grandpa2', 'grandma2'))
+
+# 1チャンクで評価する組み合わせ数の上限 (一致数の配列と比較用バッファの大きさ)
+SUMMARY_CHUNK_ELEMENTS = 4_000_000
+
+# マルチモードで支配される祖父母の組を除く子の数の上限
+# (子が多いとほとんどの組が互いに支配されず、除去の手間だけがかかる)
+PARETO_MAX_CHILDREN = 4
+# マルチモードで全ペアを評価する、制約の厳しい子の数
+MAXIMIN_PROBE_CHILDREN = 3
+
+# 上界との比較で浮動小数点の丸め誤差により枝刈りしすぎないための余裕
+BOUND_EPSILON = 1e-9
+
+
+class ExplorationCancelled(Exception):
+    pass
+
+
+class SearchContext:
+    # 1回の探索の中止フラグ・期限・進捗カウンタ・暫定結果
+    # ジョブとして実行する場合は、別スレッドからポーリングで参照される
+    def __init__(self, cancel_event=None, shared_floor=None, profile=NULL_PROFILE, memo=None, deadline=None,
+                 explain=False):
+        self.cancel_event = cancel_event if cancel_event is not None else Event()
+        # 探索を打ち切る時刻 (time.monotonic() の値)。期限を過ぎると中止と同じく探索を止める
+        self.deadline = deadline
+        self.started = time.monotonic()
+        # True なら探索は実行せず、実行計画だけを返す (/explain)
+        self.explain = explain
+        # 探索に使ったデータのバージョン (ジョブの結果に付ける)
+        self.data_version = None
+        # 段階別の計測 (metrics.RequestProfile)。計測しない場合は何もしない NULL_PROFILE
+        self.profile = profile
+        # 並列探索で分担間に共有する枝刈りの基準値 (.value を持つ共有オブジェクト)
+        self.shared_floor = shared_floor
+        # 一括探索で共有する中間テーブルの辞書 (None なら共有しない)
+        self.memo = memo
+        self.progress = {}
+        self._partial = None
+        # 打ち切った時点で、まだ調べていない組み合わせが到達しうる値の上限 (-inf なら残りは無い)
+        self.upper_bound = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set() or self.deadline_exceeded()
+
+    def deadline_exceeded(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def stop_reason(self):
+        # 探索を止めた理由 ('cancelled' / 'deadline')。止めていなければ None
+        if self.cancel_event.is_set():
+            return 'cancelled'
+        if self.deadline_exceeded():
+            return 'deadline'
+        return None
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def report_progress(self, **counters):
+        self.progress = {**self.progress, **counters}
+
+    def report_partial(self, build_result):
+        # 暫定結果は参照されたときに組み立てる (探索ループ側では整形しない)
+        self._partial = build_result
+
+    @property
+    def partial_result(self):
+        return self._partial() if self._partial is not None else None
+
+
+def _shared_floor(context, local):
+    # 他の分担が既に達成した基準値の方が高ければそれを使う
+    if context is None or context.shared_floor is None:
+        return local
+    return max(local, context.shared_floor.value)
+
+
+def _publish_floor(context, local):
+    # 同時に更新されて低い値で上書きされても、枝刈りが弱まるだけで結果は変わらない
+    if context is not None and context.shared_floor is not None and local > context.shared_floor.value:
+        context.shared_floor.value = local
+
+
+def _raise_if_cancelled(context, bound=None):
+    # bound は中止時に残りの探索空間の上界を返す関数 (中止するときだけ呼ぶ)
+    if context is not None and context.is_cancelled():
+        if bound is not None:
+            context.upper_bound = bound()
+        raise ExplorationCancelled()
+
+
+def deadline_after(milliseconds):
+    # 今から milliseconds ミリ秒後の期限 (SearchContext の deadline)。None なら期限なし
+    if milliseconds is None:
+        return None
+    return time.monotonic() + float(milliseconds) / 1000
+
+
+def _profile(context):
+    return context.profile if context is not None else NULL_PROFILE
+
+
+def _report(context, partial=None, **counters):
+    if context is None:
+        return
+    context.report_progress(**counters)
+    if partial is not None:
+        context.report_partial(partial)
+
+
+def iter_side_candidates(store, parent, child, grandpa=None, grandma=None, excluded_codes=frozenset()):
+    # 片側 (親・子が決まっている) の祖父母候補を相性値の降順に (相性値, 祖父, 祖母) で列挙する
+    # 固定されていない祖父母は順位表を先頭から辿り、除外モンスターを読み飛ばすだけなので、
+    # 手間は N² ではなく除外数に比例する。固定された祖父母は除外判定の対象にしない。
+    affinity = store.affinity
+    if grandpa is not None and grandma is not None:
+        val = affinity.item(parent, grandpa, grandma, child)
+        if val == val:
+            yield val, grandpa, grandma
+        return
+
+    if grandpa is not None:
+        ranked = store.ranked_grandmas[parent, grandpa, child].tolist()
+        values = affinity[parent, grandpa, :, child]
+        for gm in ranked:
+            val = values.item(gm)
+            if val != val:
+                return
+            if gm not in excluded_codes:
+                yield val, grandpa, gm
+        return
+
+    if grandma is not None:
+        ranked = store.ranked_grandpas[parent, grandma, child].tolist()
+        values = affinity[parent, :, grandma, child]
+        for gp in ranked:
+            val = values.item(gp)
+            if val != val:
+                return
+            if gp not in excluded_codes:
+                yield val, gp, grandma
+        return
+
+    n = store.size
+    values = affinity[parent, :, :, child]
+    for pair in store.ranked_grandparent_pairs[parent, child]:
+        gp, gm = divmod(int(pair), n)
+        val = values.item(gp, gm)
+        if val != val:
+            return
+        if gp not in excluded_codes and gm not in excluded_codes:
+            yield val, gp, gm
+
+
+def inventory_side_candidates(store, parent, child, grandpas, grandmas):
+    # 祖父・祖母の候補を血統コードの配列で与えた片側の候補 (所持モンスターに限った探索用)
+    # 手間は N² ではなく候補の数の積に比例する。順序は iter_side_candidates と同じ
+    # (相性値の降順、同値なら祖父・祖母のコード順)
+    grandpas = np.asarray(grandpas, dtype=np.intp)
+    grandmas = np.asarray(grandmas, dtype=np.intp)
+    values = store.affinity[parent, grandpas[:, None], grandmas[None, :], child].ravel()
+    order = np.argsort(-np.nan_to_num(values, nan=-np.inf), kind='stable')
+    order = order[~np.isnan(values[order])]
+    gp_index, gm_index = np.divmod(order, len(grandmas))
+    for val, gp, gm in zip(values[order].tolist(), grandpas[gp_index].tolist(), grandmas[gm_index].tolist()):
+        yield val, gp, gm
+
+
+class _LazyCandidates:
+    # 降順の候補イテレータを必要な位置まで読み進めて保持する
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self.items = []
+
+    def get(self, index):
+        while len(self.items) <= index:
+            item = next(self._iterator, None)
+            if item is None:
+                return None
+            self.items.append(item)
+        return self.items[index]
+
+
+def top_lineages(store, child, parent_pairs, fixed_codes, excluded_codes, fixed_bonus, limit,
+                 distinct_parents=False, context=None, allowed_codes=None, floor=None):
+    # 子を指定した探索で、相性値の上位 limit 件の血統を1回の走査で求める
+    # parent_pairs は (親①, 親②, C値) のコードの列。結果は大きさ limit のヒープで保持し、
+    # 親ペアの上界 (各側の最良候補 + C値) がヒープの最下位に届かなければ調べない。
+    # 同じ親ペアから祖父母違いの血統も降順に取り出す。distinct_parents=True の場合は親ペアごとに最良の1件だけを返す。
+    # allowed_codes は所持モンスターで絞り込んだ スロット -> 血統コードの一覧 (制限の無いスロットは None)。
+    # 祖父母が絞り込まれている側は、順位表を読み飛ばさず候補だけから並べる
+    # floor を指定すると、それより小さい相性値の血統は調べない (同値は残す)
+    if limit <= 0:
+        return []
+    explorable = None
+    sides = {}
+
+    def side_candidates(parent, grandpa_slot, grandma_slot):
+        # 同じ親の片側の候補は親ペアをまたいで使い回す
+        key = (parent, grandpa_slot)
+        if key not in sides:
+            sides[key] = _LazyCandidates(side_iterator(parent, grandpa_slot, grandma_slot))
+        return sides[key]
+
+    def side_iterator(parent, grandpa_slot, grandma_slot):
+        nonlocal explorable
+        grandpa, grandma = fixed_codes[grandpa_slot], fixed_codes[grandma_slot]
+        restricted = [slot for slot, code in ((grandpa_slot, grandpa), (grandma_slot, grandma))
+                      if code is None and allowed_codes is not None and allowed_codes.get(slot) is not None]
+        if not restricted:
+            return iter_side_candidates(store, parent, child, grandpa, grandma, excluded_codes)
+        if explorable is None:
+            explorable = np.setdiff1d(np.arange(store.size), np.fromiter(excluded_codes, dtype=np.intp))
+
+        def codes(slot, code):
+            if code is not None:
+                return [code]
+            return allowed_codes[slot] if slot in restricted else explorable
+        return inventory_side_candidates(store, parent, child, codes(grandpa_slot, grandpa), codes(grandma_slot, grandma))
+
+    heap = []  # (相性値, -発見順, 組み合わせ) の最小ヒープ: 根が現在の最下位
+    sequence = 0
+
+    def offer(total, codes):
+        nonlocal sequence
+        entry = (total, -sequence, codes)
+        sequence += 1
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    def beaten(total):
+        # 同値なら先に見つかった方が上位なので、後から来た同値は入れない
+        return (len(heap) >= limit and total <= heap[0][0]) or (floor is not None and total < floor)
+
+    def ranked_results():
+        results = []
+        for total, _, codes in sorted(heap, key=lambda entry: entry[:2], reverse=True):
+            combination = {slot: store.bloodlines[code] for slot, code in zip(SLOT_NAMES, codes)}
+            results.append({'best_affinity': total, 'combination': combination})
+        return results
+
+    processed_count = 0
+    _report(context, partial=ranked_results)
+    parent_pairs = iter(parent_pairs)
+    for p1, p2, c_val in parent_pairs:
+        if context is not None and context.is_cancelled():
+            # 残りの親ペアの上界を求めてから中断する (列挙は安価なので中断時にまとめて読み切る)
+            remaining = [(p1, p2, c_val)] + list(parent_pairs)
+            _raise_if_cancelled(context, bound=lambda: _lineage_bound(store, child, remaining, fixed_codes, fixed_bonus))
+        side1 = side_candidates(p1, 'grandpa1', 'grandma1')
+        side2 = side_candidates(p2, 'grandpa2', 'grandma2')
+        first_a = side1.get(0)
+        first_b = side2.get(0)
+        processed_count += 1
+        if processed_count % 100 == 0:
+            _report(context, partial=ranked_results, parent_pairs=processed_count)
+        if first_a is None or first_b is None:
+            continue
+
+        if distinct_parents:
+            total = first_a[0] + first_b[0] + c_val + fixed_bonus
+            if not beaten(total):
+                offer(total, (p1, first_a[1], first_a[2], p2, first_b[1], first_b[2]))
+            continue
+
+        # 2つの降順リストの和を大きい順に取り出す (i, j) のフロンティア探索
+        frontier = [(-(first_a[0] + first_b[0]), 0, 0)]
+        seen = {(0, 0)}
+        while frontier:
+            neg_sum, i, j = heapq.heappop(frontier)
+            total = -neg_sum + c_val + fixed_bonus
+            if beaten(total):
+                break
+            a = side1.get(i)
+            b = side2.get(j)
+            offer(total, (p1, a[1], a[2], p2, b[1], b[2]))
+            for ni, nj in ((i + 1, j), (i, j + 1)):
+                if (ni, nj) in seen:
+                    continue
+                next_a = side1.get(ni)
+                next_b = side2.get(nj)
+                if next_a is not None and next_b is not None:
+                    seen.add((ni, nj))
+                    heapq.heappush(frontier, (-(next_a[0] + next_b[0]), ni, nj))
+
+    profile = _profile(context)
+    profile.count('parent_pairs', processed_count)
+    profile.count('lineages', sequence)
+    profile.lap('aggregation')
+    return ranked_results()
+
+
+def top_category_lineages(store, category, parent_pairs, fixed_codes, excluded_codes, fixed_bonus, limit,
+                          distinct_parents=False, context=None, allowed_codes=None):
+    # モン類を子に指定した探索。モン類のいずれかの子を生む血統のうち、相性値の上位 limit 件を返す
+    # (結果の combination には子も含める)。並び順は相性値の降順、同値なら子のコード順、
+    # 同じ子の中では top_lineages の順で、子ごとに top_lineages を呼んで併合した結果と同じになる。
+    # 親ペアの上界はモン類ごとの集約 (category_best_ab_max) で求め、モン類のどの子にも届かない親ペアは除く。
+    # 子は上界の降順に調べ、上位 limit 件の最下位に届かない子・親ペアは調べない
+    children = store.category_codes(category)
+    if limit <= 0 or not children:
+        return []
+    pairs = list(parent_pairs)
+    if not pairs:
+        return []
+    p1s, p2s, c_vals = (np.asarray(column) for column in zip(*pairs))
+    c_vals = c_vals.astype(np.float64) + fixed_bonus
+    k = store.categories.index(category)
+    category_bound = store.category_best_ab_max[p1s, k] + store.category_best_ab_max[p2s, k] + c_vals
+    viable = np.flatnonzero(~np.isnan(category_bound))
+    best = np.asarray(store.best_ab_affinity)[:, children]
+    best = np.where(best > -1, best, np.nan)
+    # [親ペア, 子] の上界と、子ごとの上界
+    pair_bounds = best[p1s[viable]] + best[p2s[viable]] + c_vals[viable, None]
+    child_bounds = np.full(len(children), -np.inf)
+    if len(viable):
+        child_bounds = np.where(np.isnan(pair_bounds), -np.inf, pair_bounds).max(axis=0)
+    order = np.argsort(-child_bounds, kind='stable')
+    _profile(context).lap('lookup')
+
+    ranked = []  # (相性値, 子のコード, 子の中での順位, 結果)
+
+    def results():
+        return [entry for _, _, _, entry in ranked]
+
+    def remaining_bound(position):
+        return float(child_bounds[order[position:]].max()) if position < len(order) else -np.inf
+
+    evaluated = 0
+    for position, column in enumerate(order.tolist()):
+        child = children[column]
+        _raise_if_cancelled(context, bound=lambda: remaining_bound(position))
+        kth = ranked[limit - 1][0] if len(ranked) >= limit else None
+        if not np.isfinite(child_bounds[column]) or (kth is not None and child_bounds[column] < kth):
+            break
+        with np.errstate(invalid='ignore'):
+            keep = ~np.isnan(pair_bounds[:, column])
+            if kth is not None:
+                keep &= pair_bounds[:, column] >= kth - BOUND_EPSILON
+        child_pairs = [pairs[i] for i in viable[keep].tolist()]
+        evaluated += 1
+        # 子ごとの暫定結果は外側の context に載せず、併合した結果だけを報告する
+        child_context = None
+        if context is not None:
+            child_context = SearchContext(cancel_event=context.cancel_event, profile=context.profile, deadline=context.deadline)
+        try:
+            entries = top_lineages(
+                store, child, child_pairs, fixed_codes, excluded_codes, fixed_bonus, limit,
+                distinct_parents=distinct_parents, context=child_context, allowed_codes=allowed_codes, floor=kth
+            )
+        except ExplorationCancelled:
+            partial = [(entry['best_affinity'], child, rank, entry) for rank, entry in enumerate(child_context.partial_result or [])]
+            for _, _, _, entry in partial:
+                entry['combination'] = {'child': store.bloodlines[child], **entry['combination']}
+            ranked = sorted(ranked + partial, key=lambda item: (-item[0], item[1], item[2]))[:limit]
+            context.report_partial(results)
+            context.upper_bound = max(child_context.upper_bound if child_context.upper_bound is not None else -np.inf,
+                                      remaining_bound(position + 1))
+            raise
+        for rank, entry in enumerate(entries):
+            entry['combination'] = {'child': store.bloodlines[child], **entry['combination']}
+            ranked.append((entry['best_affinity'], child, rank, entry))
+        ranked.sort(key=lambda item: (-item[0], item[1], item[2]))
+        del ranked[limit:]
+        _report(context, partial=results, children=position + 1)
+
+    profile = _profile(context)
+    profile.count('children', evaluated)
+    profile.count('pruned_children', len(children) - evaluated)
+    return results()
+
+
+def _side_maxima(store, parents, child, grandpa=None, grandma=None):
+    # 親ごとの片側の相性値の最大値 (順位表の先頭)。除外モンスターは考慮しないので上界として使う
+    # 候補が無い親は -inf
+    parents = np.asarray(parents, dtype=np.intp)
+    if grandpa is not None and grandma is not None:
+        grandpas = np.full_like(parents, grandpa)
+        grandmas = np.full_like(parents, grandma)
+    elif grandpa is not None:
+        grandpas = np.full_like(parents, grandpa)
+        grandmas = np.asarray(store.ranked_grandmas[parents, grandpa, child, 0], dtype=np.intp)
+    elif grandma is not None:
+        grandpas = np.asarray(store.ranked_grandpas[parents, grandma, child, 0], dtype=np.intp)
+        grandmas = np.full_like(parents, grandma)
+    else:
+        grandpas, grandmas = np.divmod(np.asarray(store.ranked_grandparent_pairs[parents, child, 0], dtype=np.intp), store.size)
+    values = store.affinity[parents, grandpas, grandmas, child]
+    return np.where(np.isnan(values), -np.inf, values)
+
+
+def _lineage_bound(store, child, parent_pairs, fixed_codes, fixed_bonus):
+    # (親①, 親②, C値) の列から作れる血統の相性値の上界 (各側の最大値 + C値 + 固定ボーナス)
+    if not parent_pairs:
+        return -np.inf
+    p1s, p2s, c_vals = (np.asarray(column) for column in zip(*parent_pairs))
+    parents1, inverse1 = np.unique(p1s, return_inverse=True)
+    parents2, inverse2 = np.unique(p2s, return_inverse=True)
+    side1 = _side_maxima(store, parents1, child, fixed_codes['grandpa1'], fixed_codes['grandma1'])[inverse1]
+    side2 = _side_maxima(store, parents2, child, fixed_codes['grandpa2'], fixed_codes['grandma2'])[inverse2]
+    return float((side1 + side2 + c_vals.astype(np.float64)).max() + fixed_bonus)
+
+
+def side_candidate_arrays(store, parent, child, grandpa=None, grandma=None, excluded_mask=None):
+    # iter_side_candidates の配列版。(相性値, 祖父, 祖母) をそれぞれ相性値の降順の配列で返す
+    # excluded_mask は血統コードごとの除外フラグ。固定された祖父母は除外判定の対象にしない
+    if grandpa is not None and grandma is not None:
+        grandpas = np.array([grandpa], dtype=np.intp)
+        grandmas = np.array([grandma], dtype=np.intp)
+    elif grandpa is not None:
+        grandmas = np.asarray(store.ranked_grandmas[parent, grandpa, child], dtype=np.intp)
+        grandpas = np.full_like(grandmas, grandpa)
+    elif grandma is not None:
+        grandpas = np.asarray(store.ranked_grandpas[parent, grandma, child], dtype=np.intp)
+        grandmas = np.full_like(grandpas, grandma)
+    else:
+        grandpas, grandmas = np.divmod(np.asarray(store.ranked_grandparent_pairs[parent, child], dtype=np.intp), store.size)
+    values = store.affinity[parent, grandpas, grandmas, child]
+    keep = ~np.isnan(values)
+    if excluded_mask is not None:
+        if grandpa is None:
+            keep &= ~excluded_mask[grandpas]
+        if grandma is None:
+            keep &= ~excluded_mask[grandmas]
+    return values[keep], grandpas[keep], grandmas[keep]
+
+
+def threshold_parent_pairs(store, child, parent_pairs, fixed_codes, excluded_codes, threshold):
+    # 子を固定した探索で、A + B + C >= threshold になりうる親ペアを
+    # (親①, 親②, C値, 親①側の候補, 親②側の候補) の一覧にする。候補は side_candidate_arrays の戻り値で、
+    # 同じ親・固定祖父母の候補は使い回す。一覧の位置 (親ペア番号) は列挙の順序とカーソルに使われる
+    excluded_mask = np.zeros(store.size, dtype=bool)
+    excluded_mask[list(excluded_codes)] = True
+    sides = {}
+
+    def side(parent, grandpa, grandma):
+        key = (parent, grandpa, grandma)
+        if key not in sides:
+            sides[key] = side_candidate_arrays(store, parent, child, grandpa, grandma, excluded_mask)
+        return sides[key]
+
+    pairs = []
+    for p1, p2, c_val in parent_pairs:
+        side1 = side(p1, fixed_codes['grandpa1'], fixed_codes['grandma1'])
+        side2 = side(p2, fixed_codes['grandpa2'], fixed_codes['grandma2'])
+        if len(side1[0]) == 0 or len(side2[0]) == 0 or side1[0][0] + side2[0][0] + c_val < threshold:
+            continue
+        pairs.append((p1, p2, c_val, side1, side2))
+    return pairs
+
+
+def count_lineages_above(pairs, threshold, context=None):
+    # threshold_parent_pairs の各親ペアについて、両側の降順リストの二分探索で
+    # A + B + C >= threshold となる (祖父母①, 祖父母②) の組の数を数える (組を1つずつは調べない)
+    # 相性値と C値は 0.5 刻みなので、差をとって比較しても判定は和で比較した場合と変わらない
+    # 中断した場合は、それまでに数えた件数 (lineages_counted) が件数の下限になる
+    total = 0
+    for p1, p2, c_val, side1, side2 in pairs:
+        _raise_if_cancelled(context)
+        a_values, b_values = side1[0], side2[0]
+        # 親②側は昇順にして、各 a について b >= threshold - C - a を満たす個数を求める
+        below = np.searchsorted(b_values[::-1], threshold - c_val - a_values, side='left')
+        total += len(a_values) * len(b_values) - int(below.sum())
+        _report(context, lineages_counted=total)
+    _profile(context).count('parent_pairs', len(pairs))
+    return total
+
+
+def _resume_frontier(index, c_val, a_values, b_values, threshold, after):
+    # 親ペア index の行 (親①側の候補 i ごとの、親②側の候補 j の列) から、
+    # キーが after より後の最初の要素を集める。after が None なら先頭の行の先頭だけ
+    head = (-(a_values[0] + b_values[0] + c_val), index, 0, 0)
+    if after is None or head > after:
+        return [head]
+
+    last_total, last_index, last_i, last_j = -after[0], after[1], after[2], after[3]
+    n = len(b_values)
+    # 行ごとに、合計値が last_total 以上・より大きい要素の数 (行内は合計値の降順)
+    limits = last_total - c_val - a_values
+    at_least = n - np.searchsorted(b_values[::-1], limits, side='left')
+    above = n - np.searchsorted(b_values[::-1], limits, side='right')
+    if index < last_index:
+        emitted = at_least
+    elif index > last_index:
+        emitted = above
+    else:
+        rows = np.arange(len(a_values))
+        emitted = np.where(rows < last_i, at_least, np.where(rows > last_i, above, np.clip(last_j + 1, above, at_least)))
+
+    # 取り出し済みの行は先頭から連続している。各行の続きと、まだ始まっていない最初の行を入れる
+    started = int(np.count_nonzero(emitted))
+    frontier = []
+    for i, j in enumerate(emitted[:started].tolist()):
+        if j < n:
+            total = a_values[i] + b_values[j] + c_val
+            if total >= threshold:
+                frontier.append((-total, index, i, j))
+    if started < len(a_values):
+        total = a_values[started] + b_values[0] + c_val
+        if total >= threshold:
+            frontier.append((-total, index, started, 0))
+    return frontier
+
+
+def lineages_above(store, pairs, threshold, fixed_bonus, limit, after=None, context=None):
+    # A + B + C >= threshold の血統を (合計値の降順, 親ペア番号, 親①側の順位, 親②側の順位) の順に
+    # 最大 limit 件返す。戻り値は (結果, 次のページのキー)。続きが無ければキーは None
+    # after に前のページのキーを渡すと、その続きから返す (探索状態は保持せず、キーから復元する)
+    # 各親ペアの行 i は、先頭 (i, 0) を取り出したときに次の行 (i+1, 0) をヒープに入れるので、
+    # ヒープの大きさは取り出した件数 + 親ペア数 程度に収まる
+    heap = []
+    for index, (p1, p2, c_val, side1, side2) in enumerate(pairs):
+        _raise_if_cancelled(context)
+        heap.extend(_resume_frontier(index, c_val, side1[0], side2[0], threshold, after))
+    heapq.heapify(heap)
+    profile = _profile(context)
+    profile.lap('candidates')
+
+    results = []
+    last = None
+    while heap and len(results) < limit:
+        key = heapq.heappop(heap)
+        neg_total, index, i, j = key
+        p1, p2, c_val, (a_values, a_grandpas, a_grandmas), (b_values, b_grandpas, b_grandmas) = pairs[index]
+        codes = (p1, int(a_grandpas[i]), int(a_grandmas[i]), p2, int(b_grandpas[j]), int(b_grandmas[j]))
+        combination = {slot: store.bloodlines[code] for slot, code in zip(SLOT_NAMES, codes)}
+        results.append({'best_affinity': float(-neg_total) + fixed_bonus, 'combination': combination})
+        last = key
+        if j + 1 < len(b_values):
+            total = a_values[i] + b_values[j + 1] + c_val
+            if total >= threshold:
+                heapq.heappush(heap, (-total, index, i, j + 1))
+        if j == 0 and i + 1 < len(a_values):
+            total = a_values[i + 1] + b_values[0] + c_val
+            if total >= threshold:
+                heapq.heappush(heap, (-total, index, i + 1, 0))
+
+    profile.count('lineages', len(results))
+    profile.lap('aggregation')
+    return results, (last if heap else None)
+
+
+def slot_sensitivity(store, codes):
+    # 全スロットが決まった血統 (SLOT_NAMES 順のコード) について、1スロットだけ別の血統に替えた場合の
+    # A + B + C を、全ての置き換え先と全ての子についてまとめて求める (相性表と C値表の切り出しだけで済む)
+    # 戻り値は (現在の値 (子), 置き換え後の値 (スロット, 置き換え先, 子))。欠損を含む組は NaN
+    p1, gp1, gm1, p2, gp2, gm2 = codes
+    affinity = store.affinity
+    c_matrix = store.c_matrix
+    a_values = affinity[p1, gp1, gm1]
+    b_values = affinity[p2, gp2, gm2]
+    c_val = c_matrix[p1, p2]
+    current = a_values + b_values + c_val
+    table = np.stack([
+        affinity[:, gp1, gm1] + b_values + c_matrix[:, p2][:, None],
+        affinity[p1, :, gm1] + b_values + c_val,
+        affinity[p1, gp1, :] + b_values + c_val,
+        a_values + affinity[:, gp2, gm2] + c_matrix[p1, :][:, None],
+        a_values + affinity[p2, :, gm2] + c_val,
+        a_values + affinity[p2, gp2, :] + c_val,
+    ])
+    return current, table
+
+
+def slot_codes(explorable_codes, slot):
+    # explorable_codes は全スロット共通の血統コードの一覧か、スロットごとの一覧の辞書 (所持モンスターで絞り込んだ場合)
+    if isinstance(explorable_codes, dict):
+        return explorable_codes[slot]
+    return explorable_codes
+
+
+def _codes_key(explorable_codes):
+    if isinstance(explorable_codes, dict):
+        return tuple((slot, tuple(explorable_codes[slot])) for slot in SLOT_NAMES)
+    return tuple(explorable_codes)
+
+
+def side_combinations(store, fixed_slots, slots, explorable_codes):
+    # 片側 (親・祖父・祖母) の候補を辞書順に列挙し、コード配列 (k, 3) を返す
+    # 固定スロットが未知の血統の場合は候補なし
+    candidate_lists = []
+    for slot in slots:
+        value = fixed_slots.get(slot)
+        if value is None:
+            candidate_lists.append(slot_codes(explorable_codes, slot))
+        else:
+            code = store.code(value)
+            if code is None:
+                return np.empty((0, 3), dtype=np.intp)
+            candidate_lists.append([code])
+    # itertools.product と同じ順序 (最後のスロットが最も速く変わる) で配列として展開する
+    grids = np.meshgrid(*[np.asarray(codes, dtype=np.intp) for codes in candidate_lists], indexing='ij')
+    return np.stack([grid.ravel() for grid in grids], axis=1)
+
+
+class SideTables:
+    # 固定スロットと探索対象の血統が同じ探索で共有できる中間テーブル
+    # 両側の候補 (side1, side2)、全ての子に対する相性表 A, B、親ごとの区切りと子ごとの最大値。
+    # 相性表などは最初に使われたときに作る
+    def __init__(self, store, fixed_slots, explorable_codes):
+        self.store = store
+        self.side1 = side_combinations(store, fixed_slots, SIDE_SLOTS[0], explorable_codes)
+        self.side2 = side_combinations(store, fixed_slots, SIDE_SLOTS[1], explorable_codes)
+        self._tables = None
+        self._groups = None
+        self._group_maxima = None
+
+    def tables(self):
+        # A[i, 子], B[j, 子] (欠損は NaN のまま。比較は常に False になる)
+        if self._tables is None:
+            affinity = self.store.affinity
+            side1, side2 = self.side1, self.side2
+            self._tables = (
+                affinity[side1[:, 0], side1[:, 1], side1[:, 2]],
+                affinity[side2[:, 0], side2[:, 1], side2[:, 2]],
+            )
+        return self._tables
+
+    def groups(self):
+        # 辞書順に列挙しているため、同じ親を持つ行・列は連続している
+        if self._groups is None:
+            p1_codes, p1_start = np.unique(self.side1[:, 0], return_index=True)
+            p2_codes, p2_start = np.unique(self.side2[:, 0], return_index=True)
+            self._groups = (
+                p1_codes, np.append(p1_start, len(self.side1)),
+                p2_codes, np.append(p2_start, len(self.side2)),
+            )
+        return self._groups
+
+    def group_maxima(self):
+        # 親ごと・子ごとの最大値 (親の数, 子の数)
+        if self._group_maxima is None:
+            a_table, b_table = self.tables()
+            p1_codes, p1_bounds, p2_codes, p2_bounds = self.groups()
+            self._group_maxima = (
+                np.stack([_column_max(a_table[p1_bounds[g]:p1_bounds[g + 1]]) for g in range(len(p1_codes))]),
+                np.stack([_column_max(b_table[p2_bounds[g]:p2_bounds[g + 1]]) for g in range(len(p2_codes))]),
+            )
+        return self._group_maxima
+
+
+def side_tables(store, fixed_slots, explorable_codes, context=None):
+    # context.memo (一括探索で共有する辞書) があれば、同じ条件の SideTables を使い回す
+    memo = context.memo if context is not None else None
+    if memo is None:
+        return SideTables(store, fixed_slots, explorable_codes)
+    key = ('side_tables',) + tuple(fixed_slots.get(slot) for slot in SLOT_NAMES) + (_codes_key(explorable_codes),)
+    tables = memo.get(key)
+    if tables is None:
+        tables = memo[key] = SideTables(store, fixed_slots, explorable_codes)
+    return tables
+
+
+def _column_max(table):
+    # 子ごとの最大値 (欠損のみの列は -inf)
+    return np.where(np.isnan(table), -np.inf, table).max(axis=0)
+
+
+def _count_matches(lhs, rhs, count_dtype):
+    # matches[i, j] = #{子 c | lhs[i, c] >= rhs[j, c]}
+    # 3次元配列を作らず、子ごとの2次元比較を小さい整数型で累積する方が大幅に速い
+    counts = np.zeros((lhs.shape[0], rhs.shape[0]), dtype=count_dtype)
+    hit = np.empty(counts.shape, dtype=bool)
+    lhs = np.ascontiguousarray(lhs.T)
+    rhs = np.ascontiguousarray(rhs.T)
+    with np.errstate(invalid='ignore'):
+        for c in range(lhs.shape[0]):
+            np.greater_equal(lhs[c][:, None], rhs[c][None, :], out=hit)
+            counts += hit
+    return counts.astype(np.int64)
+
+
+def _top_merge(best_matches, best_index, matches, index, limit):
+    # (一致数の降順, 組み合わせ番号の昇順) で上位 limit 件を残す
+    matches = np.concatenate([best_matches, matches])
+    index = np.concatenate([best_index, index])
+    order = np.lexsort((index, -matches))[:limit]
+    return matches[order], index[order]
+
+
+def _restrict_parents(pair_bound, p1_codes, p2_codes, parent1_codes, parent2_codes, excluded_bound):
+    # 並列探索の分担: 担当外の親を持つ親ペアは上界を excluded_bound にして調べない
+    if parent1_codes is not None:
+        pair_bound[~np.isin(p1_codes, parent1_codes), :] = excluded_bound
+    if parent2_codes is not None:
+        pair_bound[:, ~np.isin(p2_codes, parent2_codes)] = excluded_bound
+
+
+def summary_entries(store, fixed_slots, explorable_codes, best_matches, best_index, context=None):
+    # summary_top の結果 (一致数, 組み合わせ番号) をレスポンスの形式に変換する
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    return _summary_entries(store, fixed_slots, tables.side1, tables.side2, best_matches, best_index)
+
+
+def _summary_entries(store, fixed_slots, side1, side2, best_matches, best_index):
+    exploring_slot_keys = [slot for slot in SLOT_NAMES if fixed_slots.get(slot) is None]
+    results = []
+    for matches, index in zip(np.asarray(best_matches).tolist(), np.asarray(best_index).tolist()):
+        i, j = divmod(index, len(side2))
+        codes = dict(zip(SIDE_SLOTS[0] + SIDE_SLOTS[1], side1[i].tolist() + side2[j].tolist()))
+        combination = {slot: store.bloodlines[codes[slot]] for slot in exploring_slot_keys}
+        results.append({
+            'parent_bloodline': " / ".join(combination.values()),
+            'matches': matches,
+            'combination': combination
+        })
+    return results
+
+
+def add_category_matches(store, fixed_slots, entries, fixed_bonus, target_min):
+    # サマリーの結果に、モン類ごとの一致数 (目標値以上になる子の数) と一致する子がいるモン類の数を付ける
+    # 判定は summary_top と同じ式で行うので、一致数の合計は matches と一致する
+    for entry in entries:
+        codes = [store.code(entry['combination'].get(slot, fixed_slots.get(slot))) for slot in SLOT_NAMES]
+        a_values = store.affinity[codes[0], codes[1], codes[2]]
+        b_values = store.affinity[codes[3], codes[4], codes[5]]
+        with np.errstate(invalid='ignore'):
+            hit = a_values + (store.c_matrix[codes[0], codes[3]] + fixed_bonus) >= target_min - b_values
+        counts = {category: int(hit[store.category_codes(category)].sum()) for category in store.categories}
+        entry['category_matches'] = counts
+        entry['categories_reached'] = sum(1 for count in counts.values() if count)
+    return entries
+
+
+def summarize_combinations(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                           context=None, chunk_elements=SUMMARY_CHUNK_ELEMENTS):
+    # 子を指定しない場合のサマリー探索
+    # 空きスロットの全組み合わせについて、全ての子の A+B+C+ボーナス を配列演算で求め、
+    # target_min 以上になる子の数を数えて上位 limit 件を返す。
+    # 並び順は一致数の降順、同数なら itertools.product の列挙順 (=組み合わせ番号順) で、
+    # 結果は常に厳密かつ再現可能。
+    best_matches, best_index = summary_top(
+        store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+        context=context, chunk_elements=chunk_elements
+    )
+    return summary_entries(store, fixed_slots, explorable_codes, best_matches, best_index, context=context)
+
+
+def _summary_pair_bound(store, tables, threshold):
+    # 親ペア単位の上界: 両側の子ごとの最大値と C値で到達しうる一致数の上限 (C値の無い親ペアは -1)
+    # 戻り値は (上界, C値) で、どちらも [親①の番号, 親②の番号]
+    p1_codes, _, p2_codes, _ = tables.groups()
+    a_group_max, b_group_max = tables.group_maxima()
+    c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    with np.errstate(invalid='ignore'):
+        pair_bound = ((a_group_max[:, None, :] + b_group_max[None, :, :] + c_sub[:, :, None]) >= threshold).sum(axis=2)
+    pair_bound[np.isnan(c_sub)] = -1
+    return pair_bound, c_sub
+
+
+def summary_upper_bound(store, fixed_slots, explorable_codes, fixed_bonus, target_min,
+                        parent1_codes=None, parent2_codes=None, context=None):
+    # 指定した親を持つ組み合わせが到達しうる一致数の上限 (並列探索を中断したときの、終わっていない分担の上界)
+    # 組み合わせが無ければ -inf
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    if len(tables.side1) == 0 or len(tables.side2) == 0:
+        return -np.inf
+    pair_bound, _ = _summary_pair_bound(store, tables, target_min - fixed_bonus - BOUND_EPSILON)
+    p1_codes, _, p2_codes, _ = tables.groups()
+    _restrict_parents(pair_bound, p1_codes, p2_codes, parent1_codes, parent2_codes, -1)
+    best = int(pair_bound.max())
+    return best if best >= 0 else -np.inf
+
+
+def summary_top(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                context=None, chunk_elements=SUMMARY_CHUNK_ELEMENTS, parent1_codes=None, parent2_codes=None):
+    # サマリー探索の本体。上位 limit 件を (一致数, 組み合わせ番号) の配列で返す
+    # 組み合わせ番号は 祖父母込みの親①側の番号 * 親②側の候補数 + 親②側の番号 (=列挙順)
+    # parent1_codes / parent2_codes を指定すると、その親を持つ組み合わせだけを調べる (並列探索用)
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    exploring_slot_keys = [slot for slot in SLOT_NAMES if fixed_slots.get(slot) is None]
+    if not exploring_slot_keys or limit <= 0:
+        return empty
+
+    profile = _profile(context)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    side1, side2 = tables.side1, tables.side2
+    profile.lap('candidates')
+    if len(side1) == 0 or len(side2) == 0:
+        return empty
+
+    a_table, b_table = tables.tables()
+    profile.lap('lookup')
+    n_children = a_table.shape[1]
+    k2 = len(side2)
+
+    p1_codes, p1_bounds, p2_codes, p2_bounds = tables.groups()
+    a_group_max, b_group_max = tables.group_maxima()
+
+    threshold = target_min - fixed_bonus - BOUND_EPSILON
+    pair_bound, c_sub = _summary_pair_bound(store, tables, threshold)
+    _restrict_parents(pair_bound, p1_codes, p2_codes, parent1_codes, parent2_codes, -1)
+
+    best_matches = np.empty(0, dtype=np.int64)
+    best_index = np.empty(0, dtype=np.int64)
+    count_dtype = np.uint8 if n_children < 256 else np.uint16
+
+    processed_count = 0
+    for pair in np.argsort(-pair_bound, axis=None, kind='stable').tolist():
+        g1, g2 = divmod(pair, len(p2_codes))
+        # 親ペアは上界の降順に調べるので、中断時の残りの上界はこの親ペアの上界
+        _raise_if_cancelled(context, bound=lambda: int(pair_bound[g1, g2]))
+        # 既に上位 limit 件が埋まっていれば、その最下位に届かない親ペア・行・列は調べない
+        kth = _shared_floor(context, best_matches[-1] if len(best_matches) >= limit else 0)
+        if pair_bound[g1, g2] < max(kth, 0):
+            break
+
+        c_val = c_sub[g1, g2]
+        rows = np.arange(p1_bounds[g1], p1_bounds[g1 + 1])
+        cols = np.arange(p2_bounds[g2], p2_bounds[g2 + 1])
+        with np.errstate(invalid='ignore'):
+            row_bound = ((a_table[rows] + b_group_max[g2] + c_val) >= threshold).sum(axis=1)
+            col_bound = ((b_table[cols] + a_group_max[g1] + c_val) >= threshold).sum(axis=1)
+        order = np.argsort(-row_bound, kind='stable')
+        rows, row_bound = rows[order], row_bound[order]
+
+        position = 0
+        chunk_rows = max(1, chunk_elements // len(cols))
+        while position < len(rows) and row_bound[position] >= kth:
+            _raise_if_cancelled(context, bound=lambda: int(pair_bound[g1, g2]))
+            block_rows = rows[position:position + chunk_rows]
+            block_rows = block_rows[row_bound[position:position + chunk_rows] >= kth]
+            block_cols = cols[col_bound >= kth]
+            position += chunk_rows
+            if len(block_cols) == 0:
+                break
+
+            matches = _count_matches(
+                a_table[block_rows] + (c_val + fixed_bonus), target_min - b_table[block_cols], count_dtype
+            )
+
+            matches = matches.ravel()
+            index = (block_rows[:, None] * k2 + block_cols[None, :]).ravel()
+            keep = matches >= kth
+            best_matches, best_index = _top_merge(best_matches, best_index, matches[keep], index[keep], limit)
+            if len(best_matches) >= limit:
+                _publish_floor(context, int(best_matches[-1]))
+            kth = _shared_floor(context, best_matches[-1] if len(best_matches) >= limit else 0)
+
+            processed_count += len(block_rows) * len(block_cols)
+            _report(context, partial=lambda: _summary_entries(store, fixed_slots, side1, side2, best_matches, best_index),
+                    combinations=processed_count)
+
+    profile.count('evaluated', processed_count)
+    profile.count('pruned', len(side1) * k2 - processed_count)
+    profile.lap('aggregation')
+    return best_matches, best_index
+
+
+def _pareto_front(vectors, block_size=256):
+    # 他の行に全ての子で同等以上となる (支配される) 行を除いた行番号を返す
+    # 合計値の降順に調べれば、支配する側は必ず先に現れるので、既に残した行とだけ比べればよい
+    # (全く同じベクトルが複数ある場合は先に現れた1行だけを残す)
+    order = np.argsort(-vectors.sum(axis=1), kind='stable')
+    front = np.empty(0, dtype=np.intp)
+    for start in range(0, len(order), block_size):
+        block = order[start:start + block_size]
+        block_vectors = vectors[block]
+        if len(front):
+            dominated = (vectors[front][None, :, :] >= block_vectors[:, None, :]).all(axis=2).any(axis=1)
+            block, block_vectors = block[~dominated], block_vectors[~dominated]
+        # ブロック内では自分より前の行にだけ支配されうる
+        covers = (block_vectors[None, :, :] >= block_vectors[:, None, :]).all(axis=2)
+        dominated = np.tril(covers, k=-1).any(axis=1)
+        front = np.concatenate([front, block[~dominated]])
+    return np.sort(front)
+
+
+def _covered(archive, vectors, block_size=256):
+    # vectors の各行が archive のいずれかの行に全ての子で同等以上とされるか
+    covered = np.zeros(len(vectors), dtype=bool)
+    if len(archive) == 0:
+        return covered
+    # 子ごとの比較を小さい2次元配列で累積する (3次元の比較配列を作るより速い)
+    archive = np.ascontiguousarray(archive.T)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size].T
+        cover = archive[0][None, :] >= block[0][:, None]
+        for k in range(1, len(archive)):
+            cover &= archive[k][None, :] >= block[k][:, None]
+        covered[start:start + block_size] = cover.any(axis=1)
+    return covered
+
+
+class ParetoArchive:
+    # 非劣解の集合を逐次更新する。追加した行のうち、既存の解に支配されない行だけを残し、
+    # 新しい行に支配された既存の解は取り除く (同じベクトルは先に追加された方を残す)
+    # 解は合計値の降順に保ち、多くの行を支配しやすい先頭の解で先にふるい落としてから残りと比べる
+    PREFILTER_SIZE = 256
+
+    def __init__(self, n_children):
+        self.vectors = np.empty((0, n_children))
+        self.ids = np.empty((0, 2), dtype=np.intp)
+
+    def dominates(self, vectors):
+        head = self.PREFILTER_SIZE
+        covered = _covered(self.vectors[:head], vectors)
+        rest = np.flatnonzero(~covered)
+        if len(rest) and len(self.vectors) > head:
+            covered[rest] = _covered(self.vectors[head:], vectors[rest])
+        return covered
+
+    def add(self, vectors, ids):
+        keep = ~self.dominates(vectors)
+        vectors, ids = vectors[keep], ids[keep]
+        if len(vectors) == 0:
+            return
+        front = _pareto_front(vectors)
+        vectors, ids = vectors[front], ids[front]
+        survivors = ~_covered(vectors, self.vectors)
+        vectors = np.concatenate([self.vectors[survivors], vectors])
+        ids = np.concatenate([self.ids[survivors], ids])
+        order = np.argsort(-vectors.sum(axis=1), kind='stable')
+        self.vectors, self.ids = vectors[order], ids[order]
+
+
+def _pair_maximin_above(lhs, rhs, floor, chunk_elements=SUMMARY_CHUNK_ELEMENTS):
+    # min_k (lhs[i, k] + rhs[j, k]) が floor を超える (i, j) のうち最大のものを (値, i, j) で返す
+    # まず制約の厳しい子だけで全ペアを評価して候補を絞り、残りの子は候補についてのみ調べる
+    n_children = lhs.shape[1]
+    order = np.argsort(lhs.max(axis=0) + rhs.max(axis=0), kind='stable')
+    probe = order[:MAXIMIN_PROBE_CHILDREN]
+    rest = order[MAXIMIN_PROBE_CHILDREN:]
+
+    partial = np.full((lhs.shape[0], rhs.shape[0]), np.inf)
+    tmp = np.empty(partial.shape)
+    for k in probe.tolist():
+        np.add(lhs[:, k][:, None], rhs[:, k][None, :], out=tmp)
+        np.minimum(partial, tmp, out=partial)
+    cand_i, cand_j = np.nonzero(partial > floor)
+    if len(cand_i) == 0:
+        return None
+    values = partial[cand_i, cand_j]
+    if len(rest):
+        lhs_rest = lhs[:, rest]
+        rhs_rest = rhs[:, rest]
+        step = max(1, chunk_elements // n_children)
+        for start in range(0, len(cand_i), step):
+            ci = cand_i[start:start + step]
+            cj = cand_j[start:start + step]
+            np.minimum(values[start:start + step], (lhs_rest[ci] + rhs_rest[cj]).min(axis=1),
+                       out=values[start:start + step])
+    best = int(np.argmax(values))
+    if not values[best] > floor:
+        return None
+    return values[best], cand_i[best], cand_j[best]
+
+
+def pareto_combinations(store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                        context=None, chunk_elements=SUMMARY_CHUNK_ELEMENTS):
+    # マルチモードのパレート解: 選択された子ごとの相性値のベクトルが、他のどの組み合わせにも
+    # 支配されない (全ての子で同等以上、という組み合わせが無い) 組み合わせを全空間から厳密に求める
+    #   1. 親ごとに、支配される祖父母の組を除く (同じ親の別の組に置き換えれば全ての子で同等以上になる)
+    #   2. 親ペアを上界 (両側の子ごとの最大値 + C) の合計の降順に調べ、上界が既存の解に支配される
+    #      親ペア・行・列は調べない
+    #   3. 残った行と列の和を、非劣解の集合 (ParetoArchive) に逐次追加する
+    # 戻り値は (子ごとの相性値のベクトル (固定ボーナス込み), 組み合わせ) の一覧
+    profile = _profile(context)
+    child_codes = np.asarray(child_codes, dtype=np.intp)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    side1, side2 = tables.side1, tables.side2
+    profile.lap('candidates')
+    if len(side1) == 0 or len(side2) == 0 or len(child_codes) == 0:
+        return []
+
+    a_table, b_table = tables.tables()
+    a_table, b_table = a_table[:, child_codes], b_table[:, child_codes]
+    profile.lap('lookup')
+    a_valid = ~np.isnan(a_table).any(axis=1)
+    b_valid = ~np.isnan(b_table).any(axis=1)
+    side1, a_table = side1[a_valid], a_table[a_valid]
+    side2, b_table = side2[b_valid], b_table[b_valid]
+    if len(side1) == 0 or len(side2) == 0:
+        return []
+
+    p1_codes, p1_start = np.unique(side1[:, 0], return_index=True)
+    p2_codes, p2_start = np.unique(side2[:, 0], return_index=True)
+    p1_bounds = np.append(p1_start, len(side1))
+    p2_bounds = np.append(p2_start, len(side2))
+    # 子ごとの最大値は支配されない組だけから求めても同じなので、支配される組の除去は親を調べるときに行う
+    a_group_max = np.stack([a_table[p1_bounds[g]:p1_bounds[g + 1]].max(axis=0) for g in range(len(p1_codes))])
+    b_group_max = np.stack([b_table[p2_bounds[g]:p2_bounds[g + 1]].max(axis=0) for g in range(len(p2_codes))])
+    group_cache = ({}, {})
+
+    def group_rows(side, g):
+        cache = group_cache[side]
+        if g not in cache:
+            bounds, table = (p1_bounds, a_table) if side == 0 else (p2_bounds, b_table)
+            cache[g] = bounds[g] + _pareto_front(table[bounds[g]:bounds[g + 1]])
+        return cache[g]
+
+    c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    ideal = a_group_max[:, None, :] + b_group_max[None, :, :] + c_sub[:, :, None]
+    pair_order = np.argsort(-ideal.sum(axis=2), axis=None, kind='stable')
+    n_children = len(child_codes)
+    archive = ParetoArchive(n_children)
+
+    def entries():
+        results = []
+        for vector, (i, j) in zip((archive.vectors + fixed_bonus).tolist(), archive.ids.tolist()):
+            codes = side1[i].tolist() + side2[j].tolist()
+            results.append((vector, {slot: store.bloodlines[code] for slot, code in zip(SLOT_NAMES, codes)}))
+        return results
+
+    def remaining_bound(position):
+        # 未処理の親ペアで到達しうる最低保証相性値の上限
+        ideal_min = ideal.min(axis=2).ravel()[pair_order[position:]]
+        ideal_min = ideal_min[~np.isnan(ideal_min)]
+        return float(ideal_min.max() + fixed_bonus) if len(ideal_min) else -np.inf
+
+    processed_count = 0
+    for position, pair in enumerate(pair_order.tolist()):
+        _raise_if_cancelled(context, bound=lambda: remaining_bound(position))
+        g1, g2 = divmod(pair, len(p2_codes))
+        c_val = c_sub[g1, g2]
+        if c_val != c_val or archive.dominates(ideal[g1, g2][None, :])[0]:
+            continue
+        rows = group_rows(0, g1)
+        cols = group_rows(1, g2)
+        rows = rows[~archive.dominates(a_table[rows] + b_group_max[g2] + c_val)]
+        cols = cols[~archive.dominates(b_table[cols] + a_group_max[g1] + c_val)]
+        if len(rows) == 0 or len(cols) == 0:
+            continue
+
+        chunk_rows = max(1, chunk_elements // (len(cols) * n_children))
+        for start in range(0, len(rows), chunk_rows):
+            _raise_if_cancelled(context, bound=lambda: remaining_bound(position))
+            block_rows = rows[start:start + chunk_rows]
+            vectors = (a_table[block_rows][:, None, :] + b_table[cols][None, :, :] + c_val).reshape(-1, n_children)
+            ids = np.stack(np.meshgrid(block_rows, cols, indexing='ij'), axis=-1).reshape(-1, 2)
+            archive.add(vectors, ids)
+            processed_count += len(block_rows) * len(cols)
+        _report(context, partial=lambda: [{
+            'min_guaranteed_affinity': min(vector),
+            'combination': combination,
+            'children_details': {store.bloodlines[code]: {'affinity': affinity} for code, affinity in zip(child_codes.tolist(), vector)},
+        } for vector, combination in entries()], combinations=processed_count, front_size=len(archive.vectors))
+
+    profile.count('evaluated', processed_count)
+    profile.count('pruned', len(side1) * len(side2) - processed_count)
+    profile.lap('aggregation')
+    return entries()
+
+
+def _maximin_pair_bound(c_sub, a_group_max, b_group_max):
+    # 親ペア単位の上界 C + min_k(maxA[k] + maxB[k]) (C値の無い親ペアは -inf)
+    pair_bound = (a_group_max[:, None, :] + b_group_max[None, :, :]).min(axis=2) + c_sub
+    pair_bound[np.isnan(c_sub)] = -np.inf
+    return pair_bound
+
+
+def maximin_upper_bound(store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                        parent1_codes=None, parent2_codes=None, context=None):
+    # 指定した親を持つ組み合わせの最低保証相性値の上限 (並列探索を中断したときの、終わっていない分担の上界)
+    # maximin_combination と同じ式だが、いずれかの子で欠損する祖父母の組も最大値に含めるので少し緩い
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    if len(tables.side1) == 0 or len(tables.side2) == 0 or len(child_codes) == 0:
+        return -np.inf
+    child_codes = np.asarray(child_codes, dtype=np.intp)
+    p1_codes, _, p2_codes, _ = tables.groups()
+    a_group_max, b_group_max = tables.group_maxima()
+    pair_bound = _maximin_pair_bound(
+        store.c_matrix[np.ix_(p1_codes, p2_codes)], a_group_max[:, child_codes], b_group_max[:, child_codes]
+    )
+    _restrict_parents(pair_bound, p1_codes, p2_codes, parent1_codes, parent2_codes, -np.inf)
+    return float(pair_bound.max() + fixed_bonus)
+
+
+def maximin_combination(store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                        context=None, chunk_elements=SUMMARY_CHUNK_ELEMENTS, parent1_codes=None, parent2_codes=None):
+    # マルチモード: 選択された子全員に対する最低相性値を最大化する組み合わせを厳密に求める
+    # 目的関数は A(親①, 祖父①, 祖母①) + B(親②, 祖父②, 祖母②) + C(親①, 親②) に分解できるので、
+    #   1. 片側ごとに子の相性ベクトルを前計算し、欠損を含む候補を除く
+    #   2. 親ペアごとの上界 C + min_k(maxA[k] + maxB[k]) の降順に調べ、暫定解を超えられない時点で打ち切る
+    #   3. 親ペア内では、支配される祖父母の組を除いた上で、上界で行・列を絞って総当たりする
+    # 戻り値は (最低保証相性値, 組み合わせ) 、成立する組み合わせが無ければ None
+    # parent1_codes / parent2_codes を指定すると、その親を持つ組み合わせだけを調べる (並列探索用)
+    profile = _profile(context)
+    child_codes = np.asarray(child_codes, dtype=np.intp)
+    tables = side_tables(store, fixed_slots, explorable_codes, context)
+    side1, side2 = tables.side1, tables.side2
+    profile.lap('candidates')
+    if len(side1) == 0 or len(side2) == 0 or len(child_codes) == 0:
+        return None
+
+    a_table, b_table = tables.tables()
+    a_table, b_table = a_table[:, child_codes], b_table[:, child_codes]
+    profile.lap('lookup')
+    # 選択された子のいずれかで相性値が欠損している候補は成立しない
+    a_valid = ~np.isnan(a_table).any(axis=1)
+    b_valid = ~np.isnan(b_table).any(axis=1)
+    side1, a_table = side1[a_valid], a_table[a_valid]
+    side2, b_table = side2[b_valid], b_table[b_valid]
+    if len(side1) == 0 or len(side2) == 0:
+        return None
+
+    p1_codes, p1_start = np.unique(side1[:, 0], return_index=True)
+    p2_codes, p2_start = np.unique(side2[:, 0], return_index=True)
+    p1_bounds = np.append(p1_start, len(side1))
+    p2_bounds = np.append(p2_start, len(side2))
+    a_group_max = np.stack([a_table[p1_bounds[g]:p1_bounds[g + 1]].max(axis=0) for g in range(len(p1_codes))])
+    b_group_max = np.stack([b_table[p2_bounds[g]:p2_bounds[g + 1]].max(axis=0) for g in range(len(p2_codes))])
+
+    c_sub = store.c_matrix[np.ix_(p1_codes, p2_codes)]
+    pair_bound = _maximin_pair_bound(c_sub, a_group_max, b_group_max)
+    _restrict_parents(pair_bound, p1_codes, p2_codes, parent1_codes, parent2_codes, -np.inf)
+
+    # 子が少ない場合は、支配される祖父母の組を親ごとに一度だけ除いておく
+    use_pareto = len(child_codes) <= PARETO_MAX_CHILDREN
+    group_cache = ({}, {})
+
+    def group_rows(side, g):
+        cache = group_cache[side]
+        if g not in cache:
+            bounds, table = (p1_bounds, a_table) if side == 0 else (p2_bounds, b_table)
+            rows = np.arange(bounds[g], bounds[g + 1])
+            cache[g] = rows[_pareto_front(table[rows])] if use_pareto else rows
+        return cache[g]
+
+    best_value = -np.inf
+    best_pair = None
+
+    def solution():
+        if best_pair is None:
+            return None
+        codes = side1[best_pair[0]].tolist() + side2[best_pair[1]].tolist()
+        combination = {slot: store.bloodlines[code] for slot, code in zip(SLOT_NAMES, codes)}
+        return float(best_value + fixed_bonus), combination
+
+    def partial_solution():
+        current = solution()
+        if current is None:
+            return []
+        return [{'min_guaranteed_affinity': current[0], 'combination': current[1]}]
+
+    processed_count = 0
+    for pair in np.argsort(-pair_bound, axis=None, kind='stable').tolist():
+        g1, g2 = divmod(pair, len(p2_codes))
+        # 親ペアは上界の降順に調べるので、中断時の残りの上界はこの親ペアの上界
+        _raise_if_cancelled(context, bound=lambda: float(pair_bound[g1, g2] + fixed_bonus))
+        # 他の分担が達成した値と同値の解は残す (同値の場合の勝ち負けを分担の順で決めるため)
+        floor = max(best_value, _shared_floor(context, -np.inf) - BOUND_EPSILON)
+        if not pair_bound[g1, g2] > floor:
+            break
+
+        c_val = c_sub[g1, g2]
+        rows = group_rows(0, g1)
+        cols = group_rows(1, g2)
+        # 相手側の最大値と組んでも暫定解を超えられない行・列は除く
+        row_bound = (a_table[rows] + b_group_max[g2]).min(axis=1) + c_val
+        col_bound = (b_table[cols] + a_group_max[g1]).min(axis=1) + c_val
+        rows, row_bound = rows[row_bound > floor], row_bound[row_bound > floor]
+        cols, col_bound = cols[col_bound > floor], col_bound[col_bound > floor]
+        order = np.argsort(-row_bound, kind='stable')
+        rows, row_bound = rows[order], row_bound[order]
+
+        chunk_rows = max(1, chunk_elements // max(1, len(cols)))
+        position = 0
+        while position < len(rows) and row_bound[position] > floor:
+            _raise_if_cancelled(context, bound=lambda: float(pair_bound[g1, g2] + fixed_bonus))
+            block_rows = rows[position:position + chunk_rows]
+            block_rows = block_rows[row_bound[position:position + chunk_rows] > floor]
+            block_cols = cols[col_bound > floor]
+            position += chunk_rows
+            if len(block_cols) == 0:
+                break
+
+            found = _pair_maximin_above(a_table[block_rows], b_table[block_cols], floor - c_val)
+            if found is not None:
+                value, i, j = found
+                best_value = floor = value + c_val
+                best_pair = (block_rows[i], block_cols[j])
+                _publish_floor(context, float(best_value))
+            processed_count += len(block_rows) * len(block_cols)
+
+        _report(context, partial=partial_solution, combinations=processed_count)
+
+    profile.count('evaluated', processed_count)
+    profile.count('pruned', len(side1) * len(side2) - processed_count)
+    profile.lap('aggregation')
+    return solution()
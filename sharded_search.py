@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from affinity_store import file_identity, open_store
+from search_engine import (
+    SUMMARY_CHUNK_ELEMENTS, ExplorationCancelled, SearchContext, _top_merge, maximin_combination, maximin_upper_bound,
+    slot_codes, summarize_combinations, summary_entries, summary_top, summary_upper_bound
+)
+
+# 総当たり探索を親ごとに分割して並列に実行するプロセス数 (0 または 1 なら従来どおり単一プロセス)
+SEARCH_PROCESS_WORKERS = int(os.environ.get('EXPLORATION_PROCESS_WORKERS', 0))
+# 中止フラグと進捗を確認する間隔 (秒)
+SHARD_POLL_INTERVAL = 0.1
+
+_executor = None
+_manager = None
+_worker_stores = {}
+
+
+def _get_executor(workers):
+    # プロセスプールは最初の並列探索で作り、以降は使い回す
+    # Flask のスレッドと fork の組み合わせを避けるため spawn で起動する
+    global _executor, _manager
+    if _executor is None:
+        mp_context = multiprocessing.get_context('spawn')
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        _manager = mp_context.Manager()
+    return _executor
+
+
+def _worker_store(path, version):
+    # ワーカーではスナップショットを読み取り専用でメモリマップし、プロセス内で使い回す
+    # 再読み込みで同じパスのファイルが差し替えられた場合は、開き直す
+    store = _worker_stores.get(path)
+    if store is None or store.version != version:
+        store = _worker_stores[path] = open_store(path)
+    if store.version != version:
+        raise ValueError(f"相性ストアのバージョンが一致しません: {path}")
+    return store
+
+
+def _summary_shard(store_path, version, shard, shared, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                   chunk_elements):
+    cancel_event, shared_floor = shared
+    context = SearchContext(cancel_event=cancel_event, shared_floor=shared_floor)
+    return summary_top(
+        _worker_store(store_path, version), fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+        context=context, chunk_elements=chunk_elements, **shard
+    )
+
+
+def _maximin_shard(store_path, version, shard, shared, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                   chunk_elements):
+    cancel_event, shared_floor = shared
+    context = SearchContext(cancel_event=cancel_event, shared_floor=shared_floor)
+    return maximin_combination(
+        _worker_store(store_path, version), fixed_slots, explorable_codes, child_codes, fixed_bonus,
+        context=context, chunk_elements=chunk_elements, **shard
+    )
+
+
+def _shards(fixed_slots, explorable_codes, workers):
+    # 未固定の親 (親①を優先) の血統をワーカー数の分担に振り分ける。親が両方固定なら分割しない
+    # 分担内では上位の最下位値 (枝刈りの基準) を共有できるので、分担はワーカー数より細かくしない。
+    # 上界の高い親が特定の分担に偏らないよう、血統コードを交互に割り当てる
+    for slot, key in (('parent1', 'parent1_codes'), ('parent2', 'parent2_codes')):
+        if fixed_slots.get(slot) is None:
+            codes = slot_codes(explorable_codes, slot)
+            count = min(workers, len(codes))
+            return [{key: list(codes[start::count])} for start in range(count)]
+    return []
+
+
+def _on_disk(store):
+    # ワーカーはパスからストアを開くので、パスの中身が差し替えられた古いストアは並列にできない
+    try:
+        return store.path is not None and file_identity(store.path) == store.file_id
+    except FileNotFoundError:
+        return False
+
+
+def _can_shard(store, fixed_slots, explorable_codes, workers):
+    return workers > 1 and _on_disk(store) and len(_shards(fixed_slots, explorable_codes, workers)) > 1
+
+
+def _pending_shard(shards):
+    # 終わっていない分担をまとめた1つの分担 (同じスロットの親のコードを合わせる)
+    merged = {}
+    for shard in shards:
+        for key, codes in shard.items():
+            merged.setdefault(key, []).extend(codes)
+    return merged
+
+
+def _run_shards(store, function, shards, shard_args, initial_floor, workers, context, on_result, bound=None):
+    # 各分担をプロセスプールで実行し、終わったものから on_result(分担番号, 結果) に渡す
+    # 分担間では中止フラグと枝刈りの基準値を共有する
+    # 中止された場合はワーカーにも中止フラグを伝えてから ExplorationCancelled を送出する
+    # bound は終わっていない分担 (_pending_shard) の上界を返す関数で、中止時に context.upper_bound に入れる
+    executor = _get_executor(workers)
+    cancel_event = _manager.Event()
+    shared = (cancel_event, _manager.Value('d', initial_floor))
+    futures = {
+        executor.submit(function, store.path, store.version, shard, shared, *shard_args): index
+        for index, shard in enumerate(shards)
+    }
+    pending = set(futures)
+    try:
+        while pending:
+            if context is not None and context.is_cancelled():
+                if bound is not None:
+                    remaining = [shards[futures[future]] for future in pending]
+                    context.upper_bound = bound(_pending_shard(remaining)) if remaining else -np.inf
+                raise ExplorationCancelled()
+            done, pending = wait(pending, timeout=SHARD_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_result(futures[future], future.result())
+            if context is not None and done:
+                context.report_progress(shards_done=len(shards) - len(pending), shards_total=len(shards))
+    except BaseException:
+        cancel_event.set()
+        for future in pending:
+            future.cancel()
+        raise
+
+
+def sharded_summarize_combinations(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                                   context=None, workers=SEARCH_PROCESS_WORKERS,
+                                   chunk_elements=SUMMARY_CHUNK_ELEMENTS):
+    # summarize_combinations の並列版。各分担の上位 limit 件を (一致数の降順, 組み合わせ番号の昇順) で
+    # 併合するので、結果は単一プロセスの場合と完全に一致する
+    # (共有する基準値は他の分担の limit 件目の一致数で、同数の組み合わせは枝刈りしない)
+    if limit <= 0 or not _can_shard(store, fixed_slots, explorable_codes, workers):
+        return summarize_combinations(store, fixed_slots, explorable_codes, fixed_bonus, target_min, limit,
+                                      context=context, chunk_elements=chunk_elements)
+
+    merged = [np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)]
+
+    def on_result(_, top):
+        best_matches, best_index = _top_merge(merged[0], merged[1], top[0], top[1], limit)
+        merged[:] = best_matches, best_index
+        if context is not None:
+            context.report_partial(
+                lambda: summary_entries(store, fixed_slots, explorable_codes, best_matches, best_index)
+            )
+
+    _run_shards(
+        store, _summary_shard, _shards(fixed_slots, explorable_codes, workers),
+        (fixed_slots, explorable_codes, fixed_bonus, target_min, limit, chunk_elements), 0,
+        workers, context, on_result,
+        bound=lambda shard: summary_upper_bound(
+            store, fixed_slots, explorable_codes, fixed_bonus, target_min, context=context, **shard
+        )
+    )
+    if context is not None:
+        context.profile.lap('aggregation')
+    return summary_entries(store, fixed_slots, explorable_codes, merged[0], merged[1])
+
+
+def sharded_maximin_combination(store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                                context=None, workers=SEARCH_PROCESS_WORKERS,
+                                chunk_elements=SUMMARY_CHUNK_ELEMENTS):
+    # maximin_combination の並列版。各分担の最適解のうち最低保証相性値が最大のものを返す
+    # (同値の場合は分担の順で先のもの)
+    if not _can_shard(store, fixed_slots, explorable_codes, workers):
+        return maximin_combination(store, fixed_slots, explorable_codes, child_codes, fixed_bonus,
+                                   context=context, chunk_elements=chunk_elements)
+
+    winners = {}
+
+    def best_solution():
+        best = None
+        for index in sorted(winners):
+            if best is None or winners[index][0] > best[0]:
+                best = winners[index]
+        return best
+
+    def on_result(index, solution):
+        if solution is None:
+            return
+        winners[index] = solution
+        if context is not None:
+            best_value, best_combination = best_solution()
+            context.report_partial(
+                lambda: [{'min_guaranteed_affinity': best_value, 'combination': best_combination}]
+            )
+
+    _run_shards(
+        store, _maximin_shard, _shards(fixed_slots, explorable_codes, workers),
+        (fixed_slots, explorable_codes, [int(code) for code in child_codes], fixed_bonus, chunk_elements), -np.inf,
+        workers, context, on_result,
+        bound=lambda shard: maximin_upper_bound(
+            store, fixed_slots, explorable_codes, child_codes, fixed_bonus, context=context, **shard
+        )
+    )
+    if context is not None:
+        context.profile.lap('aggregation')
+    return best_solution()
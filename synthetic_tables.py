@@ -0,0 +1,81 @@
+import argparse
+import os
+
+import numpy as np
+
+# 合成データの既定値 (ベンチマーク用)
+DEFAULT_SEED = 0
+MONSTER_CATEGORIES = ['竜類', '獣類', '鳥類', '植物類', '物質類', '魔法類']
+
+
+def synthetic_bloodlines(n):
+    # 名前順とコード順が一致するよう、ゼロ埋めした連番の名前にする
+    return [f"血統{i:02d}" for i in range(n)]
+
+
+def generate_tables(n, seed=DEFAULT_SEED, missing_rate=0.02):
+    # N 血統分の相性テーブル・C値テーブル・モンスター一覧を決定的に生成する
+    # 相性値は 親×子 の基本値 + 祖父母×子 の補正 + ノイズ で、実データと同程度の値域になる。
+    # missing_rate の割合で相性値を欠損させ、欠損の扱いを含む経路も通るようにする
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    names = np.array(synthetic_bloodlines(n))
+
+    base = rng.integers(20, 90, (n, n))
+    grandparent = rng.integers(0, 50, (n, n))
+    p, gp, gm, ch = (axis.ravel() for axis in np.indices((n, n, n, n)))
+    values = (base[p, ch] + grandparent[gp, ch] + grandparent[gm, ch] + rng.integers(0, 10, p.size)).astype(np.float64)
+    keep = rng.random(p.size) >= missing_rate
+    # 子と同じ血統の組 (p = gp = gm = ch) は必ず残し、どの子にも最低1件の相性値があるようにする
+    keep |= (p == gp) & (gp == gm) & (gm == ch)
+    affinity_df = pd.DataFrame({
+        'parent_bloodline': names[p[keep]],
+        'grandpa_bloodline': names[gp[keep]],
+        'grandma_bloodline': names[gm[keep]],
+        'child_bloodline': names[ch[keep]],
+        'main_affinity': values[keep],
+    })
+
+    c1, c2 = (axis.ravel() for axis in np.indices((n, n)))
+    distinct = c1 != c2
+    c1, c2 = c1[distinct], c2[distinct]
+    c_keep = rng.random(c1.size) >= missing_rate
+    c_df = pd.DataFrame({
+        'parent1_bloodline': names[c1[c_keep]],
+        'parent2_bloodline': names[c2[c_keep]],
+        'c_affinity': rng.integers(0, 60, c1.size)[c_keep].astype(np.float64),
+    })
+
+    monsters_df = pd.DataFrame({
+        '主血統': names,
+        'モン類': [MONSTER_CATEGORIES[i % len(MONSTER_CATEGORIES)] for i in range(n)],
+    })
+    return affinity_df, c_df, monsters_df
+
+
+def write_tables(directory, n, seed=DEFAULT_SEED, missing_rate=0.02):
+    # アプリが読み込むのと同じファイル名で書き出し、3つのパスを返す
+    os.makedirs(directory, exist_ok=True)
+    affinity_df, c_df, monsters_df = generate_tables(n, seed=seed, missing_rate=missing_rate)
+    paths = {
+        'affinity': os.path.join(directory, 'part_affinity_lookup_table.csv'),
+        'c': os.path.join(directory, 'part_C_lookup_table.csv'),
+        'monsters': os.path.join(directory, 'monsters.xlsx'),
+    }
+    affinity_df.to_csv(paths['affinity'], index=False)
+    c_df.to_csv(paths['c'], index=False)
+    monsters_df.to_excel(paths['monsters'], index=False)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ベンチマーク用の合成相性テーブルを生成します。')
+    parser.add_argument('directory', help='出力先ディレクトリ')
+    parser.add_argument('--bloodlines', type=int, default=32, help='血統数 N (10〜60)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--missing-rate', type=float, default=0.02, help='欠損させる相性値の割合')
+    args = parser.parse_args()
+    written = write_tables(args.directory, args.bloodlines, seed=args.seed, missing_rate=args.missing_rate)
+    for path in written.values():
+        print(path)